@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the reservation calendar.
+
+Compares the indexed calendar against the old linear reservation list, with all
+reservations on a single (busy) resource. Run from the top-level directory:
+
+    PYTHONPATH=. python benchmarks/bench_calendar.py [size ...]
+"""
+
+import sys
+import time
+import random
+import datetime
+
+from opennsa.backends.common import calendar
+
+
+RESOURCE = 'port-1'
+QUERIES  = 1000
+
+BASE = datetime.datetime(2024, 1, 1)
+
+
+
+def linearIsAvailable(reservations, resource, start_time, end_time):
+    # what ReservationCalendar.checkReservation used to do
+    for (c_resource, c_start_time, c_end_time) in reservations:
+        if resource == c_resource:
+            if not (end_time < c_start_time or start_time > c_end_time):
+                return False
+    return True
+
+
+
+def createReservations(size):
+    # non-overlapping one-minute reservations with small gaps, as on a busy port
+    rng = random.Random(size)
+    reservations = []
+    for i in range(size):
+        start_time = BASE + datetime.timedelta(minutes=2*i)
+        end_time   = start_time + datetime.timedelta(seconds=rng.randint(30, 60))
+        reservations.append( (RESOURCE, start_time, end_time) )
+    rng.shuffle(reservations)
+    return reservations
+
+
+
+def createQueries(size):
+    rng = random.Random(-size)
+    queries = []
+    for _ in range(QUERIES):
+        start_time = BASE + datetime.timedelta(minutes=rng.randint(0, 2*size))
+        queries.append( (start_time, start_time + datetime.timedelta(seconds=50)) )
+    return queries
+
+
+
+def run(size):
+
+    reservations = createReservations(size)
+    queries = createQueries(size)
+
+    t = time.time()
+    cal = calendar.ReservationCalendar()
+    for resource, start_time, end_time in reservations:
+        cal.addReservation(resource, start_time, end_time)
+    build_time = time.time() - t
+
+    # the linear scan is so slow on large sizes that we sample fewer queries
+    linear_queries = queries[:max(10, QUERIES * 10000 / size)]
+    t = time.time()
+    linear_result = [ linearIsAvailable(reservations, RESOURCE, st, et) for st, et in linear_queries ]
+    linear_time = (time.time() - t) / len(linear_queries)
+
+    t = time.time()
+    indexed_result = [ cal.isAvailable(RESOURCE, st, et) for st, et in queries ]
+    indexed_time = (time.time() - t) / len(queries)
+
+    assert linear_result == indexed_result[:len(linear_queries)], 'Linear and indexed calendar disagree'
+
+    t = time.time()
+    for resource, start_time, end_time in reservations[:QUERIES]:
+        cal.removeReservation(resource, start_time, end_time)
+    remove_time = (time.time() - t) / QUERIES
+
+    print '%8i reservations: build %6.2fs  check linear %9.3f ms  indexed %6.3f ms (%6ix)  remove %6.3f ms' % \
+          (size, build_time, linear_time * 1000, indexed_time * 1000, linear_time / indexed_time, remove_time * 1000)
+
+
+
+if __name__ == '__main__':
+    sizes = [ int(a) for a in sys.argv[1:] ] or [ 10000, 100000, 1000000 ]
+    for size in sizes:
+        run(size)
+
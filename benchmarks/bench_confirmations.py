@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for creating acknowledgements and confirmations.
+
+Compares building the messages with the bindings, i.e., creating and
+serializing an element tree, with the templates in the nsi2 helper, which
+only fill in the text fields.
+Run from the top-level directory:
+
+    PYTHONPATH=. python benchmarks/bench_confirmations.py
+"""
+
+import time
+import datetime
+
+from opennsa import nsa
+from opennsa.protocols.shared import minisoap
+from opennsa.protocols.nsi2 import helper
+from opennsa.protocols.nsi2.bindings import nsiconnection
+
+
+ITERATIONS = 10000
+
+REQUESTER_NSA  = 'urn:ogf:network:aruba.net:nsa:requester'
+PROVIDER_NSA   = 'urn:ogf:network:aruba.net:nsa'
+CORRELATION_ID = 'urn:uuid:4b2b8a3e-4bb4-4c1b-a6e4-6f6c6c7d9a01'
+CONNECTION_ID  = 'ARU-7af3e1'
+
+HEADER = nsa.NSIHeader(REQUESTER_NSA, PROVIDER_NSA, correlation_id=CORRELATION_ID)
+TIMESTAMP = datetime.datetime(2014, 4, 1, 12, 30, 15)
+
+
+
+def timeit(function):
+    t = time.time()
+    for _ in xrange(ITERATIONS):
+        function()
+    return (time.time() - t) / ITERATIONS * 10**6 # microseconds
+
+
+
+def treePayload(body_element):
+    header_element = helper.createHeader(REQUESTER_NSA, PROVIDER_NSA, correlation_id=CORRELATION_ID)
+    return minisoap.createSoapPayload(body_element, header_element)
+
+
+def treeAcknowledgement():
+    return treePayload( nsiconnection.GenericAcknowledgmentType().xml(nsiconnection.acknowledgment) )
+
+def treeReserveResponse():
+    return treePayload( nsiconnection.ReserveResponseType(CONNECTION_ID).xml(nsiconnection.reserveResponse) )
+
+def treeGenericConfirmed():
+    return treePayload( nsiconnection.GenericConfirmedType(CONNECTION_ID).xml(nsiconnection.provisionConfirmed) )
+
+def treeDataPlaneStateChange():
+    dps = nsiconnection.DataPlaneStateChangeRequestType(CONNECTION_ID, 7, helper.createXMLTime(TIMESTAMP),
+                                                        nsiconnection.DataPlaneStatusType(True, 0, True))
+    return treePayload( dps.xml(nsiconnection.dataPlaneStateChange) )
+
+
+def templateAcknowledgement():
+    return helper.createGenericAcknowledgement(HEADER)
+
+def templateReserveResponse():
+    return helper.createReserveResponse(HEADER, CONNECTION_ID)
+
+def templateGenericConfirmed():
+    return helper.createGenericConfirmed(nsiconnection.provisionConfirmed, REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID, CONNECTION_ID)
+
+def templateDataPlaneStateChange():
+    return helper.createDataPlaneStateChange(REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID, CONNECTION_ID, 7, TIMESTAMP, True, 0, True)
+
+
+
+def run():
+
+    for name, tree, template in [
+        ('acknowledgement',      treeAcknowledgement,      templateAcknowledgement),
+        ('reserveResponse',      treeReserveResponse,      templateReserveResponse),
+        ('provisionConfirmed',   treeGenericConfirmed,     templateGenericConfirmed),
+        ('dataPlaneStateChange', treeDataPlaneStateChange, templateDataPlaneStateChange),
+    ]:
+        assert tree() == template()
+        tt = timeit(tree)
+        pt = timeit(template)
+        print '%-20s  bindings %7.2f us (%6i/s)   template %6.2f us (%7i/s)   (%5.1fx)' % \
+              (name, tt, 10**6 / tt, pt, 10**6 / pt, tt / pt)
+
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for label set operations.
+
+Compares the range list representation with the integer bitset, on
+fragmented VLAN label sets. For operations producing a new label the bitset
+result has to be turned back into ranges, which is included in the timing.
+For the other operations the Label method, which picks a representation
+depending on the label, is timed as well.
+Run from the top-level directory:
+
+    PYTHONPATH=. python benchmarks/bench_label.py
+"""
+
+import time
+import random
+
+from opennsa import nsa, constants as cnt
+
+
+ITERATIONS = 2000
+
+
+
+def createLabel(rng, n_ranges):
+    ranges = []
+    for _ in range(n_ranges):
+        v1 = rng.randint(1, 4000)
+        ranges.append( '%i-%i' % (v1, v1 + rng.randint(0, 40)) )
+    return nsa.Label(cnt.ETHERNET_VLAN, ','.join(ranges))
+
+
+
+def timeit(function, *args):
+    t = time.time()
+    for _ in xrange(ITERATIONS):
+        function(*args)
+    return (time.time() - t) / ITERATIONS * 10**6 # microseconds
+
+
+
+def bitsToRanges(bits):
+    ranges = []
+    offset = 0
+    while bits:
+        skip = (bits & -bits).bit_length() - 1
+        bits >>= skip
+        run = (bits ^ (bits + 1)).bit_length() - 1
+        bits >>= run
+        ranges.append( (offset + skip, offset + skip + run - 1) )
+        offset += skip + run
+    return ranges
+
+
+
+def rangeIntersect(l1, l2):
+    return nsa.Label._fromRanges(l1.type_, nsa._intersectRanges(l1.values, l2.values))
+
+def rangeUnion(l1, l2):
+    return nsa.Label._fromRanges(l1.type_, nsa._mergeRanges(l1.values + l2.values))
+
+def rangeDifference(l1, l2):
+    return nsa.Label._fromRanges(l1.type_, nsa._differenceRanges(l1.values, l2.values))
+
+def rangeIntersects(l1, l2):
+    return len(nsa._intersectRanges(l1.values, l2.values)) > 0
+
+def rangeFirstFree(l1, l2):
+    free = nsa._differenceRanges(l1.values, l2.values)
+    return free[0][0] if free else None
+
+def rangeContains(l1, values):
+    return [ any( v1 <= v <= v2 for v1, v2 in l1.values ) for v in values ]
+
+
+def bitsIntersect(l1, l2):
+    return nsa.Label._fromRanges(l1.type_, bitsToRanges(l1.bits() & l2.bits()))
+
+def bitsUnion(l1, l2):
+    return nsa.Label._fromRanges(l1.type_, bitsToRanges(l1.bits() | l2.bits()))
+
+def bitsDifference(l1, l2):
+    return nsa.Label._fromRanges(l1.type_, bitsToRanges(l1.bits() & ~l2.bits()))
+
+def bitsIntersects(l1, l2):
+    return (l1.bits() & l2.bits()) != 0
+
+def bitsFirstFree(l1, l2):
+    free = l1.bits() & ~l2.bits()
+    return (free & -free).bit_length() - 1 if free else None
+
+def bitsContains(l1, values):
+    bits = l1.bits()
+    return [ bool((bits >> v) & 1) for v in values ]
+
+
+# what the Label methods do, picking a representation
+def labelIntersects(l1, l2):
+    return l1.intersects(l2)
+
+def labelFirstFree(l1, l2):
+    return l1.firstFreeValue(l2)
+
+def labelContains(l1, values):
+    return [ v in l1 for v in values ]
+
+
+
+def run(n_ranges):
+
+    rng = random.Random(n_ranges)
+    l1 = createLabel(rng, n_ranges)
+    l2 = createLabel(rng, n_ranges)
+    values = [ rng.randint(1, 4095) for _ in range(10) ]
+
+    assert rangeIntersect(l1, l2).values  == bitsIntersect(l1, l2).values
+    assert rangeUnion(l1, l2).values      == bitsUnion(l1, l2).values
+    assert rangeDifference(l1, l2).values == bitsDifference(l1, l2).values
+    assert rangeIntersects(l1, l2)        == bitsIntersects(l1, l2)
+    assert rangeFirstFree(l1, l2)         == bitsFirstFree(l1, l2)
+    assert rangeContains(l1, values)      == bitsContains(l1, values)      == labelContains(l1, values)
+
+    print '%4i ranges (%i/%i after merge):' % (n_ranges, len(l1.values), len(l2.values))
+    for name, range_op, bits_op, label_op, args in [
+        ('intersect',  rangeIntersect,  bitsIntersect,  None,            (l1, l2)),
+        ('union',      rangeUnion,      bitsUnion,      None,            (l1, l2)),
+        ('difference', rangeDifference, bitsDifference, None,            (l1, l2)),
+        ('intersects', rangeIntersects, bitsIntersects, labelIntersects, (l1, l2)),
+        ('first free', rangeFirstFree,  bitsFirstFree,  labelFirstFree,  (l1, l2)),
+        ('contains10', rangeContains,   bitsContains,   labelContains,   (l1, values)),
+    ]:
+        rt = timeit(range_op, *args)
+        bt = timeit(bits_op,  *args)
+        line = '    %-10s  ranges %8.2f us   bitset %8.2f us   (%5.1fx)' % (name, rt, bt, rt / bt)
+        if label_op:
+            line += '   Label %8.2f us' % timeit(label_op, *args)
+        print line
+
+
+
+if __name__ == '__main__':
+    for n_ranges in (1, 10, 100, 1000):
+        run(n_ranges)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for payload logging.
+
+Compares the old way of logging payloads, formatting the message and handing
+it to log.msg, where the observer drops it when payload logging is off, with
+logging.logPayload, which checks the payload flag before doing anything.
+With payload logging on, logPayload is slower, as it tries to indent the
+logged copy of the payload.
+Messages go through the regular twisted logging machinery to a
+DebugLogObserver writing to /dev/null.
+Run from the top-level directory:
+
+    PYTHONPATH=. python benchmarks/bench_logging.py
+"""
+
+import os
+import time
+
+from twisted.python import log
+
+from opennsa import logging
+
+
+ITERATIONS = 20000
+
+LOG_SYSTEM = 'Benchmark'
+
+
+
+def timeit(function, *args):
+    t = time.time()
+    for _ in xrange(ITERATIONS):
+        function(*args)
+    return (time.time() - t) / ITERATIONS * 10**6 # microseconds
+
+
+
+def eagerPayload(payload):
+    log.msg(" -- Received Reply --\n%s\n -- END. Received Reply --" % payload, system=LOG_SYSTEM, payload=True)
+
+
+def lazyPayload(payload):
+    logging.logPayload(LOG_SYSTEM, payload, 'Received Reply')
+
+
+
+def run(payload_size, dump_payload):
+
+    payload = ('<payload>' + 'x' * payload_size + '</payload>')
+
+    logging.setPayloadLogging(dump_payload)
+    observer = logging.DebugLogObserver(open(os.devnull, 'w'), payload=dump_payload)
+    log.startLoggingWithObserver(observer.emit, setStdout=False)
+    try:
+        et = timeit(eagerPayload, payload)
+        lt = timeit(lazyPayload, payload)
+    finally:
+        log.removeObserver(observer.emit)
+
+    print '%6i bytes, payload logging %-3s   eager %8.2f us   logPayload %8.2f us   (%6.1fx)' % \
+          (len(payload), 'on' if dump_payload else 'off', et, lt, et / lt)
+
+
+
+if __name__ == '__main__':
+    for payload_size in (100, 4000, 40000):
+        for dump_payload in (False, True):
+            run(payload_size, dump_payload)
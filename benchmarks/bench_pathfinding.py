@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for topology path finding.
+
+First builds synthetic ladder topologies, two rows of networks, where each
+network is connected to its neighbours in the same row and to the network in
+the other row. The number of loop free paths between the corners grows
+exponentially with the length of the ladder, so the exhaustive search
+(findPaths) is only run for small sizes.
+
+Then builds larger mesh topologies, a ring of networks with random extra links,
+where paths are short, like in real multi-domain topologies. The shortest path
+search (findPath) and the k shortest paths search (findPaths with max_paths)
+are run on all topologies.
+
+Run from the top-level directory:
+
+    PYTHONPATH=. python benchmarks/bench_pathfinding.py
+"""
+
+import time
+import random
+from StringIO import StringIO
+
+from opennsa import nsa, constants as cnt
+from opennsa.topology import nml, nrmparser
+
+
+LADDER_LENGTHS = [ 4, 8, 12, 25, 50 ]
+MESH_SIZES     = [ 100, 300, 1000 ]
+MESH_QUERIES   = 20
+
+MAX_EXHAUSTIVE_LENGTH = 12
+K_PATHS = 5
+
+PORT_LINE = 'bi-ethernet     %-12s %-28s vlan:%s  1000    em%i\n'
+
+
+
+def networkName(row, column):
+    return 'n%i-%i' % (row, column)
+
+
+
+def createTopology(neighbours):
+    # neighbours is a dict: network name -> [ network name ]
+
+    topology = nml.Topology()
+    agent = nsa.NetworkServiceAgent('bench:nsa', 'endpoint')
+
+    for idx, name in enumerate(sorted(neighbours)):
+        spec = PORT_LINE % ('ps', '-', '1780-1789', 0)
+        for port_idx, remote in enumerate(neighbours[name]):
+            # vary the labels a bit, so some combinations cannot be used
+            labels = '1780-1789' if (idx + port_idx) % 3 else '1780-1784'
+            spec += PORT_LINE % (remote, '%s#%s-(in|out)' % (remote, name), labels, port_idx+1)
+
+        network, _ = nrmparser.parseTopologySpec(StringIO(spec), name)
+        topology.addNetwork(network, agent)
+
+    return topology
+
+
+
+def createLadder(length):
+    neighbours = {}
+    for row in (0, 1):
+        for column in range(length):
+            nb = [ networkName(1 - row, column) ]
+            if column > 0:
+                nb.append( networkName(row, column-1) )
+            if column < length - 1:
+                nb.append( networkName(row, column+1) )
+            neighbours[networkName(row, column)] = nb
+    return neighbours
+
+
+
+def createMesh(size):
+    rng = random.Random(size)
+    neighbours = dict( [ (networkName(0, i), set()) for i in range(size) ] )
+    for i in range(size):
+        links = [ (i+1) % size ] + [ rng.randint(0, size-1) for _ in range(2) ]
+        for j in links:
+            if i != j:
+                neighbours[networkName(0, i)].add(networkName(0, j))
+                neighbours[networkName(0, j)].add(networkName(0, i))
+    return dict( [ (name, sorted(nb)) for name, nb in neighbours.items() ] )
+
+
+
+def stp(name):
+    label = nsa.Label(cnt.ETHERNET_VLAN, '1780-1789')
+    return nsa.STP(name + ':topology', name + ':ps', [label])
+
+
+
+def runLadder(length):
+
+    t = time.time()
+    topology = createTopology(createLadder(length))
+    build_time = time.time() - t
+
+    source_stp = stp(networkName(0, 0))
+    dest_stp   = stp(networkName(1, length-1))
+
+    t = time.time()
+    path = topology.findPath(source_stp, dest_stp, 100)
+    bfs_time = time.time() - t
+
+    t = time.time()
+    k_paths = topology.findPaths(source_stp, dest_stp, 100, max_paths=K_PATHS)
+    k_time = time.time() - t
+
+    if length <= MAX_EXHAUSTIVE_LENGTH:
+        t = time.time()
+        paths = topology.findPaths(source_stp, dest_stp, 100)
+        exhaustive_time = time.time() - t
+        paths.sort(key=len)
+        assert len(path) == len(paths[0]), 'Shortest path length differs between searches'
+        assert [ len(p) for p in k_paths ] == [ len(p) for p in paths[:K_PATHS] ], 'K shortest paths differ from exhaustive search'
+        exhaustive = '%9.3f ms (%6i paths, %7ix)' % (exhaustive_time * 1000, len(paths), exhaustive_time / bfs_time)
+    else:
+        exhaustive = '      skipped'
+
+    print 'ladder %5i networks: build %6.3f s  shortest path %8.3f ms (%3i links)  %i paths %9.3f ms  all paths %s' % \
+          (2 * length, build_time, bfs_time * 1000, len(path), K_PATHS, k_time * 1000, exhaustive)
+
+
+
+def runMesh(size):
+
+    t = time.time()
+    topology = createTopology(createMesh(size))
+    build_time = time.time() - t
+
+    rng = random.Random(-size)
+    queries = [ (stp(networkName(0, rng.randint(0, size-1))), stp(networkName(0, rng.randint(0, size-1)))) for _ in range(MESH_QUERIES) ]
+    queries = [ (s, d) for s, d in queries if s.network != d.network ]
+
+    t = time.time()
+    path_lengths = [ len(topology.findPath(s, d, 100)) for s, d in queries ]
+    bfs_time = (time.time() - t) / len(queries)
+
+    t = time.time()
+    for s, d in queries:
+        topology.findPaths(s, d, 100, max_paths=K_PATHS)
+    k_time = (time.time() - t) / len(queries)
+
+    print 'mesh   %5i networks: build %6.3f s  shortest path %8.3f ms (%3.1f links)  %i paths %9.3f ms' % \
+          (size, build_time, bfs_time * 1000, float(sum(path_lengths)) / len(path_lengths), K_PATHS, k_time * 1000)
+
+
+
+if __name__ == '__main__':
+    for length in LADDER_LENGTHS:
+        runLadder(length)
+    for size in MESH_SIZES:
+        runMesh(size)
+
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for building SOAP payloads.
+
+Builds reserve and reserveConfirmed messages like the requester and provider
+clients do, and serializes them compact (wire format). The indented times
+add indenting the logged copy of the payload, as done with payload logging
+on (and the old wire format).
+Run from the top-level directory:
+
+    PYTHONPATH=. python benchmarks/bench_soap.py
+"""
+
+import time
+import datetime
+
+from dateutil.tz import tzutc
+
+from opennsa import nsa, logging, constants as cnt
+from opennsa.protocols.shared import minisoap
+from opennsa.protocols.nsi2 import helper
+from opennsa.protocols.nsi2.bindings import nsiconnection, p2pservices
+
+
+ITERATIONS = 5000
+
+REQUESTER_NSA = 'urn:ogf:network:aruba.net:nsa:requester'
+PROVIDER_NSA  = 'urn:ogf:network:aruba.net:nsa'
+
+SOURCE_STP = nsa.STP('aruba.net:topology', 'ps',  [ nsa.Label(cnt.ETHERNET_VLAN, '1781') ])
+DEST_STP   = nsa.STP('aruba.net:topology', 'bon', [ nsa.Label(cnt.ETHERNET_VLAN, '1782') ])
+
+
+
+def timeit(function, *args):
+    t = time.time()
+    for _ in xrange(ITERATIONS):
+        function(*args)
+    return (time.time() - t) / ITERATIONS * 10**6 # microseconds
+
+
+
+def createServiceType(sd):
+    src_stp = helper.createSTPType(sd.source_stp)
+    dst_stp = helper.createSTPType(sd.dest_stp)
+    src_stp.labels = []
+    dst_stp.labels = []
+    src_vlan = sd.source_stp.labels[0].labelValue()
+    dst_vlan = sd.dest_stp.labels[0].labelValue()
+    return p2pservices.EthernetVlanType(sd.capacity, sd.directionality, sd.symmetric, src_stp, dst_stp, None,
+                                        sd.mtu, sd.burst_size, src_vlan, dst_vlan)
+
+
+def reserve(criteria):
+    header_element = helper.createHeader(REQUESTER_NSA, PROVIDER_NSA, reply_to='https://aruba.net:9443/NSI/services/RequesterService2',
+                                         correlation_id='urn:uuid:4b2b8a3e-4bb4-4c1b-a6e4-6f6c6c7d9a01')
+    schedule = nsiconnection.ScheduleType(criteria.schedule.start_time.replace(tzinfo=tzutc()).isoformat(),
+                                          criteria.schedule.end_time.replace(tzinfo=tzutc()).isoformat())
+    rc = nsiconnection.ReservationRequestCriteriaType(criteria.revision, schedule, cnt.EVTS_AGOLE,
+                                                      { p2pservices.evts : createServiceType(criteria.service_def) } )
+    body_element = nsiconnection.ReserveType(None, None, 'Benchmark connection', rc).xml(nsiconnection.reserve)
+    return minisoap.createSoapPayload(body_element, header_element)
+
+
+def reserveConfirmed(criteria):
+    header_element = helper.createHeader(REQUESTER_NSA, PROVIDER_NSA, correlation_id='urn:uuid:4b2b8a3e-4bb4-4c1b-a6e4-6f6c6c7d9a01')
+    schedule = nsiconnection.ScheduleType(helper.createXMLTime(criteria.schedule.start_time), helper.createXMLTime(criteria.schedule.end_time))
+    rc = nsiconnection.ReservationConfirmCriteriaType(criteria.revision, schedule, str(p2pservices.evts),
+                                                      { p2pservices.evts : createServiceType(criteria.service_def) } )
+    body_element = nsiconnection.ReserveConfirmedType('ARU-7af3e1', 'urn:uuid:1f2a0e6c-5d39-4f0e-9a43-0f0c6b9c9a11',
+                                                      'Benchmark connection', rc).xml(nsiconnection.reserveConfirmed)
+    return minisoap.createSoapPayload(body_element, header_element)
+
+
+
+def run():
+
+    start_time = datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(hours=1)
+    schedule = nsa.Schedule(start_time, start_time + datetime.timedelta(hours=1))
+    criteria = nsa.Criteria(0, schedule, nsa.EthernetVLANService(SOURCE_STP, DEST_STP, 100, 1500, 0))
+
+    for name, build in [ ('reserve', reserve), ('reserveConfirmed', reserveConfirmed) ]:
+        compact  = build(criteria)
+        indented = logging.indentPayload(compact)
+        assert minisoap.parseSoapPayload(compact)[1][0].tag == minisoap.parseSoapPayload(indented)[1][0].tag
+
+        ct = timeit(build, criteria)
+        it = timeit(lambda criteria : logging.indentPayload(build(criteria)), criteria)
+        print '%-16s  compact %8.2f us %5i bytes   indented %8.2f us %5i bytes   (%4.2fx time, %4.2fx size)' % \
+              (name, ct, len(compact), it, len(indented), it / ct, float(len(indented)) / len(compact))
+
+
+
+if __name__ == '__main__':
+    run()
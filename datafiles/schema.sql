@@ -70,6 +70,7 @@ CREATE TABLE generic_backend_connections (
     provision_state         text                        NOT NULL,
     lifecycle_state         text                        NOT NULL,
     data_plane_active       boolean                     NOT NULL,
+    allocated               boolean                     NOT NULL, -- reservation has been committed
     source_network          text                        NOT NULL,
     source_port             text                        NOT NULL,
     source_labels           label[],
@@ -4,14 +4,16 @@ Connection abstraction.
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
+import math
 import string
 import random
 import datetime
+import collections
 
 from zope.interface import implements
 
 from twisted.python import log, failure
-from twisted.internet import defer
+from twisted.internet import reactor, defer
 
 from opennsa.interface import INSIProvider, INSIRequester
 from opennsa import error, nsa, state, database
@@ -20,6 +22,19 @@ from opennsa import error, nsa, state, database
 
 LOG_SYSTEM = 'Aggregator'
 
+PROBE_PATHS = 1 # number of candidate paths to probe and rank before reserving, 1 disables probing
+RESERVE_ATTEMPTS = 3 # number of paths to try per reserve request
+RESERVE_TIME_BUDGET = 60 # seconds, no new path is tried when a reserve request has been running for longer
+LATENCY_SAMPLES = 1000 # number of reserve latencies kept for statistics
+AVAILABILITY_HINT_TIMEOUT = 300 # seconds, for how long a reserve failure counts against a network
+ABANDONED_TIMEOUT = 300 # seconds, for how long to wait for terminateConfirmed for a sub connection dropped during path retry
+
+# likelihoods of a link reservation succeeding, the likelihood of a path is the product of its links
+AVAILABLE       = 1.0
+UNKNOWN         = 0.5
+RECENTLY_FAILED = 0.1
+UNAVAILABLE     = 0.0
+
 
 
 #def connPath(conn):
@@ -42,6 +57,12 @@ def shortLabel(labels):
     return ','.join(lbs)
 
 
+def _linkKey(link):
+    # hashable link identity, links with the same key are probed once
+    labelsKey = lambda labels : tuple( [ (label.type_, tuple(label.values)) for label in labels ] )
+    return (link.network, link.src_port, link.dst_port, labelsKey(link.src_labels or []), labelsKey(link.dst_labels or []))
+
+
 def _buildErrorMessage(results, action):
 
     # should probably seperate loggin somehow
@@ -86,6 +107,97 @@ def _createAggregateFailure(results, action):
 
 
 
+class AvailabilityHints:
+    """
+    Remembers recent reservation outcomes per network. Used as availability hint
+    for providers which cannot be probed directly (NSI has no availability
+    query, so this is all we know about remote networks).
+    """
+    def __init__(self, timeout=AVAILABILITY_HINT_TIMEOUT):
+        self.timeout = timeout
+        self.failures = {} # network -> time of last reservation failure
+        self.clock = reactor # this is needed in order to test expiry
+
+
+    def reserveFailed(self, network):
+        self.failures[network] = self.clock.seconds()
+
+
+    def reserveSucceeded(self, network):
+        self.failures.pop(network, None)
+
+
+    def likelihood(self, network):
+        try:
+            failure_time = self.failures[network]
+        except KeyError:
+            return UNKNOWN
+        if self.clock.seconds() - failure_time > self.timeout:
+            del self.failures[network]
+            return UNKNOWN
+        return RECENTLY_FAILED
+
+
+
+class ReserveStatistics:
+    """
+    Counters and latencies (seconds) for aggregated reserve requests. Only the
+    latest latencies are kept.
+    """
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.requests  = 0
+        self.succeeded = 0
+        self.failed    = 0
+        self.attempts  = 0 # paths tried, over all requests
+        self.latencies = collections.deque(maxlen=samples)
+
+
+    def record(self, attempts, latency, success):
+        self.requests += 1
+        self.attempts += attempts
+        if success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        self.latencies.append(latency)
+
+
+    def latencyPercentile(self, percentile):
+        # nearest rank, None if there are no samples
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        rank = int(math.ceil(percentile / 100.0 * len(latencies)))
+        return latencies[ min(max(rank, 1), len(latencies)) - 1 ]
+
+
+    def summary(self):
+        if self.latencies:
+            latency = 'latency p50 %.3f / p95 %.3f seconds' % (self.latencyPercentile(50), self.latencyPercentile(95))
+        else:
+            latency = 'no latencies'
+        paths = float(self.attempts) / self.requests if self.requests else 0
+        return '%i requests, %i succeeded, %i failed, %.2f paths per request, %s' % (self.requests, self.succeeded, self.failed, paths, latency)
+
+
+
+class PathSearch:
+    """
+    The candidate paths of a reservation, and how far trying them has come.
+    Kept until the reservation has been confirmed or has failed, so a
+    reserveFailed for a sub connection can move on to the next path.
+    """
+    def __init__(self, criteria, paths, start_time):
+        self.criteria     = criteria
+        self.paths        = paths # candidate paths which have not been tried
+        self.path         = None  # path being reserved
+        self.reserved     = {}    # link key -> (provider nsa, correlation id, sub connection id)
+        self.failed_links = {}    # link key -> error, for reserveFailed calls arriving while reserving a path
+        self.attempts     = 0
+        self.start_time   = start_time
+
+
+
 class Aggregator:
 
     implements(INSIProvider, INSIRequester)
@@ -103,6 +215,17 @@ class Aggregator:
         self.reservations       = {} # correlation_id -> info
         self.notification_id    = 0
 
+        self.probe_paths        = PROBE_PATHS
+        self.availability_hints = AvailabilityHints()
+
+        self.reserve_attempts    = RESERVE_ATTEMPTS
+        self.reserve_time_budget = RESERVE_TIME_BUDGET
+        self.reserve_statistics  = ReserveStatistics()
+        self.path_searches = {} # service connection id -> PathSearch, until the reservation is confirmed or has failed
+        self.path_lengths = {}  # service connection id -> number of links, set when the path is settled
+        self.abandoned = {}     # (provider nsa, connection id) -> delayed call for dropping the entry, for sub connections terminated during path retry
+        self.clock = reactor    # this is needed in order to test time budgets
+
 
     def getNotificationId(self):
         nid = self.notification_id
@@ -114,6 +237,66 @@ class Aggregator:
         return self.provider_registry.getProvider(nsi_agent_urn)
 
 
+    def _linkCriteria(self, link, criteria):
+        # this has to be done more generic sometime
+        sd = criteria.service_def
+        link_sd = nsa.EthernetVLANService(nsa.STP(link.network, link.src_port, labels=link.src_labels),
+                                          nsa.STP(link.network, link.dst_port, labels=link.dst_labels),
+                                          sd.capacity, sd.mtu, sd.burst_size, sd.directionality, sd.symmetric)
+        return nsa.Criteria(criteria.revision, criteria.schedule, link_sd)
+
+
+    def probeLink(self, link, criteria):
+        """
+        Get the likelihood of the link being reservable. Providers with a
+        checkAvailability method (local backends) are asked, for other providers
+        the availability hints are used. Returns a deferred.
+        """
+        try:
+            provider = self.getProvider(self.topology.getNSA(link.network).urn())
+        except (error.TopologyError, KeyError):
+            return defer.succeed(UNAVAILABLE)
+
+        if not hasattr(provider, 'checkAvailability'):
+            return defer.succeed( self.availability_hints.likelihood(link.network) )
+
+        def probeFailed(err):
+            log.msg('Error probing availability of %s: %s' % (link, err.getErrorMessage()), system=LOG_SYSTEM)
+            return self.availability_hints.likelihood(link.network)
+
+        d = defer.maybeDeferred(provider.checkAvailability, self._linkCriteria(link, criteria))
+        d.addCallbacks(lambda available : AVAILABLE if available else UNAVAILABLE, probeFailed)
+        return d
+
+
+    @defer.inlineCallbacks
+    def rankPaths(self, paths, criteria):
+        """
+        Probe the links of all paths concurrently and sort the paths by the
+        likelihood of being reservable. The sort is stable, so paths which are
+        equally likely keep their order (which is by cost from findPaths).
+        """
+        link_keys = {}
+        for path in paths:
+            for link in path:
+                link_keys.setdefault( _linkKey(link), link)
+
+        keys = link_keys.keys()
+        results = yield defer.DeferredList( [ self.probeLink(link_keys[k], criteria) for k in keys ] ) # probeLink doesn't errback
+        likelihoods = dict( [ (k, likelihood) for k, (_, likelihood) in zip(keys, results) ] )
+
+        def pathLikelihood(path):
+            pl = 1.0
+            for link in path:
+                pl *= likelihoods[ _linkKey(link) ]
+            return pl
+
+        ranked = sorted(paths, key=pathLikelihood, reverse=True)
+        for path in ranked:
+            log.msg('Path %s, likelihood %.3f' % (' -> '.join( [ str(l) for l in path ] ), pathLikelihood(path)), debug=True, system=LOG_SYSTEM)
+        defer.returnValue(ranked)
+
+
     def getConnection(self, requester_nsa, connection_id):
 
         # need to do authz here
@@ -220,7 +403,7 @@ class Aggregator:
             # log about creation and the connection type
             log.msg('Connection %s: Aggregate path creation: %s -> %s' % (conn.connection_id, str(source_stp), str(dest_stp)), system=LOG_SYSTEM)
             # making the connection is the same for all though :-)
-            paths = self.topology.findPaths(source_stp, dest_stp, conn.bandwidth)
+            paths = self.topology.findPaths(source_stp, dest_stp, conn.bandwidth, max_paths=max(self.probe_paths, self.reserve_attempts))
 
             # error out if we could not find a path
             if not paths:
@@ -228,97 +411,211 @@ class Aggregator:
                 log.msg(error_msg, system=LOG_SYSTEM)
                 raise error.TopologyError(error_msg)
 
-            paths.sort(key=lambda e : len(e))
+            if self.probe_paths > 1 and len(paths) > 1:
+                ranked_paths = yield self.rankPaths(paths[:self.probe_paths], criteria)
+                paths = ranked_paths + paths[self.probe_paths:]
+
+        search = PathSearch(criteria, paths, self.clock.seconds())
+        self.path_searches[conn.id] = search
+
+        results = yield self._searchPaths(conn, search)
+
+        if all( [ success for success, _ in results ] ):
+            log.msg('Connection %s: Reserve acked, %i path(s) tried' % (conn.connection_id, search.attempts), system=LOG_SYSTEM)
+            # reserveConfirmed calls may have arrived while trying paths
+            d = self._aggregateReserveHeld(conn)
+            d.addErrback(lambda f : log.msg('Error aggregating reservation for connection %s: %s' % (conn.connection_id, f.getErrorMessage()), system=LOG_SYSTEM))
+            defer.returnValue(connection_id)
+
+        else:
+            yield self._abandonSearch(conn, search)
+            err = _createAggregateException(results, 'reservations', error.ConnectionCreateError)
+            raise err
+
+
+    @defer.inlineCallbacks
+    def _searchPaths(self, conn, search):
+        """
+        Reserve the candidate paths of a search in turn, until all links of a
+        path have been acked, or there are no more paths, attempts, or time
+        to try. Returns the DeferredList results of the last path tried.
+        """
+        while True:
+            search.path = search.paths.pop(0) # shortest path, or most likely to succeed if probed
+            search.attempts += 1
+            results = yield self._reservePath(conn, search.criteria, search.path, search.reserved)
+
+            # links acked, but failed while waiting for the other links
+            results = [ (False, failure.Failure(search.failed_links[_linkKey(link)])) if _linkKey(link) in search.failed_links else result
+                        for link, result in zip(search.path, results) ]
+            search.failed_links = {}
+
+            if all( [ success for success, _ in results ] ):
+                self.path_lengths[conn.id] = len(search.path)
+                defer.returnValue(results)
+
+            failed_links = set( [ _linkKey(link) for link, (success, _) in zip(search.path, results) if not success ] )
+            if not self._nextPath(conn, search, failed_links):
+                defer.returnValue(results)
+
+            yield self._releaseSegments(search.reserved, search.paths[0])
+
+
+    def _nextPath(self, conn, search, failed_links):
+        # forget the failed links, and check if another path should be tried
+
+        for key in failed_links:
+            search.reserved.pop(key, None) # nothing to terminate, the reservation failed
+
+        # paths with a link which just failed are not worth trying
+        search.paths = [ path for path in search.paths if not failed_links.intersection( [ _linkKey(link) for link in path ] ) ]
+
+        elapsed = self.clock.seconds() - search.start_time
+        if not search.paths or search.attempts >= self.reserve_attempts or elapsed > self.reserve_time_budget:
+            return False
+
+        log.msg('Connection %s: Reservation failed on %i link(s), trying next path (attempt %i/%i)' % \
+                (conn.connection_id, len(failed_links), search.attempts + 1, self.reserve_attempts), system=LOG_SYSTEM)
+        return True
+
+
+    @defer.inlineCallbacks
+    def _abandonSearch(self, conn, search):
+        # terminate non-failed connections
+        # currently we don't try and be too clever about cleaning, just do it, and switch state
+        self._searchDone(conn, search, False)
+        yield state.terminating(conn)
+        yield self._releaseSegments(search.reserved, [])
+        yield state.terminated(conn)
+
+
+    def _searchDone(self, conn, search, success):
+        self.path_searches.pop(conn.id, None)
+        latency = self.clock.seconds() - search.start_time
+        self.reserve_statistics.record(search.attempts, latency, success)
+        log.msg('Connection %s: Reserve %s, %i path(s) tried in %.3f seconds' % \
+                (conn.connection_id, 'confirmed' if success else 'failed', search.attempts, latency), system=LOG_SYSTEM)
+        log.msg('Reserve statistics: %s' % self.reserve_statistics.summary(), system=LOG_SYSTEM)
+
 
-        selected_path = paths[0] # shortest path
-        log_path = ' -> '.join( [ str(p) for p in selected_path ] )
+    @defer.inlineCallbacks
+    def _reservePath(self, conn, criteria, path, reserved):
+        """
+        Reserve the links of a path, links which are already reserved (the
+        entries in reserved) are reused. Returns the DeferredList results.
+        """
+        log_path = ' -> '.join( [ str(p) for p in path ] )
         log.msg('Attempting to create path %s' % log_path, system=LOG_SYSTEM)
 
-        for link in selected_path:
+        for link in path:
             try:
                 self.topology.getNSA(link.network)
             except error.TopologyError:
                 raise error.ConnectionCreateError('No provider for network %s. Cannot create link' % link.network)
 
         conn_info = []
-        for idx, link in enumerate(selected_path):
+        for idx, link in enumerate(path):
+
+            if _linkKey(link) in reserved:
+                provider_nsa_urn, correlation_id, sc_id = reserved[_linkKey(link)]
+                log.msg('Connection %s: Keeping sub connection %s at %s' % (conn.connection_id, sc_id, provider_nsa_urn), system=LOG_SYSTEM)
+                yield self._reorderSegment(provider_nsa_urn, correlation_id, sc_id, idx)
+                conn_info.append( (defer.succeed(sc_id), provider_nsa_urn, correlation_id) )
+                continue
 
             provider_nsa = self.topology.getNSA(link.network)
             provider     = self.getProvider(provider_nsa.urn())
 
             header = nsa.NSIHeader(self.nsa_.urn(), provider_nsa.urn(), [])
 
-            # this has to be done more generic sometime
-            sd = nsa.EthernetVLANService(nsa.STP(link.network, link.src_port, labels=link.src_labels),
-                                         nsa.STP(link.network, link.dst_port, labels=link.dst_labels),
-                                         conn.bandwidth, sd.mtu, sd.burst_size, sd.directionality, sd.symmetric)
-
             # save info for db saving
             self.reservations[header.correlation_id] = {
                                                         'provider_nsa'  : provider_nsa.urn(),
                                                         'service_connection_id' : conn.id,
+                                                        'link_key'       : _linkKey(link),
                                                         'order_id'       : idx,
                                                         'source_network' : link.network,
                                                         'source_port'    : link.src_port,
                                                         'dest_network'   : link.network,
                                                         'dest_port'      : link.dst_port }
 
-            crt = nsa.Criteria(criteria.revision, criteria.schedule, sd)
+            crt = self._linkCriteria(link, criteria)
 
             d = provider.reserve(header, None, conn.global_reservation_id, conn.description, crt)
-            conn_info.append( (d, provider_nsa) )
+            conn_info.append( (d, provider_nsa.urn(), header.correlation_id) )
 
             # Don't bother trying to save connection here, wait for reserveConfirmed
 
-#            @defer.inlineCallbacks
-#            def reserveResponse(connection_id, link_provider_nsa, order_id):
-#                # need to collapse the label values when getting reserveConfirm
-#                log.msg('Connection reservation for %s via %s acked' % (connection_id, link_provider_nsa), debug=True, system=LOG_SYSTEM)
-#                # should probably do some sanity checks here
-#                sp = service_params
-#                local_link = True if link_provider_nsa == self.nsa_ else False
-#                sc = database.SubConnection(provider_nsa=link_provider_nsa.urn(),
-#                                            connection_id=connection_id, local_link=local_link, revision=0, service_connection_id=conn.id, order_id=order_id,
-#                                            global_reservation_id=global_reservation_id, description=description,
-#                                            reservation_state=state.RESERVE_START, provision_state=state.RELEASED, lifecycle_state=state.CREATED, data_plane_active=False,
-#                                            source_network=sp.source_stp.network, source_port=sp.source_stp.port, source_labels=sp.source_stp.labels,
-#                                            dest_network=sp.dest_stp.network, dest_port=sp.dest_stp.port, dest_labels=sp.dest_stp.labels,
-#                                            start_time=sp.start_time.isoformat(), end_time=sp.end_time.isoformat(), bandwidth=sp.bandwidth)
-#                yield sc.save()
-#                defer.returnValue(sc)
-#
-#            d.addCallback(reserveResponse, provider_nsa, idx)
-
         results = yield defer.DeferredList( [ c[0] for c in conn_info ], consumeErrors=True) # doesn't errback
-        successes = [ r[0] for r in results ]
 
-        if all(successes):
-            log.msg('Connection %s: Reserve acked' % conn.connection_id, system=LOG_SYSTEM)
-            defer.returnValue(connection_id)
+        for link, (success, sc_id), (_, provider_nsa_urn, correlation_id) in zip(path, results, conn_info):
+            if success:
+                self.availability_hints.reserveSucceeded(link.network)
+                reserved[_linkKey(link)] = (provider_nsa_urn, correlation_id, sc_id)
+            else:
+                self.availability_hints.reserveFailed(link.network)
+                self.reservations.pop(correlation_id, None) # there will be no reserveConfirmed
 
+        defer.returnValue(results)
+
+
+    @defer.inlineCallbacks
+    def _reorderSegment(self, provider_nsa_urn, correlation_id, sc_id, order_id):
+        # a kept sub connection can have a different position in the new path
+        if correlation_id in self.reservations:
+            self.reservations[correlation_id]['order_id'] = order_id
         else:
-            # terminate non-failed connections
-            # currently we don't try and be too clever about cleaning, just do it, and switch state
-            yield state.terminating(conn)
-            defs = []
-            reserved_connections = [ (sc_id, provider_nsa) for (success,sc_id),(_,provider_nsa) in zip(results, conn_info) if success ]
-            for (sc_id, provider_nsa) in reserved_connections:
-
-                provider = self.getProvider(provider_nsa.urn())
-                header = nsa.NSIHeader(self.nsa_.urn(), provider_nsa.urn(), [])
-
-                d = provider.terminate(header, sc_id)
-                d.addCallbacks(
-                    lambda c : log.msg('Succesfully terminated sub connection %s at %s after partial reservation failure.' % (sc_id, provider_nsa.urn()) , system=LOG_SYSTEM),
-                    lambda f : log.msg('Error terminating connection after partial-reservation failure: %s' % str(f), system=LOG_SYSTEM)
-                )
-                defs.append(d)
-            dl = defer.DeferredList(defs)
-            yield dl
-            yield state.terminated(conn)
+            sub_connection = yield self.getSubConnection(provider_nsa_urn, sc_id)
+            if sub_connection.order_id != order_id:
+                sub_connection.order_id = order_id
+                yield sub_connection.save()
 
-            err = _createAggregateException(results, 'reservations', error.ConnectionCreateError)
-            raise err
+
+    @defer.inlineCallbacks
+    def _releaseSegments(self, reserved, keep_path):
+        """
+        Terminate the reserved sub connections which are not part of keep_path,
+        and forget about them.
+        """
+        keep_keys = set( [ _linkKey(link) for link in keep_path ] )
+
+        defs = []
+        for key in [ k for k in reserved if k not in keep_keys ]:
+            provider_nsa_urn, correlation_id, sc_id = reserved.pop(key)
+            # if terminateConfirmed never arrives, the entry is dropped after a while
+            self.abandoned[(provider_nsa_urn, sc_id)] = self.clock.callLater(ABANDONED_TIMEOUT, self.abandoned.pop, (provider_nsa_urn, sc_id), None)
+
+            if self.reservations.pop(correlation_id, None) is None:
+                # reserveConfirmed has been received, so the sub connection is in the database
+                sub_conns = yield database.SubConnection.findBy(provider_nsa=provider_nsa_urn, connection_id=sc_id)
+                for sc in sub_conns:
+                    yield sc.delete()
+
+            provider = self.getProvider(provider_nsa_urn)
+            header = nsa.NSIHeader(self.nsa_.urn(), provider_nsa_urn, [])
+
+            def terminateFailed(f, sc_id=sc_id, urn=provider_nsa_urn):
+                log.msg('Error terminating connection after partial-reservation failure: %s' % str(f), system=LOG_SYSTEM)
+                self._dropAbandoned(urn, sc_id) # no terminateConfirmed will come
+
+            d = provider.terminate(header, sc_id)
+            d.addCallbacks(
+                lambda c, sc_id=sc_id, urn=provider_nsa_urn : log.msg('Succesfully terminated sub connection %s at %s after partial reservation failure.' % (sc_id, urn) , system=LOG_SYSTEM),
+                terminateFailed
+            )
+            defs.append(d)
+
+        yield defer.DeferredList(defs)
+
+
+    def _dropAbandoned(self, provider_nsa_urn, connection_id):
+        # returns True if the sub connection was dropped during path retry
+        call = self.abandoned.pop( (provider_nsa_urn, connection_id), None)
+        if call is None:
+            return False
+        if call.active():
+            call.cancel()
+        return True
 
 
     @defer.inlineCallbacks
@@ -479,6 +776,10 @@ class Aggregator:
         if conn.lifecycle_state == state.TERMINATED:
             defer.returnValue(connection_id) # all good
 
+        # stop trying paths, if the reservation has not been confirmed yet
+        self.path_searches.pop(conn.id, None)
+        self.path_lengths.pop(conn.id, None)
+
         yield state.terminating(conn)
 
         defs = []
@@ -606,25 +907,97 @@ class Aggregator:
 
         yield sc.save()
 
+        if (org_provider_nsa, connection_id) in self.abandoned:
+            # sub connection was dropped for another path, while we were saving it
+            yield sc.delete()
+            return
+
         # figure out if we can aggregate upwards
 
         conn = yield sc.ServiceConnection.get()
-        sub_conns = yield conn.SubConnections.get()
+        yield self._aggregateReserveHeld(conn)
 
-        if sc.order_id == 0:
-            conn.source_labels = sd.source_stp.labels
-        if sc.order_id == len(sub_conns)-1:
-            conn.dest_labels = sd.dest_stp.labels
 
-        yield conn.save()
+    @defer.inlineCallbacks
+    def reserveFailed(self, header, connection_id, connection_states, err):
+
+        log.msg('', system=LOG_SYSTEM)
+        log.msg('reserveFailed. NSA: %s. Connection ID: %s. Error: %s' % (header.provider_nsa, connection_id, err), system=LOG_SYSTEM)
+
+        if (header.provider_nsa, connection_id) in self.abandoned:
+            log.msg('Sub connection %s at %s was dropped during reservation, ignoring reserveFailed' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+            return
 
-        outstanding_calls = [ v for v in self.reservations.values() if v.get('service_connection_id') == resv_info['service_connection_id'] ]
+        if not header.correlation_id in self.reservations:
+            msg = 'Unrecognized correlation id %s in reserveFailed. Connection ID %s. NSA %s' % (header.correlation_id, connection_id, header.provider_nsa)
+            log.msg(msg, system=LOG_SYSTEM)
+            raise error.ConnectionNonExistentError(msg)
+
+        org_provider_nsa = self.reservations[header.correlation_id]['provider_nsa']
+        if header.provider_nsa != org_provider_nsa:
+            log.msg('Provider NSA in header %s for reserveFailed does not match saved identity %s' % (header.provider_nsa, org_provider_nsa), system=LOG_SYSTEM)
+            raise error.SecurityError('Provider NSA for connection does not match saved identity')
+
+        resv_info = self.reservations.pop(header.correlation_id)
+        self.availability_hints.reserveFailed(resv_info['source_network'])
+
+        search = self.path_searches.get(resv_info['service_connection_id'])
+        if search is None:
+            log.msg('No path search for failed sub connection %s at %s' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+            return
+
+        if not resv_info['service_connection_id'] in self.path_lengths:
+            # the path is still being reserved, the failure is picked up when all links have been acked
+            search.failed_links[resv_info['link_key']] = err
+            return
+
+        conn = yield database.ServiceConnection.find(resv_info['service_connection_id'])
+        del self.path_lengths[conn.id]
+
+        if self._nextPath(conn, search, set( [ resv_info['link_key'] ] )):
+            yield self._releaseSegments(search.reserved, search.paths[0])
+            results = yield self._searchPaths(conn, search)
+        else:
+            results = [ (False, failure.Failure(err)) ]
+
+        if all( [ success for success, _ in results ] ):
+            log.msg('Connection %s: Reserve acked, %i path(s) tried' % (conn.connection_id, search.attempts), system=LOG_SYSTEM)
+            yield self._aggregateReserveHeld(conn)
+        else:
+            yield self._abandonSearch(conn, search)
+            aggr_err = _createAggregateException(results, 'reservations', error.ConnectionCreateError)
+            if not isinstance(aggr_err, failure.Failure):
+                aggr_err = failure.Failure(aggr_err)
+            header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn(), None)
+            connection_states = (state.RESERVE_FAILED, conn.provision_state, conn.lifecycle_state, (False, 0, False))
+            self.parent_requester.reserveFailed(header, conn.connection_id, connection_states, aggr_err)
+
+
+    @defer.inlineCallbacks
+    def _aggregateReserveHeld(self, conn):
+
+        if not conn.id in self.path_lengths:
+            log.msg('Connection %s: Path not settled, cannot aggregate yet' % conn.connection_id, system=LOG_SYSTEM)
+            return
+
+        outstanding_calls = [ v for v in self.reservations.values() if v.get('service_connection_id') == conn.id ]
         if len(outstanding_calls) > 0:
             log.msg('Connection %s: Still missing %i reserveConfirmed call(s) to aggregate' % (conn.connection_id, len(outstanding_calls)), system=LOG_SYSTEM)
             return
 
-        if all( [ sc.reservation_state == state.RESERVE_HELD for sc in sub_conns ] ):
+        sub_conns = yield conn.SubConnections.get()
+
+        # check again, another call could have aggregated while we got the sub connections
+        if conn.id in self.path_lengths and len(sub_conns) == self.path_lengths[conn.id] and \
+           all( [ sc.reservation_state == state.RESERVE_HELD for sc in sub_conns ] ):
             log.msg('Connection %s: All sub connections reserve held, can emit reserveConfirmed' % (conn.connection_id), system=LOG_SYSTEM)
+            del self.path_lengths[conn.id]
+            search = self.path_searches.get(conn.id)
+            if search is not None:
+                self._searchDone(conn, search, True)
+            sub_conns.sort(key=lambda sc : sc.order_id)
+            conn.source_labels = sub_conns[0].source_labels
+            conn.dest_labels   = sub_conns[-1].dest_labels
             yield state.reserveHeld(conn)
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn(), None)
             source_stp = nsa.STP(conn.source_network, conn.source_port, conn.source_labels)
@@ -717,6 +1090,10 @@ class Aggregator:
     @defer.inlineCallbacks
     def terminateConfirmed(self, header, connection_id):
 
+        if self._dropAbandoned(header.provider_nsa, connection_id):
+            log.msg('Terminate confirmed for sub connection %s at %s, which was dropped during reservation' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+            return
+
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         sub_connection.reservation_state = state.TERMINATED
         yield sub_connection.save()
@@ -762,6 +1139,10 @@ class Aggregator:
     @defer.inlineCallbacks
     def reserveTimeout(self, header, connection_id, notification_id, timestamp, timeout_value, org_connection_id, org_nsa):
 
+        if self._dropAbandoned(header.provider_nsa, connection_id):
+            log.msg('Reserve timeout for sub connection %s at %s, which was dropped during reservation' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+            return
+
         sub_conn = yield self.findSubConnection(header.provider_nsa, connection_id)
         conn = yield sub_conn.ServiceConnection.get()
         sub_conns = yield conn.SubConnections.get()
@@ -3,22 +3,232 @@ Backend reservation calendar.
 
 Inteded usage is for NRM backend which does not have their own reservation calendar.
 
-Right now it is very minimal, but should be enough for basic service.
+Reservations are kept in an interval tree per resource, so checking for
+overlap is O(log N + k) and adding/removing reservations is O(log N), where N
+is the number of reservations for the resource. Finding free label values
+only looks up the resources of the ports and label values asked for.
+
+Bandwidth is tracked separately in a capacity calendar, which keeps a step
+function of committed bandwidth per port.
 
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011)
 """
 
+import random
 import datetime
 
 from opennsa import error
 
 
 
+class _IntervalNode(object):
+
+    __slots__ = ('start', 'end', 'values', 'priority', 'max_end', 'left', 'right')
+
+    def __init__(self, start, end, value):
+        self.start    = start
+        self.end      = end
+        self.values   = [ value ]
+        self.priority = random.random()
+        self.max_end  = end
+        self.left     = None
+        self.right    = None
+
+
+    def update(self):
+        max_end = self.end
+        if self.left is not None and self.left.max_end > max_end:
+            max_end = self.left.max_end
+        if self.right is not None and self.right.max_end > max_end:
+            max_end = self.right.max_end
+        self.max_end = max_end
+
+
+
+def _rotateRight(node):
+    left = node.left
+    node.left = left.right
+    left.right = node
+    node.update()
+    left.update()
+    return left
+
+
+def _rotateLeft(node):
+    right = node.right
+    node.right = right.left
+    right.left = node
+    node.update()
+    right.update()
+    return right
+
+
+
+class IntervalTree(object):
+    """
+    Augmented interval tree, balanced as a treap on (start, end).
+
+    Each node keeps the largest end point in its subtree, which allows pruning
+    subtrees that cannot overlap a query. Intervals are closed, i.e., two
+    intervals sharing an end point overlap. Each interval can carry a value,
+    and the same interval can be inserted (and must be removed) several times.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    @classmethod
+    def build(cls, intervals):
+        """
+        Build a tree from an iterable of (start, end, value) tuples in
+        O(N) time after sorting, instead of inserting one at a time.
+        """
+        tree = cls()
+        nodes = []
+        for start, end, value in sorted(intervals):
+            if nodes and nodes[-1].start == start and nodes[-1].end == end:
+                nodes[-1].values.append(value)
+            else:
+                nodes.append( _IntervalNode(start, end, value) )
+            tree.size += 1
+
+        # nodes are sorted, so the treap is a cartesian tree on priority, which can be built with a stack
+        stack = []
+        for node in nodes:
+            last = None
+            while stack and stack[-1].priority < node.priority:
+                last = stack.pop()
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+
+        if stack:
+            tree.root = stack[0]
+            # children must be updated before their parents, reverse pre-order does that
+            pre_order = []
+            pending = [ tree.root ]
+            while pending:
+                node = pending.pop()
+                pre_order.append(node)
+                pending += [ child for child in (node.left, node.right) if child is not None ]
+            for node in reversed(pre_order):
+                node.update()
+
+        return tree
+
+
+    def insert(self, start, end, value=None):
+        self.root = self._insert(self.root, start, end, value)
+        self.size += 1
+
+
+    def _insert(self, node, start, end, value):
+        if node is None:
+            return _IntervalNode(start, end, value)
+
+        if start == node.start and end == node.end:
+            node.values.append(value)
+            return node
+
+        if start < node.start or (start == node.start and end < node.end):
+            node.left = self._insert(node.left, start, end, value)
+            if node.left.priority > node.priority:
+                return _rotateRight(node)
+        else:
+            node.right = self._insert(node.right, start, end, value)
+            if node.right.priority > node.priority:
+                return _rotateLeft(node)
+
+        node.update()
+        return node
+
+
+    def remove(self, start, end, value=None):
+        # raises KeyError if the interval (with the value) is not in the tree
+        self.root = self._remove(self.root, start, end, value)
+        self.size -= 1
+
+
+    def _remove(self, node, start, end, value):
+        if node is None:
+            raise KeyError( (start, end, value) )
+
+        if start < node.start or (start == node.start and end < node.end):
+            node.left = self._remove(node.left, start, end, value)
+        elif start > node.start or end > node.end:
+            node.right = self._remove(node.right, start, end, value)
+        elif len(node.values) > 1 or value != node.values[0]:
+            try:
+                node.values.remove(value)
+            except ValueError:
+                raise KeyError( (start, end, value) )
+        elif node.left is None:
+            return node.right
+        elif node.right is None:
+            return node.left
+        elif node.left.priority > node.right.priority:
+            node = _rotateRight(node)
+            node.right = self._remove(node.right, start, end, value)
+        else:
+            node = _rotateLeft(node)
+            node.left = self._remove(node.left, start, end, value)
+
+        node.update()
+        return node
+
+
+    def overlaps(self, start, end):
+        """
+        Generate all intervals in the tree which overlaps with [start, end],
+        as (start, end, value) tuples.
+        """
+        stack = [ self.root ]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_end < start:
+                continue # nothing in this subtree ends after the query starts
+            stack.append(node.left)
+            if node.start <= end:
+                if node.end >= start:
+                    for value in node.values:
+                        yield (node.start, node.end, value)
+                stack.append(node.right)
+
+
+    def hasOverlap(self, start, end):
+        for _ in self.overlaps(start, end):
+            return True
+        return False
+
+
+    def __iter__(self):
+        # in-order traversal, i.e., sorted by (start, end)
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                for value in node.values:
+                    yield (node.start, node.end, value)
+                node = node.right
+
+
+
 class ReservationCalendar:
 
     def __init__(self):
-        self.reservations = [] # [ ( resource, start_time, end_time ) ]
+        self.reservations = {} # resource -> IntervalTree of ( start_time, end_time )
 
 
     def _checkArgs(self, resource, start_time, end_time):
@@ -32,23 +242,53 @@ class ReservationCalendar:
     def addReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
-        self.reservations.append(reservation)
+        try:
+            resource_reservations = self.reservations[resource]
+        except KeyError:
+            resource_reservations = IntervalTree()
+            self.reservations[resource] = resource_reservations
+
+        resource_reservations.insert(start_time, end_time)
 
 
     def removeReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
         try:
-            self.reservations.remove(reservation)
-        except ValueError:
+            resource_reservations = self.reservations[resource]
+            resource_reservations.remove(start_time, end_time)
+        except KeyError:
             raise ValueError('Reservation (%s, %s, %s) does not exist. Cannot remove' % (resource, start_time, end_time))
 
+        if len(resource_reservations) == 0:
+            self.reservations.pop(resource)
 
-    def checkReservation(self, resource, start_time, end_time):
-        self._checkArgs(resource, start_time, end_time)
 
+    def loadReservations(self, reservations):
+        """
+        Add many reservations at once, each a (resource, start_time, end_time)
+        tuple. Intended for building the calendar on startup. If the calendar is
+        empty the index is built directly, otherwise reservations are added one
+        by one.
+        """
+        reservations = list(reservations)
+        for resource, start_time, end_time in reservations:
+            self._checkArgs(resource, start_time, end_time)
+
+        if self.reservations:
+            for resource, start_time, end_time in reservations:
+                self.addReservation(resource, start_time, end_time)
+            return
+
+        resource_intervals = {}
+        for resource, start_time, end_time in reservations:
+            resource_intervals.setdefault(resource, []).append( (start_time, end_time, None) )
+
+        for resource, intervals in resource_intervals.items():
+            self.reservations[resource] = IntervalTree.build(intervals)
+
+
+    def _checkSchedule(self, start_time, end_time):
         # sanity checks
         if start_time > end_time:
             raise error.PayloadError('Invalid request: Reverse duration (end time before start time)')
@@ -62,24 +302,297 @@ class ReservationCalendar:
         if start_time > datetime.datetime(2025, 1, 1):
             raise error.PayloadError('Invalid request: Start time after year 2025')
 
-        for (c_resource, c_start_time, c_end_time) in self.reservations:
-            if resource == c_resource:
-                if self._resourceOverlap(c_start_time, c_end_time, start_time, end_time):
-                    raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
+
+    def checkReservation(self, resource, start_time, end_time):
+        self._checkArgs(resource, start_time, end_time)
+        self._checkSchedule(start_time, end_time)
+
+        if not self.isAvailable(resource, start_time, end_time):
+            raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
 
         # all good
 
-    # resourceort temporal availability
-    def _resourceOverlap(self, res1_start_time, res1_end_time, res2_start_time, res2_end_time):
 
-        assert res1_start_time < res1_end_time, 'Refusing to detect overlap for backwards reservation (1)'
-        assert res2_start_time < res2_end_time, 'Refusing to detect overlap for backwards reservation (2)'
+    def isAvailable(self, resource, start_time, end_time):
+        # resource temporal availability, no sanity checks
+        try:
+            resource_reservations = self.reservations[resource]
+        except KeyError:
+            return True # no reservations for resource
+
+        assert start_time < end_time, 'Refusing to detect overlap for backwards reservation'
+        return not resource_reservations.hasOverlap(start_time, end_time)
+
+
+    def availableLabelValues(self, ports, label, start_time, end_time, getResource):
+        """
+        Generate the values of label, in ascending order, which are available on
+        all of the ports in the time span. The getResource function maps (port,
+        label type, label value) to a calendar resource, i.e., it is the
+        getResource method of the connection manager.
+        """
+        # label availability, no sanity checks
+        assert type(ports) in (list, tuple), 'Ports must be a list or tuple'
+
+        # only the resources for the ports and values are looked up, each in its own tree
+        # several values (or ports) can map to the same resource, e.g., the entire port, so lookups are remembered
+        available = {} # resource -> bool
+
+        def isFree(resource):
+            try:
+                return available[resource]
+            except KeyError:
+                resource_reservations = self.reservations.get(resource)
+                free = resource_reservations is None or not resource_reservations.hasOverlap(start_time, end_time)
+                available[resource] = free
+                return free
+
+        for value in label:
+            for port in ports:
+                if not isFree(getResource(port, label.type_, value)):
+                    break
+            else:
+                yield value
+
+
+    def findLabelValue(self, ports, label, start_time, end_time, getResource):
+        """
+        First fit: Return the lowest value of label available on all ports in
+        the time span, or None if there is no such value.
+        """
+        self._checkSchedule(start_time, end_time)
+
+        for value in self.availableLabelValues(ports, label, start_time, end_time, getResource):
+            return value
+        return None
+
+
+
+class _StepNode(object):
+
+    __slots__ = ('key', 'delta', 'priority', 'total', 'max_prefix', 'left', 'right')
+
+    def __init__(self, key, delta):
+        self.key        = key
+        self.delta      = delta
+        self.priority   = random.random()
+        self.total      = delta
+        self.max_prefix = delta
+        self.left       = None
+        self.right      = None
+
+
+    def update(self):
+        # sum and maximum prefix sum of the deltas in the subtree, in key order
+        total, max_prefix = _combineSteps(_stepAggregate(self.left), (self.delta, self.delta))
+        self.total, self.max_prefix = _combineSteps( (total, max_prefix), _stepAggregate(self.right))
+
+
+
+def _stepAggregate(node):
+    if node is None:
+        return (0, None)
+    return (node.total, node.max_prefix)
+
+
+def _combineSteps(first, second):
+    # combine (total, max_prefix) of two consecutive key ranges, max_prefix is None for an empty range
+    total_1, max_prefix_1 = first
+    total_2, max_prefix_2 = second
+    if max_prefix_2 is None:
+        return (total_1 + total_2, max_prefix_1)
+    if max_prefix_1 is None:
+        return (total_1 + total_2, total_1 + max_prefix_2)
+    return (total_1 + total_2, max(max_prefix_1, total_1 + max_prefix_2))
+
+
+
+class CapacityTimeline(object):
+    """
+    Step function of committed capacity over time.
+
+    Each reservation adds a step up at its start time and a step down just
+    after its end time (intervals are closed, like in IntervalTree). The steps
+    are kept in a treap, augmented with the sum and maximum prefix sum of each
+    subtree, so the peak committed capacity in a time span is found in
+    O(log N) time.
+    """
+    START = 0
+    END   = 1 # ends sort after starts at the same time, as the end time is inclusive
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+        self.reservations = {} # ( start_time, end_time, capacity ) -> count
+
+
+    def __len__(self):
+        return self.size
+
+
+    def add(self, start_time, end_time, capacity):
+        self._addStep( (start_time, self.START),  capacity)
+        self._addStep( (end_time,   self.END),   -capacity)
+        key = (start_time, end_time, capacity)
+        self.reservations[key] = self.reservations.get(key, 0) + 1
+        self.size += 1
+
+
+    def remove(self, start_time, end_time, capacity):
+        # raises KeyError if there is no such reservation
+        key = (start_time, end_time, capacity)
+        count = self.reservations[key]
+        if count == 1:
+            self.reservations.pop(key)
+        else:
+            self.reservations[key] = count - 1
+        self.size -= 1
+        self._addStep( (start_time, self.START), -capacity)
+        self._addStep( (end_time,   self.END),    capacity)
+
+
+    def _addStep(self, key, delta):
+        self.root = self._insert(self.root, key, delta)
+
+
+    def _insert(self, node, key, delta):
+        if node is None:
+            return _StepNode(key, delta)
+
+        if key == node.key:
+            node.delta += delta
+            if node.delta == 0:
+                return self._removeNode(node)
+        elif key < node.key:
+            node.left = self._insert(node.left, key, delta)
+            if node.left is not None and node.left.priority > node.priority:
+                return _rotateRight(node)
+        else:
+            node.right = self._insert(node.right, key, delta)
+            if node.right is not None and node.right.priority > node.priority:
+                return _rotateLeft(node)
+
+        node.update()
+        return node
+
+
+    def _removeNode(self, node):
+        # step has no effect anymore, rotate it down and remove it
+        if node.left is None:
+            return node.right
+        elif node.right is None:
+            return node.left
+        elif node.left.priority > node.right.priority:
+            node = _rotateRight(node)
+            node.right = self._removeNode(node.right)
+        else:
+            node = _rotateLeft(node)
+            node.left = self._removeNode(node.left)
+        node.update()
+        return node
+
+
+    def _prefixSum(self, key):
+        # sum of all steps with key less than or equal to key
+        total = 0
+        node = self.root
+        while node is not None:
+            if node.key <= key:
+                total += node.delta + (node.left.total if node.left is not None else 0)
+                node = node.right
+            else:
+                node = node.left
+        return total
+
+
+    def _rangeAggregate(self, node, low, high):
+        # (total, max_prefix) for steps with key in [low, high]
+        while node is not None:
+            if node.key < low:
+                node = node.right
+            elif node.key > high:
+                node = node.left
+            else:
+                left  = self._fromAggregate(node.left, low)
+                right = self._toAggregate(node.right, high)
+                return _combineSteps(_combineSteps(left, (node.delta, node.delta)), right)
+        return (0, None)
+
+
+    def _fromAggregate(self, node, low):
+        # (total, max_prefix) for steps with key greater than or equal to low
+        if node is None:
+            return (0, None)
+        if node.key < low:
+            return self._fromAggregate(node.right, low)
+        head = _combineSteps(self._fromAggregate(node.left, low), (node.delta, node.delta))
+        return _combineSteps(head, _stepAggregate(node.right))
+
+
+    def _toAggregate(self, node, high):
+        # (total, max_prefix) for steps with key less than or equal to high
+        if node is None:
+            return (0, None)
+        if node.key > high:
+            return self._toAggregate(node.left, high)
+        head = _combineSteps(_stepAggregate(node.left), (node.delta, node.delta))
+        return _combineSteps(head, self._toAggregate(node.right, high))
+
+
+    def peak(self, start_time, end_time):
+        """
+        Maximum committed capacity at any point in [start_time, end_time].
+        """
+        committed = self._prefixSum( (start_time, self.START) ) # committed at start time
+        _, max_prefix = self._rangeAggregate(self.root, (start_time, self.END), (end_time, self.START))
+        if max_prefix is not None and max_prefix > 0:
+            committed += max_prefix
+        return committed
+
+
+
+class CapacityCalendar:
+    """
+    Bandwidth calendar, keyed by port.
+
+    Unlike ReservationCalendar the resources are not exclusive, a port can
+    carry several reservations at the same time as long as the committed
+    bandwidth does not exceed the port capacity.
+    """
+
+    def __init__(self):
+        self.ports = {} # port -> CapacityTimeline
+
+
+    def addReservation(self, port, bandwidth, start_time, end_time):
+        try:
+            timeline = self.ports[port]
+        except KeyError:
+            timeline = CapacityTimeline()
+            self.ports[port] = timeline
+
+        timeline.add(start_time, end_time, bandwidth)
+
+
+    def removeReservation(self, port, bandwidth, start_time, end_time):
+        try:
+            timeline = self.ports[port]
+            timeline.remove(start_time, end_time, bandwidth)
+        except KeyError:
+            raise ValueError('Bandwidth reservation (%s, %s, %s, %s) does not exist. Cannot remove' % (port, bandwidth, start_time, end_time))
+
+        if len(timeline) == 0:
+            self.ports.pop(port)
+
+
+    def committedBandwidth(self, port, start_time, end_time):
+        # peak committed bandwidth on the port in the time span
+        try:
+            return self.ports[port].peak(start_time, end_time)
+        except KeyError:
+            return 0
 
-        if res2_end_time < res1_start_time:
-            return False # res2 ends before res1 starts so it is ok
-        if res2_start_time > res1_end_time:
-            return False # res2 starts after res1 ends so it is ok
 
-        # resources overlap in time
-        return True
+    def canProvideBandwidth(self, port, capacity, bandwidth, start_time, end_time):
+        return self.committedBandwidth(port, start_time, end_time) + bandwidth <= capacity
 
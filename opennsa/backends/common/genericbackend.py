@@ -27,6 +27,7 @@ from opennsa import error, state, nsa
 from opennsa.backends.common import scheduler, calendar
 
 from twistar.dbobject import DBObject
+from twistar.registry import Registry
 
 
 
@@ -41,6 +42,12 @@ class GenericBackend(service.Service):
 
     TPC_TIMEOUT = 40 # seconds
 
+    # reservation states in which a connection holds calendar entries, besides committed connections
+    RESERVING_STATES = (state.RESERVE_CHECKING, state.RESERVE_HELD, state.RESERVE_COMMITTING)
+
+    RESTORE_BATCH_SIZE  = 1000 # connections fetched per query when building the schedule
+    RESTORE_CONCURRENCY = 10   # concurrent device operations for overdue connections when building the schedule
+
     def __init__(self, network, network_topology, connection_manager, parent_requester, log_system):
 
         assert network == network_topology.id_, 'Network name and network topology name does not match %s != %s' % (network, network_topology.id_)
@@ -55,10 +62,11 @@ class GenericBackend(service.Service):
 
         self.scheduler = scheduler.CallScheduler()
         self.calendar  = calendar.ReservationCalendar()
-        # need to build the calendar as well
+        self.capacity_calendar = calendar.CapacityCalendar()
 
-        # need to build schedule here
+        # calendar and schedule are built from the database when the reactor starts, requests wait for it
         self.restore_defer = defer.Deferred()
+        self.restore_failure = None
         reactor.callWhenRunning(self.buildSchedule)
 
 
@@ -68,7 +76,20 @@ class GenericBackend(service.Service):
 
     def stopService(self):
         service.Service.stopService(self)
-        return self.restore_defer.addCallback( lambda _ : self.scheduler.cancelAllCalls() )
+        return self.restore_defer.addBoth( lambda _ : self.scheduler.cancelAllCalls() )
+
+
+    def waitForRestore(self):
+        # fires when the calendars and schedule have been restored, i.e., when it is safe to reserve resources
+        # if the restore failed, it errbacks with the failure, as the calendars cannot be trusted
+        d = defer.Deferred()
+        def restored(_):
+            if self.restore_failure is None:
+                d.callback(None)
+            else:
+                d.errback(self.restore_failure)
+        self.restore_defer.addBoth(restored)
+        return d
 
 
     def getNotificationId(self):
@@ -78,57 +99,160 @@ class GenericBackend(service.Service):
 
 
     @defer.inlineCallbacks
-    def buildSchedule(self):
+    def buildCalendar(self):
 
-        conns = yield GenericBackendConnections.find(where=['lifecycle_state <> ?', state.TERMINATED])
-        for conn in conns:
-            # avoid race with newly created connections
-            if self.scheduler.hasScheduledCall(conn.connection_id):
+        # Single query for the resource columns of all committed connections which have not ended. No ORM objects are
+        # created, and the rows are loaded directly into the calendar index. Held, aborted, and timed out reservations
+        # are left out, reservations which were being made when we went down are handled when restoring the schedule.
+        # Connections past their end time are loaded as well, as their end is run, and the resources released, when
+        # the schedule is restored.
+
+        rows = yield Registry.getConfig().select(GenericBackendConnections.tablename(),
+                                                 where=['lifecycle_state = ? AND reservation_state = ? AND allocated',
+                                                        state.CREATED, state.RESERVE_START],
+                                                 select='source_port, source_labels, dest_port, dest_labels, start_time, end_time, bandwidth')
+
+        reservations = []
+        for row in rows:
+            try:
+                resources, capacity_ports = self._calendarEntries(row['source_port'], row['source_labels'], row['dest_port'], row['dest_labels'])
+            except (error.TopologyError, KeyError, IndexError, TypeError) as e:
+                # port no longer in the topology or port map, or labels missing
+                log.msg('Error adding reservation %s -> %s to calendar: %s' % (row['source_port'], row['dest_port'], e), system=self.log_system)
                 continue
+            reservations += [ (resource, row['start_time'], row['end_time']) for resource in resources ]
+            for port in capacity_ports:
+                self.capacity_calendar.addReservation(port.id_, row['bandwidth'], row['start_time'], row['end_time'])
 
-            now = datetime.datetime.utcnow()
+        self.calendar.loadReservations(reservations)
+        log.msg('Calendar built with %i reservations' % len(rows), system=self.log_system)
 
-            if conn.lifecycle_state in (state.PASSED_ENDTIME, state.TERMINATED):
-                pass # This connection has already lived it life to the fullest :-)
 
-            elif conn.end_time < now and conn.lifecycle_state not in (state.PASSED_ENDTIME, state.TERMINATED):
-                log.msg('Connection %s: Immediate end during buildSchedule' % conn.connection_id, system=self.log_system)
-                yield self._doEndtime(conn)
+    def buildSchedule(self):
 
-            elif conn.start_time > now:
-                # start time has not yet passed, we most schedule activate or schedule terminate depending on state
-                if conn.provision_state == state.PROVISIONED and conn.data_plane_active == False:
-                    self.scheduler.scheduleCall(conn.connection_id, conn.start_time, self._doActivate, conn)
-                    td = conn.start_time - now
-                    log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                elif conn.provision_state == state.RELEASED:
-                    self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
-                    td = conn.end_time - now
-                    log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                else:
-                    log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
-
-            elif conn.start_time < now:
-                # we have passed start time, we must either: activate, schedule deactive, or schedule terminate
-                if conn.provision_state == state.PROVISIONED:
-                    if conn.data_plane_active:
-                        self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
-                        td = conn.end_time - now
-                        log.msg('Connection %s: already active, scheduling end for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                    else:
-                        log.msg('Connection %s: Immediate activate during buildSchedule' % conn.connection_id, system=self.log_system)
-                        yield self._doActivate(conn)
-                elif conn.provision_state == state.RELEASED:
+        def restoreFailed(err):
+            log.msg('Error restoring calendar and schedule, requests will fail: %s' % err.getErrorMessage(), system=self.log_system)
+            log.err(err, system=self.log_system)
+            self.restore_failure = err
+            self.restore_defer.errback(err)
+
+        d = self._buildSchedule()
+        d.addErrback(restoreFailed)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _buildSchedule(self):
+
+        yield self.buildCalendar()
+
+        # Connections are paged through by id, so we never hold the entire table in memory. Transitions in the
+        # future are scheduled right away, while overdue activations and end times are queued for the devices
+        # and run with bounded concurrency. The restore defer fires when the schedule has been built, i.e.,
+        # it does not wait for the device operations to finish.
+
+        semaphore = defer.DeferredSemaphore(self.RESTORE_CONCURRENCY)
+        device_operations = []
+        n_connections = 0
+        last_id = 0
+
+        while True:
+            conns = yield GenericBackendConnections.find(where=['lifecycle_state <> ? AND id > ?', state.TERMINATED, last_id],
+                                                         orderby='id', limit=self.RESTORE_BATCH_SIZE)
+            if not conns:
+                break
+
+            for conn in conns:
+                try:
+                    operation = self._restoreSchedule(conn)
+                except (error.TopologyError, KeyError, IndexError, TypeError) as e:
+                    # port no longer in the topology or port map, or labels missing
+                    log.msg('Connection %s: Error restoring schedule: %s' % (conn.connection_id, e), system=self.log_system)
+                    continue
+                if operation is not None:
+                    d = semaphore.run(operation, conn)
+                    d.addErrback(self._restoreFailed, conn)
+                    device_operations.append(d)
+
+            n_connections += len(conns)
+            last_id = conns[-1].id
+            log.msg('Schedule restore: %i connections processed, %i device operations queued' % (n_connections, len(device_operations)), system=self.log_system)
+
+            if len(conns) < self.RESTORE_BATCH_SIZE:
+                break
+
+        log.msg('Schedule restored for %i connections' % n_connections, system=self.log_system)
+        self.restore_defer.callback(None)
+
+        if device_operations:
+            dl = defer.DeferredList(device_operations)
+            dl.addCallback(lambda _ : log.msg('Schedule restore: %i device operations done' % len(device_operations), system=self.log_system))
+
+
+    def _restoreFailed(self, err, conn):
+        log.msg('Connection %s: Error during schedule restore: %s' % (conn.connection_id, err.getErrorMessage()), system=self.log_system)
+
+
+    def _restoreSchedule(self, conn):
+        # schedule transitions for a connection found in the database
+        # returns the device operation to run if the connection is overdue, otherwise None
+
+        # avoid race with newly created connections
+        if self.scheduler.hasScheduledCall(conn.connection_id):
+            return None
+
+        now = datetime.datetime.utcnow()
+
+        if conn.lifecycle_state in (state.PASSED_ENDTIME, state.TERMINATED):
+            pass # This connection has already lived it life to the fullest :-)
+
+        elif conn.reservation_state in self.RESERVING_STATES:
+            # reservations being made are not loaded by buildCalendar, add them so the transitions can release them
+            self._addCalendarEntries(conn)
+            if conn.reservation_state == state.RESERVE_HELD:
+                # the 2PC timeout did not survive the restart, time out the reservation now
+                log.msg('Connection %s: Immediate reserve timeout during buildSchedule' % conn.connection_id, system=self.log_system)
+                return self._doReserveTimeout
+            self.scheduler.scheduleCall(conn.connection_id, max(conn.end_time, now), self._doEndtime, conn)
+
+        elif conn.end_time < now and conn.lifecycle_state not in (state.PASSED_ENDTIME, state.TERMINATED):
+            log.msg('Connection %s: Immediate end during buildSchedule' % conn.connection_id, system=self.log_system)
+            return self._doEndtime
+
+        elif conn.start_time > now:
+            # start time has not yet passed, we most schedule activate or schedule terminate depending on state
+            if conn.provision_state == state.PROVISIONED and conn.data_plane_active == False:
+                self.scheduler.scheduleCall(conn.connection_id, conn.start_time, self._doActivate, conn)
+                td = conn.start_time - now
+                log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+            elif conn.provision_state == state.RELEASED:
+                self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
+                td = conn.end_time - now
+                log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+            else:
+                log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
+
+        elif conn.start_time < now:
+            # we have passed start time, we must either: activate, schedule deactive, or schedule terminate
+            if conn.provision_state == state.PROVISIONED:
+                if conn.data_plane_active:
                     self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
                     td = conn.end_time - now
-                    log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+                    log.msg('Connection %s: already active, scheduling end for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
                 else:
-                    log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
-
+                    log.msg('Connection %s: Immediate activate during buildSchedule' % conn.connection_id, system=self.log_system)
+                    return self._doActivate
+            elif conn.provision_state == state.RELEASED:
+                self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
+                td = conn.end_time - now
+                log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
             else:
-                log.msg('Unhandled start/end time configuration for connection %s' % conn.connection_id)
+                log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
 
-        self.restore_defer.callback(None)
+        else:
+            log.msg('Unhandled start/end time configuration for connection %s' % conn.connection_id)
+
+        return None
 
 
 
@@ -142,17 +266,114 @@ class GenericBackend(service.Service):
         defer.returnValue( conns[0] ) # we only get one, unique in db
 
 
+    def _capacityPorts(self, source_port, dest_port):
+        # the unidirectional ports carrying the traffic of a connection, a port may be listed twice
+        ports = []
+        for port_id in (source_port, dest_port):
+            port = self.network_topology.getPort(port_id)
+            ports += [ port.inbound_port, port.outbound_port ] if port.isBidirectional() else [ port ]
+        return ports
+
+
+    def _calendarEntries(self, source_port, source_labels, dest_port, dest_labels):
+        # the calendar resources and capacity ports of a connection
+        getResource = self.connection_manager.getResource
+        resources = [ getResource(source_port, source_labels[0].type_, source_labels[0].labelValue()),
+                      getResource(dest_port,   dest_labels[0].type_,   dest_labels[0].labelValue()) ]
+        return resources, self._capacityPorts(source_port, dest_port)
+
+
+    def _hasCalendarEntries(self, conn):
+        # aborted and timed out reservations are back in reserve start, but without resources
+        if conn.reservation_state == state.RESERVE_START:
+            return conn.allocated
+        return conn.reservation_state in self.RESERVING_STATES
+
+
+    def _addCalendarEntries(self, conn):
+        resources, capacity_ports = self._calendarEntries(conn.source_port, conn.source_labels, conn.dest_port, conn.dest_labels)
+        for resource in resources:
+            self.calendar.addReservation(resource, conn.start_time, conn.end_time)
+        for port in capacity_ports:
+            self.capacity_calendar.addReservation(port.id_, conn.bandwidth, conn.start_time, conn.end_time)
+
+
+    def _removeCalendarEntries(self, conn):
+        resources, capacity_ports = self._calendarEntries(conn.source_port, conn.source_labels, conn.dest_port, conn.dest_labels)
+        try:
+            for resource in resources:
+                self.calendar.removeReservation(resource, conn.start_time, conn.end_time)
+        finally:
+            # release the bandwidth, even if the labels were not in the calendar
+            for port in capacity_ports:
+                self.capacity_calendar.removeReservation(port.id_, conn.bandwidth, conn.start_time, conn.end_time)
+
+
     def logStateUpdate(self, conn, state_msg):
         src_target = self.connection_manager.getTarget(conn.source_port, conn.source_labels[0].type_, conn.source_labels[0].labelValue())
         dst_target = self.connection_manager.getTarget(conn.dest_port,   conn.dest_labels[0].type_,   conn.dest_labels[0].labelValue())
         log.msg('Connection %s: %s -> %s %s' % (conn.connection_id, src_target, dst_target, state_msg), system=self.log_system)
 
 
+    def checkAvailability(self, criteria):
+        """
+        Check if a reservation with the given criteria could be made right now,
+        without reserving anything. Only the calendars are consulted, so this is
+        cheap, but the answer is a hint, not a promise.
+        """
+        if not self.restore_defer.called or self.restore_failure is not None:
+            return self.waitForRestore().addCallback(lambda _ : self.checkAvailability(criteria))
+
+        schedule = criteria.schedule
+        sd = criteria.service_def
+
+        source_stp = sd.source_stp
+        dest_stp   = sd.dest_stp
+
+        if source_stp.network != self.network or dest_stp.network != self.network:
+            return False
+        if len(source_stp.labels) != 1 or len(dest_stp.labels) != 1:
+            return False
+
+        try:
+            topo_source_port = self.network_topology.getPort(source_stp.port)
+            topo_dest_port   = self.network_topology.getPort(dest_stp.port)
+        except error.TopologyError:
+            return False
+
+        if not topo_source_port.canMatchLabels(source_stp.labels) or not topo_dest_port.canMatchLabels(dest_stp.labels):
+            return False
+
+        capacity_ports = self._capacityPorts(source_stp.port, dest_stp.port)
+        for port in capacity_ports:
+            bandwidth = sd.capacity * capacity_ports.count(port)
+            if not self.capacity_calendar.canProvideBandwidth(port.id_, port.bandwidth, bandwidth, schedule.start_time, schedule.end_time):
+                return False
+
+        getResource = self.connection_manager.getResource
+        src_label_candidate = source_stp.labels[0]
+        dst_label_candidate = dest_stp.labels[0]
+
+        if self.connection_manager.canSwapLabel(src_label_candidate.type_):
+            src_lv = self.calendar.findLabelValue([ source_stp.port ], src_label_candidate, schedule.start_time, schedule.end_time, getResource)
+            dst_lv = self.calendar.findLabelValue([ dest_stp.port ],   dst_label_candidate, schedule.start_time, schedule.end_time, getResource)
+            return src_lv is not None and dst_lv is not None
+        else:
+            try:
+                label_candidate = src_label_candidate.intersect(dst_label_candidate)
+            except nsa.EmptyLabelSet:
+                return False
+            lv = self.calendar.findLabelValue([ source_stp.port, dest_stp.port ], label_candidate, schedule.start_time, schedule.end_time, getResource)
+            return lv is not None
+
+
     @defer.inlineCallbacks
     def reserve(self, header, connection_id, global_reservation_id, description, criteria):
 
         # return defer.fail( error.InternalNRMError('test reservation failure') )
 
+        yield self.waitForRestore()
+
         schedule = criteria.schedule
         sd = criteria.service_def
 
@@ -205,51 +426,42 @@ class GenericBackend(service.Service):
         if not topo_dest_port.canMatchLabels(dest_stp.labels):
             raise error.TopologyError('Destination port %s cannot match label set %s' % (topo_dest_port.name, dst_label_candidate ) )
 
+        # check that there is room for the bandwidth, before we start reserving labels
+        capacity_ports = self._capacityPorts(source_stp.port, dest_stp.port)
+        for port in capacity_ports:
+            bandwidth = sd.capacity * capacity_ports.count(port)
+            if not self.capacity_calendar.canProvideBandwidth(port.id_, port.bandwidth, bandwidth, schedule.start_time, schedule.end_time):
+                raise error.BandwidthUnavailableError('Port %s cannot provide %i Mbps in specified time span' % (port.id_, sd.capacity))
+
         # do the find the labels dance
+        getResource = self.connection_manager.getResource
+
         if self.connection_manager.canSwapLabel(src_label_candidate.type_):
-            for lv in src_label_candidate.enumerateValues():
-                src_resource = self.connection_manager.getResource(source_stp.port, src_label_candidate.type_, lv)
-                try:
-                    self.calendar.checkReservation(src_resource, schedule.start_time, schedule.end_time)
-                    self.calendar.addReservation(  src_resource, schedule.start_time, schedule.end_time)
-                    src_label = nsa.Label(src_label_candidate.type_, str(lv))
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            src_lv = self.calendar.findLabelValue([ source_stp.port ], src_label_candidate, schedule.start_time, schedule.end_time, getResource)
+            if src_lv is None:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % source_stp)
+            self.calendar.addReservation(getResource(source_stp.port, src_label_candidate.type_, src_lv), schedule.start_time, schedule.end_time)
+            src_label = nsa.Label(src_label_candidate.type_, str(src_lv))
 
-
-            for lv in dst_label_candidate.enumerateValues():
-                dst_resource = self.connection_manager.getResource(dest_stp.port, dst_label_candidate.type_, lv)
-                try:
-                    self.calendar.checkReservation(dst_resource, schedule.start_time, schedule.end_time)
-                    self.calendar.addReservation(  dst_resource, schedule.start_time, schedule.end_time)
-                    dst_label = nsa.Label(dst_label_candidate.type_, str(lv))
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            dst_lv = self.calendar.findLabelValue([ dest_stp.port ], dst_label_candidate, schedule.start_time, schedule.end_time, getResource)
+            if dst_lv is None:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % dest_stp)
+            self.calendar.addReservation(getResource(dest_stp.port, dst_label_candidate.type_, dst_lv), schedule.start_time, schedule.end_time)
+            dst_label = nsa.Label(dst_label_candidate.type_, str(dst_lv))
 
         else:
             label_candidate = src_label_candidate.intersect(dst_label_candidate)
 
-            for lv in label_candidate.enumerateValues():
-                src_resource = self.connection_manager.getResource(source_stp.port, label_candidate.type_, lv)
-                dst_resource = self.connection_manager.getResource(dest_stp.port,   label_candidate.type_, lv)
-                try:
-                    self.calendar.checkReservation(src_resource, schedule.start_time, schedule.end_time)
-                    self.calendar.checkReservation(dst_resource, schedule.start_time, schedule.end_time)
-                    self.calendar.addReservation(  src_resource, schedule.start_time, schedule.end_time)
-                    self.calendar.addReservation(  dst_resource, schedule.start_time, schedule.end_time)
-                    src_label = nsa.Label(label_candidate.type_, str(lv))
-                    dst_label = nsa.Label(label_candidate.type_, str(lv))
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            lv = self.calendar.findLabelValue([ source_stp.port, dest_stp.port ], label_candidate, schedule.start_time, schedule.end_time, getResource)
+            if lv is None:
                 raise error.STPUnavailableError('STP combination %s and %s not available in specified time span' % (source_stp, dest_stp))
+            self.calendar.addReservation(getResource(source_stp.port, label_candidate.type_, lv), schedule.start_time, schedule.end_time)
+            self.calendar.addReservation(getResource(dest_stp.port,   label_candidate.type_, lv), schedule.start_time, schedule.end_time)
+            src_label = nsa.Label(label_candidate.type_, str(lv))
+            dst_label = nsa.Label(label_candidate.type_, str(lv))
+
+        for port in capacity_ports:
+            self.capacity_calendar.addReservation(port.id_, sd.capacity, schedule.start_time, schedule.end_time)
 
         now =  datetime.datetime.utcnow()
 
@@ -263,7 +475,7 @@ class GenericBackend(service.Service):
         # should we save the requester or provider here?
         conn = GenericBackendConnections(connection_id=connection_id, revision=0, global_reservation_id=global_reservation_id, description=description,
                                          requester_nsa=header.requester_nsa, reserve_time=now,
-                                         reservation_state=state.RESERVE_START, provision_state=state.RELEASED, lifecycle_state=state.CREATED, data_plane_active=False,
+                                         reservation_state=state.RESERVE_START, provision_state=state.RELEASED, lifecycle_state=state.CREATED, data_plane_active=False, allocated=False,
                                          source_network=source_stp.network, source_port=source_stp.port, source_labels=[src_label],
                                          dest_network=dest_stp.network, dest_port=dest_stp.port, dest_labels=[dst_label],
                                          start_time=schedule.start_time, end_time=schedule.end_time,
@@ -278,12 +490,15 @@ class GenericBackend(service.Service):
 
         log.msg('ReserveCommit request. Connection ID: %s' % connection_id, system=self.log_system)
 
+        yield self.waitForRestore()
+
         conn = yield self._getConnection(connection_id, header.requester_nsa)
         if conn.lifecycle_state in (state.TERMINATING, state.TERMINATED):
             raise error.ConnectionGoneError('Connection %s has been terminated')
 
         yield state.reserveCommit(conn)
         self.logStateUpdate(conn, 'RESERVE COMMIT')
+        conn.allocated = True # saved with the state, marks the connection for buildCalendar
         yield state.reserved(conn)
         self.logStateUpdate(conn, 'RESERVED')
 
@@ -302,6 +517,8 @@ class GenericBackend(service.Service):
         try:
             log.msg('ReserveAbort request. Connection ID: %s' % connection_id, system=self.log_system)
 
+            yield self.waitForRestore()
+
             conn = yield self._getConnection(connection_id, header.requester_nsa)
             if conn.lifecycle_state in (state.TERMINATING, state.TERMINATED):
                 raise error.ConnectionGoneError('Connection %s has been terminated')
@@ -318,6 +535,8 @@ class GenericBackend(service.Service):
     @defer.inlineCallbacks
     def provision(self, header, connection_id):
 
+        yield self.waitForRestore()
+
         conn = yield self._getConnection(connection_id, header.requester_nsa)
         if conn.lifecycle_state in (state.TERMINATING, state.TERMINATED):
             raise error.ConnectionGoneError('Connection %s has been terminated')
@@ -354,6 +573,8 @@ class GenericBackend(service.Service):
     def release(self, header, connection_id):
 
         try:
+            yield self.waitForRestore()
+
             conn = yield self._getConnection(connection_id, header.requester_nsa)
             if conn.lifecycle_state in (state.TERMINATING, state.TERMINATED):
                 raise error.ConnectionGoneError('Connection %s has been terminated')
@@ -387,12 +608,15 @@ class GenericBackend(service.Service):
     def terminate(self, header, connection_id):
         # return defer.fail( error.InternalNRMError('test termination failure') )
 
+        yield self.waitForRestore()
+
         conn = yield self._getConnection(connection_id, header.requester_nsa)
 
         if conn.lifecycle_state == state.TERMINATED:
             defer.returnValue(conn.cid)
 
-        yield self._doEndtime(conn)
+        if conn.lifecycle_state == state.CREATED:
+            yield self._doEndtime(conn) # resources have already been released if end time has passed
 
         yield state.terminating(conn)
         self.logStateUpdate(conn, 'TERMINATING')
@@ -500,11 +724,7 @@ class GenericBackend(service.Service):
             self.scheduler.cancelCall(conn.connection_id) # we only have this for non-timeout calls, but just cancel
 
             # release the resources
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_labels[0].type_, conn.source_labels[0].labelValue())
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_labels[0].type_,   conn.dest_labels[0].labelValue())
-
-            self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-            self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
+            self._removeCalendarEntries(conn)
 
             yield state.reserved(conn)
             self.logStateUpdate(conn, 'RESERVE START')
@@ -611,16 +831,13 @@ class GenericBackend(service.Service):
         self.scheduler.cancelCall(conn.connection_id)
 
         if conn.data_plane_active:
+            yield self._doTeardown(conn) # errors are reported by teardown, the resources are released regardless
+
+        if self._hasCalendarEntries(conn):
             try:
-                yield self._doTeardown(conn)
-                # we can only remove resource reservation entry if we succesfully shut down the link :-(
-                src_resource = self.connection_manager.getResource(conn.source_port, conn.source_labels[0].type_, conn.source_labels[0].labelValue())
-                dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_labels[0].type_,   conn.dest_labels[0].labelValue())
-                self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-                self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
-            except Exception as e:
-                log.msg('Error ending connection: %s' % e)
-                raise e
+                self._removeCalendarEntries(conn)
+            except ValueError as e:
+                log.msg('Connection %s: Error releasing resources: %s' % (conn.connection_id, e), system=self.log_system)
 
         yield state.passedEndtime(conn)
 
@@ -1,14 +1,20 @@
 """
 Call scheduler. Handles one future call per connection.
 
+The scheduled calls are kept in a heap, and only a single reactor timer is
+armed, for the earliest call. When the timer fires all due calls are run in
+one go. Cancelling a call just removes it from the connection index, the
+stale heap entry is skipped when it reaches the top of the heap.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011)
 """
 
+import heapq
 import datetime
 
 from twisted.python import log
-from twisted.internet import reactor, defer, task
+from twisted.internet import reactor, defer
 
 
 
@@ -28,18 +34,16 @@ def deferTaskFailed(err):
 class CallScheduler:
 
     def __init__(self):
-        self.scheduled_calls = {}
+        self.scheduled_calls = {} # connection_id -> ( deadline, sequence, call, args, deferred )
+        self.heap = [] # [ ( deadline, sequence, connection_id ) ], may contain cancelled entries
+        self.sequence = 0
+        self.timer = None # the one reactor DelayedCall, armed for the earliest deadline
         self.clock = reactor # this is needed in order to test scheduled calls
 
 
     def scheduleCall(self, connection_id, transition_time, call, *args):
         assert callable(call), 'call argument is not a callable'
-
-        try:
-            sched_call = self.scheduled_calls[connection_id]
-            assert sched_call.called is True, 'Connection %s: Attempt to schedule transition with existing schedule transition' % connection_id
-        except KeyError:
-            pass # no scheduled call
+        assert connection_id not in self.scheduled_calls, 'Connection %s: Attempt to schedule transition with existing schedule transition' % connection_id
 
         dt_now = datetime.datetime.utcnow()
 
@@ -50,9 +54,16 @@ class CallScheduler:
         transition_delta_seconds = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6.0
         transition_delta_seconds = max(transition_delta_seconds, 0) # if dt_now is passed during calculation
 
-        d = task.deferLater(self.clock, transition_delta_seconds, call, *args)
+        deadline = self.clock.seconds() + transition_delta_seconds
+        self.sequence += 1
+
+        d = defer.Deferred()
         d.addErrback(deferTaskFailed)
-        self.scheduled_calls[connection_id] = d
+
+        self.scheduled_calls[connection_id] = (deadline, self.sequence, call, args, d)
+        heapq.heappush(self.heap, (deadline, self.sequence, connection_id) )
+        self._compactHeap()
+        self._armTimer()
         return d
 
 
@@ -62,13 +73,72 @@ class CallScheduler:
 
     def cancelCall(self, connection_id):
         try:
-            sched_call = self.scheduled_calls.pop(connection_id)
-            sched_call.cancel()
+            _, _, _, _, d = self.scheduled_calls.pop(connection_id)
+            d.cancel()
         except KeyError:
             pass
 
 
     def cancelAllCalls(self):
         for k in self.scheduled_calls.keys():
-            self.scheduled_calls.pop(k).cancel()
+            self.cancelCall(k)
+        self.heap = []
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+
+    def _isPending(self, entry):
+        deadline, sequence, connection_id = entry
+        try:
+            return self.scheduled_calls[connection_id][1] == sequence
+        except KeyError:
+            return False
+
+
+    def _compactHeap(self):
+        # get rid of cancelled entries if they make up most of the heap
+        if len(self.heap) > 2 * len(self.scheduled_calls) + 16:
+            self.heap = [ entry for entry in self.heap if self._isPending(entry) ]
+            heapq.heapify(self.heap)
+
+
+    def _armTimer(self):
+        # make sure the timer is set for the earliest pending deadline
+        while self.heap and not self._isPending(self.heap[0]):
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            return
+
+        delay = max(self.heap[0][0] - self.clock.seconds(), 0)
+
+        if self.timer is not None and self.timer.active():
+            if self.timer.getTime() <= self.heap[0][0]:
+                return # timer will fire before (or at) the earliest deadline
+            self.timer.reset(delay)
+        else:
+            self.timer = self.clock.callLater(delay, self._runDueCalls)
+
+
+    def _runDueCalls(self):
+
+        self.timer = None
+        now = self.clock.seconds()
+        last_sequence = self.sequence
+
+        # calls scheduled by the calls we run are left for the next round
+        postponed = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if entry[1] > last_sequence:
+                postponed.append(entry)
+            elif self._isPending(entry): # check each time, a call may cancel another one
+                _, _, call, args, d = self.scheduled_calls.pop(entry[2])
+                defer.maybeDeferred(call, *args).chainDeferred(d)
+
+        for entry in postponed:
+            heapq.heappush(self.heap, entry)
+
+        self._armTimer()
 
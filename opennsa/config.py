@@ -19,6 +19,11 @@ DEFAULT_TCP_PORT        = 9080
 DEFAULT_TLS_PORT        = 9443
 DEFAULT_VERIFY          = True
 DEFAULT_CERTIFICATE_DIR = '/etc/ssl/certs' # This will work on most mordern linux distros
+DEFAULT_PROBE_PATHS     = 1 # no path probing
+DEFAULT_RESERVE_ATTEMPTS = 3
+DEFAULT_RESERVE_TIME_BUDGET = 60 # seconds
+DEFAULT_FETCH_CONCURRENCY = 10
+DEFAULT_PARSE_THREADS   = 2
 
 
 # config blocks and options
@@ -40,6 +45,12 @@ PORT             = 'port'
 TLS              = 'tls'
 NRM_MAP_FILE     = 'nrmmap'
 PEERS            = 'peers'
+PROBE_PATHS      = 'probepaths'  # number of candidate paths to probe for availability before reserving
+RESERVE_ATTEMPTS = 'reserveattempts' # number of paths to try per reservation
+RESERVE_TIME_BUDGET = 'reservetimebudget' # seconds after which no new path is tried for a reservation
+FETCH_CONCURRENCY = 'fetchconcurrency' # max number of peer topology fetches in progress
+PARSE_THREADS    = 'parsethreads' # number of threads for parsing peer topologies
+TOPOLOGY_CACHE   = 'topologycache' # directory for keeping peer topologies between restarts
 
 # database
 DATABASE                = 'database'    # mandatory
@@ -176,6 +187,46 @@ def readVerifyConfig(cfg):
     except ConfigParser.NoOptionError:
         vc[PORT] = DEFAULT_TLS_PORT if vc[TLS] else DEFAULT_TCP_PORT
 
+    try:
+        vc[PROBE_PATHS] = cfg.getint(BLOCK_SERVICE, PROBE_PATHS)
+        if vc[PROBE_PATHS] < 1:
+            raise ConfigurationError('Option %s must be at least 1' % PROBE_PATHS)
+    except ConfigParser.NoOptionError:
+        vc[PROBE_PATHS] = DEFAULT_PROBE_PATHS
+
+    try:
+        vc[RESERVE_ATTEMPTS] = cfg.getint(BLOCK_SERVICE, RESERVE_ATTEMPTS)
+        if vc[RESERVE_ATTEMPTS] < 1:
+            raise ConfigurationError('Option %s must be at least 1' % RESERVE_ATTEMPTS)
+    except ConfigParser.NoOptionError:
+        vc[RESERVE_ATTEMPTS] = DEFAULT_RESERVE_ATTEMPTS
+
+    try:
+        vc[RESERVE_TIME_BUDGET] = cfg.getint(BLOCK_SERVICE, RESERVE_TIME_BUDGET)
+        if vc[RESERVE_TIME_BUDGET] < 0:
+            raise ConfigurationError('Option %s cannot be negative' % RESERVE_TIME_BUDGET)
+    except ConfigParser.NoOptionError:
+        vc[RESERVE_TIME_BUDGET] = DEFAULT_RESERVE_TIME_BUDGET
+
+    try:
+        vc[FETCH_CONCURRENCY] = cfg.getint(BLOCK_SERVICE, FETCH_CONCURRENCY)
+        if vc[FETCH_CONCURRENCY] < 1:
+            raise ConfigurationError('Option %s must be at least 1' % FETCH_CONCURRENCY)
+    except ConfigParser.NoOptionError:
+        vc[FETCH_CONCURRENCY] = DEFAULT_FETCH_CONCURRENCY
+
+    try:
+        vc[PARSE_THREADS] = cfg.getint(BLOCK_SERVICE, PARSE_THREADS)
+        if vc[PARSE_THREADS] < 1:
+            raise ConfigurationError('Option %s must be at least 1' % PARSE_THREADS)
+    except ConfigParser.NoOptionError:
+        vc[PARSE_THREADS] = DEFAULT_PARSE_THREADS
+
+    try:
+        vc[TOPOLOGY_CACHE] = cfg.get(BLOCK_SERVICE, TOPOLOGY_CACHE)
+    except ConfigParser.NoOptionError:
+        vc[TOPOLOGY_CACHE] = None
+
     # database
     try:
         vc[DATABASE] = cfg.get(BLOCK_SERVICE, DATABASE)
@@ -6,6 +6,7 @@ Copyright: NORDUnet (2011-2012)
 """
 
 import sys
+from xml.etree import ElementTree as ET
 
 from zope.interface import implements
 
@@ -13,6 +14,56 @@ from twisted.python import log
 
 
 
+# payloads are large, and payload logging is usually off, so the flag is checked before
+# anything is formatted (twisted formats log messages when they are logged, not when emitted)
+_log_payload = False
+
+
+def setPayloadLogging(enabled):
+    global _log_payload
+    _log_payload = enabled
+
+
+def _indent(elem, level=0):
+    i = "\n" + level*"   "
+    if len(elem):
+        if not elem.text or not elem.text.strip():
+            elem.text = i + "   "
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+        for elem in elem:
+            _indent(elem, level+1)
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+    else:
+        if level and (not elem.tail or not elem.tail.strip()):
+            elem.tail = i
+
+
+def indentPayload(payload):
+    # xml payloads are compact on the wire, they are indented for reading them in the log
+    # anything which is not xml (e.g., an error page) is returned as it is
+    try:
+        element = ET.fromstring(payload)
+    except (ET.ParseError, TypeError):
+        return payload
+    _indent(element)
+    return ET.tostring(element, 'utf-8')
+
+
+def logPayload(system, payload, title, *args):
+    """
+    Log a message payload, the title is formatted with args. Nothing is
+    formatted or logged, unless payload logging has been enabled. The
+    logged copy of an xml payload is indented, the payload is not changed.
+    """
+    if _log_payload:
+        if args:
+            title = title % args
+        log.msg(' -- %s --\n%s\n -- END. %s --' % (title, indentPayload(payload), title), system=system, payload=True)
+
+
+
 class EarlyObserver:
 
     def emit(self, eventDict):
@@ -10,9 +10,9 @@ Copyright: NORDUnet (2011-2013)
 
 
 import uuid
+import bisect
 import random
 import urlparse
-import itertools
 
 from opennsa import error, constants as cnt
 
@@ -53,14 +53,98 @@ class EmptyLabelSet(Exception):
 
 
 
+# Label sets where all values are below this bound (e.g., VLANs 0-4095) can be represented as integer bitsets,
+# where bit n is set if value n is in the set. Python integers are arbitrary precision, so the bits are handled
+# as machine words by the interpreter. The bitset is built on first use and kept with the label. Bitsets are used for
+# membership, overlap, and first free value. Operations producing a new label work on the sorted ranges, as turning
+# a bitset back into ranges costs more than merging the ranges.
+BITSET_LABEL_BOUND = 4096
+
+
+def _rangesToBits(ranges):
+    bits = 0
+    for v1, v2 in ranges:
+        bits |= ((1 << (v2 - v1 + 1)) - 1) << v1
+    return bits
+
+
+def _intersectRanges(ranges, other_ranges):
+    label_values = []
+    i = iter(other_ranges)
+    try:
+        o1, o2 = i.next()
+    except StopIteration:
+        return label_values
+
+    for v1, v2 in ranges:
+        while True:
+            if v2 < o1:
+                break
+            elif o2 < v1:
+                try:
+                    o1, o2 = i.next()
+                except StopIteration:
+                    return label_values
+                continue
+            label_values.append( ( max(v1,o1), min(v2,o2)) )
+            if v2 <= o2:
+                break
+            else:
+                try:
+                    o1, o2 = i.next()
+                except StopIteration:
+                    return label_values
+    return label_values
+
+
+def _mergeRanges(ranges):
+    # sort and merge overlapping or adjacent ranges
+    nv = [] # normalized values
+    for v1, v2 in sorted(ranges):
+        if nv and v1 <= nv[-1][1] + 1: # merge
+            nv[-1] = (nv[-1][0], max(nv[-1][1], v2))
+        else:
+            nv.append( (v1,v2) )
+    return nv
+
+
+def _differenceRanges(ranges, other_ranges):
+    label_values = []
+    others = iter(other_ranges)
+    o = next(others, None)
+    for v1, v2 in ranges:
+        while o is not None and o[1] < v1:
+            o = next(others, None)
+        while o is not None and o[0] <= v2:
+            if o[0] > v1:
+                label_values.append( (v1, o[0]-1) )
+            v1 = o[1] + 1
+            if v1 > v2:
+                break
+            o = next(others, None)
+        if v1 <= v2:
+            label_values.append( (v1, v2) )
+    return label_values
+
+
+
 class Label(object):
 
     def __init__(self, type_, values=None):
 
-        assert type(values) in (None, str, list), 'Type of Label values must be a None, str, or list. Was given %s' % type(values)
+        assert values is None or type(values) in (str, list), 'Type of Label values must be a None, str, or list. Was given %s' % type(values)
 
         self.type_ = type_
         self.values = self._parseLabelValues(values) if values is not None else None
+        self._bits = None
+
+
+    @classmethod
+    def _fromRanges(cls, type_, ranges):
+        # create label from normalized ranges, skipping parsing
+        label = cls(type_)
+        label.values = ranges
+        return label
 
 
     def _parseLabelValues(self, values):
@@ -82,75 +166,155 @@ class Label(object):
         if type(values) is str:
             values = values.split(',')
 
-        parsed_values = sorted( [ createValue(value) for value in values ] )
+        # detect any overlap and remove it
+        return _mergeRanges( [ createValue(value) for value in values ] )
 
-        # detect any overlap and remove it - remember that the list is sorted
 
-        nv = [] # normalized values
-        for v1, v2 in parsed_values:
-            if len(nv) == 0:
-                nv.append( (v1,v2) )
-                continue
+    def _ranges(self):
+        # a label created without values has values None, which is the same as no values
+        return self.values or []
 
-            l = nv[-1] # last
-            if v1 <= l[1] + 1: # merge
-                nv = nv[:-1] + [ (l[0], max(l[1],v2)) ]
-            else:
-                nv.append( (v1,v2) )
 
-        return nv
+    def _useBits(self, other=None):
+        # ranges are sorted, so the last range has the highest value
+        if self.values and self.values[-1][1] >= BITSET_LABEL_BOUND:
+            return False
+        return other is None or not other.values or other.values[-1][1] < BITSET_LABEL_BOUND
+
+
+    def bits(self):
+        # values as integer bitset, only sensible for small label values, see BITSET_LABEL_BOUND
+        if self._bits is None:
+            self._bits = _rangesToBits(self._ranges())
+        return self._bits
+
+
+    def _checkCompatible(self, other, operation):
+        assert type(other) is Label, 'Cannot %s label with something that is not a label (other was %s)' % (operation, type(other))
+        assert self.type_ == other.type_, 'Cannot %s label of different types' % operation
+
 
+    # intersect, union, and difference produce new labels, and turning a bitset back into ranges
+    # is slower than working on the ranges (see benchmarks/bench_label.py), so they use the ranges
 
     def intersect(self, other):
         # get the common labels between two label set - I hate you nml
-        assert type(other) is Label, 'Cannot intersect label with something that is not a label (other was %s)' % type(other)
-        assert self.type_ == other.type_, 'Cannot insersect label of different types'
+        self._checkCompatible(other, 'intersect')
 
-        label_values = []
-        i = iter(other.values)
-        o1, o2 = i.next()
-
-        for v1, v2 in self.values:
-            while True:
-                if v2 < o1:
-                    break
-                elif o2 < v1:
-                    try:
-                        o1, o2 = i.next()
-                    except StopIteration:
-                        break
-                    continue
-                label_values.append( ( max(v1,o1), min(v2,o2)) )
-                if v2 <= o2:
-                    break
-                elif o2 <= v2:
-                    try:
-                        o1, o2 = i.next()
-                    except StopIteration:
-                        break
+        label_values = _intersectRanges(self._ranges(), other._ranges())
 
         if len(label_values) == 0:
             raise EmptyLabelSet('Label intersection produced empty label set')
 
-        ls = ','.join( [ '%i-%s' % (nv[0], nv[1]) for nv in label_values ] )
-        return Label(self.type_, ls)
+        return Label._fromRanges(self.type_, label_values)
+
+
+    def union(self, other):
+        self._checkCompatible(other, 'union')
+
+        label_values = _mergeRanges(self._ranges() + other._ranges())
+
+        return Label._fromRanges(self.type_, label_values)
+
+
+    def difference(self, other):
+        # values in this label, but not in the other label
+        self._checkCompatible(other, 'difference')
+
+        label_values = _differenceRanges(self._ranges(), other._ranges())
+
+        if len(label_values) == 0:
+            raise EmptyLabelSet('Label difference produced empty label set')
+
+        return Label._fromRanges(self.type_, label_values)
+
+
+    def intersects(self, other):
+        # true if the labels have any values in common, same as intersect not raising EmptyLabelSet
+        self._checkCompatible(other, 'intersect')
+
+        if self._useBits(other):
+            return (self.bits() & other.bits()) != 0
+        else:
+            return len(_intersectRanges(self._ranges(), other._ranges())) > 0
+
+
+    def issubset(self, other):
+        # true if all values in this label are also in the other label
+        self._checkCompatible(other, 'compare')
+
+        if self._useBits(other):
+            return (self.bits() & ~other.bits()) == 0
+        else:
+            return len(_differenceRanges(self._ranges(), other._ranges())) == 0
+
+
+    def firstFreeValue(self, used):
+        # lowest value in this label, which is not in the used label, or None if there is no such value
+        self._checkCompatible(used, 'compare')
+
+        if self._useBits(used):
+            free = self.bits() & ~used.bits()
+            return (free & -free).bit_length() - 1 if free else None
+        else:
+            free_values = _differenceRanges(self._ranges(), used._ranges())
+            return free_values[0][0] if free_values else None
+
+
+    def __contains__(self, value):
+        if self._useBits():
+            return value >= 0 and bool( (self.bits() >> value) & 1 )
+        idx = bisect.bisect_right(self.values, (value, float('inf')))
+        return idx > 0 and self.values[idx-1][0] <= value <= self.values[idx-1][1]
 
 
     def labelValue(self):
-        vs = [ str(v1) if v1 == v2 else str(v1) + '-' + str(v2) for v1,v2 in self.values ]
+        vs = [ str(v1) if v1 == v2 else str(v1) + '-' + str(v2) for v1,v2 in self._ranges() ]
         return ','.join(vs)
 
     def singleValue(self):
         return len(self.values) == 1 and self.values[0][0] == self.values[0][1]
 
     def enumerateValues(self):
-        lv = [ range(lr[0], lr[1]+1) for lr in self.values ]
-        return list(itertools.chain.from_iterable( lv ) )
+        # lazy, use list() if the values are needed as a list
+        return iter(self)
+
+    def minValue(self):
+        return self.values[0][0]
+
+    def maxValue(self):
+        return self.values[-1][1]
+
+    def split(self, value):
+        # split into values below value and values from value and up, either part is None if it would be empty
+        ranges = self._ranges()
+        idx = bisect.bisect_left(ranges, (value, value))
+        lower = ranges[:idx]
+        upper = ranges[idx:]
+        if lower and lower[-1][1] >= value:
+            v1, v2 = lower.pop()
+            lower.append( (v1, value-1) )
+            upper.insert(0, (value, v2) )
+        return Label._fromRanges(self.type_, lower) if lower else None, \
+               Label._fromRanges(self.type_, upper) if upper else None
 
     def randomLabel(self):
-        # not evenly distributed, but that isn't promised anyway
-        label_range = random.choice(self.values)
-        return random.randint(label_range[0], label_range[1]+1)
+        # pick the n'th value, so all values are equally likely
+        n = random.randrange(len(self))
+        for v1, v2 in self.values:
+            if n <= v2 - v1:
+                return v1 + n
+            n -= v2 - v1 + 1
+
+
+    def __iter__(self):
+        for v1, v2 in self._ranges():
+            for value in xrange(v1, v2+1):
+                yield value
+
+
+    def __len__(self):
+        return sum( [ v2 - v1 + 1 for v1, v2 in self._ranges() ] )
 
 
     def __eq__(self, other):
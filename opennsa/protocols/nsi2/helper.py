@@ -5,7 +5,9 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2012)
 """
 
+import re
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape
 
 from dateutil import parser
 from dateutil.tz import tzutc
@@ -43,16 +45,117 @@ def createHeader(requester_nsa_urn, provider_nsa_urn, session_security_attrs=Non
     return header_element
 
 
+# The acknowledgements and confirmations are the bulk of the messages, and only differ in a few
+# text fields, so they are created from templates instead of building and serializing a tree.
+# The templates are made by serializing the messages from the bindings with placeholders in
+# the text fields, so the result is the same as from the bindings.
+
+_PLACEHOLDER = re.compile('@@(\w+)@@')
+
+
+def _compileTemplate(body_element):
+    header_element = createHeader('@@requester_nsa@@', '@@provider_nsa@@', correlation_id='@@correlation_id@@')
+    payload = minisoap.createSoapPayload(body_element, header_element)
+    return _PLACEHOLDER.sub(r'%(\1)s', payload.replace('%', '%%'))
+
+
+def _compileDataPlaneStateChangeTemplate():
+    data_plane_status = nsiconnection.DataPlaneStatusType(True, '@@version@@', True)
+    dps = nsiconnection.DataPlaneStateChangeRequestType('@@connection_id@@', '@@notification_id@@', '@@timestamp@@', data_plane_status)
+    body_element = dps.xml(nsiconnection.dataPlaneStateChange)
+    # the bindings write the booleans themselves, so the placeholders are put in afterwards
+    body_element.find('dataPlaneStatus/active').text = '@@active@@'
+    body_element.find('dataPlaneStatus/versionConsistent').text = '@@consistent@@'
+    return _compileTemplate(body_element)
+
+
+def _xmlText(value, name, required=True):
+    # escaped and encoded like ElementTree does it
+    # required fields must have a value, optional ones become an empty element, like from the bindings
+    if value is None:
+        if required:
+            raise ValueError('%s must not be None' % name)
+        return ''
+    if type(value) is unicode:
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return xml_escape(value)
+
+
+def _xmlBoolean(value):
+    return 'true' if value else 'false'
+
+
+def _headerFields(requester_nsa, provider_nsa, correlation_id):
+    return { 'requester_nsa'  : _xmlText(requester_nsa,  'requesterNSA'),
+             'provider_nsa'   : _xmlText(provider_nsa,   'providerNSA'),
+             'correlation_id' : _xmlText(correlation_id, 'correlationId') }
+
+
+_ACKNOWLEDGEMENT_TEMPLATE         = _compileTemplate( nsiconnection.GenericAcknowledgmentType().xml(nsiconnection.acknowledgment) )
+_RESERVE_RESPONSE_TEMPLATE        = _compileTemplate( nsiconnection.ReserveResponseType('@@connection_id@@').xml(nsiconnection.reserveResponse) )
+_DATA_PLANE_STATE_CHANGE_TEMPLATE = _compileDataPlaneStateChangeTemplate()
+_generic_confirmed_templates      = {} # element name -> template, created when first used
+
+
+
 def createGenericAcknowledgement(header):
 
-    soap_header = nsiframework.CommonHeaderType(cnt.CS2_SERVICE_TYPE, header.correlation_id, header.requester_nsa, header.provider_nsa, None, header.session_security_attrs)
-    soap_header_element = soap_header.xml(nsiframework.nsiHeader)
+    if header.session_security_attrs:
+        # no template for these
+        soap_header = nsiframework.CommonHeaderType(cnt.CS2_SERVICE_TYPE, header.correlation_id, header.requester_nsa, header.provider_nsa, None, header.session_security_attrs)
+        soap_header_element = soap_header.xml(nsiframework.nsiHeader)
+
+        generic_confirm = nsiconnection.GenericAcknowledgmentType()
+        generic_confirm_element = generic_confirm.xml(nsiconnection.acknowledgment)
+
+        payload = minisoap.createSoapPayload(generic_confirm_element, soap_header_element)
+        return payload
+
+    return _ACKNOWLEDGEMENT_TEMPLATE % _headerFields(header.requester_nsa, header.provider_nsa, header.correlation_id)
+
+
+def createReserveResponse(header, connection_id):
+
+    if header.session_security_attrs:
+        soap_header = nsiframework.CommonHeaderType(cnt.CS2_SERVICE_TYPE, header.correlation_id, header.requester_nsa, header.provider_nsa, None, header.session_security_attrs)
+        soap_header_element = soap_header.xml(nsiframework.nsiHeader)
+
+        reserve_response = nsiconnection.ReserveResponseType(connection_id)
+        reserve_response_element = reserve_response.xml(nsiconnection.reserveResponse)
+
+        payload = minisoap.createSoapPayload(reserve_response_element, soap_header_element)
+        return payload
+
+    fields = _headerFields(header.requester_nsa, header.provider_nsa, header.correlation_id)
+    fields['connection_id'] = _xmlText(connection_id, 'connectionId', required=False)
+    return _RESERVE_RESPONSE_TEMPLATE % fields
+
+
+def createGenericConfirmed(element_name, requester_nsa, provider_nsa, correlation_id, connection_id):
+
+    try:
+        template = _generic_confirmed_templates[element_name]
+    except KeyError:
+        template = _compileTemplate( nsiconnection.GenericConfirmedType('@@connection_id@@').xml(element_name) )
+        _generic_confirmed_templates[element_name] = template
+
+    fields = _headerFields(requester_nsa, provider_nsa, correlation_id)
+    fields['connection_id'] = _xmlText(connection_id, 'connectionId', required=False)
+    return template % fields
+
 
-    generic_confirm = nsiconnection.GenericAcknowledgmentType()
-    generic_confirm_element = generic_confirm.xml(nsiconnection.acknowledgment)
+def createDataPlaneStateChange(requester_nsa, provider_nsa, correlation_id, connection_id, notification_id, timestamp, active, version, consistent):
 
-    payload = minisoap.createSoapPayload(generic_confirm_element, soap_header_element)
-    return payload
+    fields = _headerFields(requester_nsa, provider_nsa, correlation_id)
+    fields['connection_id']   = _xmlText(connection_id, 'connectionId', required=False)
+    fields['notification_id'] = _xmlText(notification_id, 'notificationId')
+    fields['timestamp']       = _xmlText(createXMLTime(timestamp), 'timeStamp')
+    fields['active']          = _xmlBoolean(active)
+    fields['version']         = _xmlText(version, 'version')
+    fields['consistent']      = _xmlBoolean(consistent)
+    return _DATA_PLANE_STATE_CHANGE_TEMPLATE % fields
 
 
 def createServiceException(err, provider_nsa, connection_id=None, service_type=None):
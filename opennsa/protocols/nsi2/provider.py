@@ -66,6 +66,18 @@ class Provider:
             return defer.succeed(None)
 
 
+    def reserveFailed(self, nsi_header, connection_id, connection_states, err):
+        try:
+            org_header = self.notifications.pop( (connection_id, RESERVE_RESPONSE) )
+            d = self.provider_client.reserveFailed(org_header.reply_to, org_header.requester_nsa, org_header.provider_nsa, org_header.correlation_id,
+                                                   connection_id, connection_states, err)
+            d.addErrback(logError, 'reserveFailed')
+            return d
+        except KeyError, e:
+            log.msg('No entity to notify about reserveFailed for %s' % connection_id, system=LOG_SYSTEM)
+            return defer.succeed(None)
+
+
     def reserveCommit(self, nsi_header, connection_id):
 
         if nsi_header.reply_to:
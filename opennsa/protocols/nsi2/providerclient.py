@@ -20,12 +20,7 @@ class ProviderClient:
 
     def _genericConfirm(self, element_name, requester_url, action, correlation_id, requester_nsa, provider_nsa, connection_id):
 
-        header_element = helper.createHeader(requester_nsa, provider_nsa, correlation_id=correlation_id)
-
-        confirm = nsiconnection.GenericConfirmedType(connection_id)
-        body_element   = confirm.xml(element_name)
-
-        payload = minisoap.createSoapPayload(body_element, header_element)
+        payload = helper.createGenericConfirmed(element_name, requester_nsa, provider_nsa, correlation_id, connection_id)
 
         def gotReply(data):
             # for now we just ignore this, as long as we get an okay
@@ -165,14 +160,8 @@ class ProviderClient:
     def dataPlaneStateChange(self, requester_url, requester_nsa, provider_nsa, correlation_id,
                              connection_id, notification_id, timestamp, active, version, consistent):
 
-        header_element = helper.createHeader(requester_nsa, provider_nsa, correlation_id=correlation_id)
-
-        data_plane_status = nsiconnection.DataPlaneStatusType(active, version, consistent)
-        dps = nsiconnection.DataPlaneStateChangeRequestType(connection_id, notification_id, helper.createXMLTime(timestamp), data_plane_status)
-
-        body_element = dps.xml(nsiconnection.dataPlaneStateChange)
-
-        payload = minisoap.createSoapPayload(body_element, header_element)
+        payload = helper.createDataPlaneStateChange(requester_nsa, provider_nsa, correlation_id,
+                                                    connection_id, notification_id, timestamp, active, version, consistent)
 
         d = httpclient.soapRequest(requester_url, actions.DATA_PLANE_STATE_CHANGE, payload, ctx_factory=self.ctx_factory)
         return d
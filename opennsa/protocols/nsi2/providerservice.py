@@ -115,14 +115,7 @@ class ProviderService:
         d = self.provider.reserve(header, reservation.connectionId, reservation.globalReservationId, reservation.description, crt)
 
         def createReserveAcknowledgement(connection_id):
-            soap_header = nsiframework.CommonHeaderType(cnt.CS2_SERVICE_TYPE, header.correlation_id, header.requester_nsa, header.provider_nsa, None, header.session_security_attrs)
-            soap_header_element = soap_header.xml(nsiframework.nsiHeader)
-
-            reserve_response = nsiconnection.ReserveResponseType(connection_id)
-            reserve_response_element = reserve_response.xml(nsiconnection.reserveResponse)
-
-            payload = minisoap.createSoapPayload(reserve_response_element, soap_header_element)
-            return payload
+            return helper.createReserveResponse(header, connection_id)
 
 
         d.addCallbacks(createReserveAcknowledgement, self._createSOAPFault, errbackArgs=(header.provider_nsa,))
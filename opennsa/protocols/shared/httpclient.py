@@ -1,21 +1,38 @@
 """
 A nice handy HTTP client.
 
+Requests are made with HTTP/1.1 over persistent connections, which are kept
+in a pool shared by all requests. Sending a message to a host which has
+recently been talked to, does not need a new TCP (and TLS) handshake.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
+from StringIO import StringIO
+
+from zope.interface import implementer
+
+from OpenSSL import SSL
+
 from twisted.python import log
-from twisted.internet import reactor, defer
-from twisted.web import client as twclient, http as twhttp
+from twisted.internet import reactor, defer, protocol, abstract
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.web import client as twclient, http as twhttp, iweb
+from twisted.web.http_headers import Headers
 from twisted.web.error import Error as WebError
 from twisted.internet.error import ConnectionClosed, ConnectionRefusedError
 
+from opennsa import logging
+
 
 LOG_SYSTEM = 'HTTPClient'
 
 DEFAULT_TIMEOUT = 30 # seconds
 
+MAX_CONNECTIONS_PER_HOST = 8  # max number of requests in progress to a host, further requests are queued
+IDLE_TIMEOUT             = 30 # seconds, idle connections are closed before the server is likely to close them
+
 
 
 class HTTPRequestError(Exception):
@@ -24,6 +41,132 @@ class HTTPRequestError(Exception):
     """
 
 
+
+@implementer(iweb.IPolicyForHTTPS)
+class TLSPolicy:
+    """
+    Creates TLS connections with the context from one of our context factories.
+    The TLS session of the last connection to a host is offered when making
+    a new connection to it, so only an abbreviated handshake is needed.
+    """
+    def __init__(self, ctx_factory):
+        self.ctx_factory = ctx_factory
+        self.connections = {} # ( host, port ) -> last SSL.Connection to the host
+
+
+    def creatorForNetloc(self, hostname, port):
+        return TLSConnectionCreator(self, hostname, port)
+
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class TLSConnectionCreator:
+
+    def __init__(self, policy, hostname, port):
+        self.policy = policy
+        self.hostname = hostname
+        self.port = port
+
+
+    def clientConnectionForTLS(self, tls_protocol):
+        connection = SSL.Connection(self.policy.ctx_factory.getContext(), None)
+        connection.set_app_data(tls_protocol)
+        if not (abstract.isIPAddress(self.hostname) or abstract.isIPv6Address(self.hostname)):
+            connection.set_tlsext_host_name(self.hostname)
+
+        previous = self.policy.connections.get( (self.hostname, self.port) )
+        if previous is not None:
+            session = previous.get_session()
+            if session is not None:
+                connection.set_session(session)
+        self.policy.connections[ (self.hostname, self.port) ] = connection
+        return connection
+
+
+
+class HTTPClient:
+    """
+    Agents sharing a connection pool, and a limit on the number of requests
+    in progress to each host.
+    """
+    def __init__(self):
+        self.pool = twclient.HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = MAX_CONNECTIONS_PER_HOST
+        self.pool.cachedConnectionTimeout = IDLE_TIMEOUT
+        self.agents = {} # context factory -> Agent, None is for http
+        self.host_semaphores = {} # ( scheme, host, port ) -> DeferredSemaphore
+
+
+    def getAgent(self, ctx_factory):
+        if not ctx_factory in self.agents:
+            if ctx_factory is None:
+                self.agents[ctx_factory] = twclient.Agent(reactor, pool=self.pool)
+            else:
+                self.agents[ctx_factory] = twclient.Agent(reactor, contextFactory=TLSPolicy(ctx_factory), pool=self.pool)
+        return self.agents[ctx_factory]
+
+
+    def request(self, url, method, headers, payload, timeout, ctx_factory, handleResponse):
+        # handleResponse gets the response, and must read the entire body, so the connection can be reused
+
+        uri = twclient.URI.fromBytes(url)
+        if uri.scheme == 'https' and ctx_factory is None:
+            return defer.fail(HTTPRequestError('Cannot perform https request without context factory'))
+
+        agent = self.getAgent(ctx_factory if uri.scheme == 'https' else None)
+
+        request_headers = Headers( { 'User-Agent' : [ 'OpenNSA/Twisted' ] } )
+        for header, value in headers.items():
+            request_headers.setRawHeaders(header, [ value ])
+
+        def sendRequest():
+            body_producer = twclient.FileBodyProducer(StringIO(payload)) if payload is not None else None
+            return agent.request(method, url, request_headers, body_producer)
+
+        def retryNotSent(err):
+            # a pooled connection can be closed before the request is sent on it, it is safe to send it again then
+            # requests which were sent, but got no reply, are not resent, as the server may have processed them,
+            # and the soap requests (reserve, terminate, etc.) are not idempotent (the pool itself retries idempotent
+            # requests without a body, i.e., downloads)
+            err.trap(twclient.RequestNotSent)
+            log.msg('Connection to %s closed before sending request, resending it' % url, debug=True, system=LOG_SYSTEM)
+            return sendRequest()
+
+        def doRequest():
+            d = sendRequest()
+            d.addErrback(retryNotSent)
+            d.addCallback(handleResponse)
+            d.addTimeout(timeout, reactor)
+            return d
+
+        key = (uri.scheme, uri.host, uri.port)
+        if not key in self.host_semaphores:
+            self.host_semaphores[key] = defer.DeferredSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return self.host_semaphores[key].run(doRequest)
+
+
+    def closeConnections(self):
+        return self.pool.closeCachedConnections()
+
+
+
+_client = None
+
+def getClient():
+    global _client
+    if _client is None:
+        _client = HTTPClient()
+    return _client
+
+
+def closeConnections():
+    # closes the idle pooled connections, returns a deferred which fires when they are closed
+    if _client is None:
+        return defer.succeed(None)
+    return _client.closeConnections()
+
+
+
 def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_factory=None, headers=None):
 
     if not headers:
@@ -36,52 +179,65 @@ def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_fa
 
 
 
-def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None):
-    # copied from twisted.web.client in order to get access to the
-    # factory (which contains response codes, headers, etc)
+def _checkURL(url):
 
     if type(url) is not str:
-        e = HTTPRequestError('URL must be string, not %s' % type(url))
-        return defer.fail(e)
+        return HTTPRequestError('URL must be string, not %s' % type(url))
 
     if not url.startswith('http'):
-        e = HTTPRequestError('URL does not start with http (URL %s)' % (url))
-        return defer.fail(e)
+        return HTTPRequestError('URL does not start with http (URL %s)' % (url))
 
-    log.msg(" -- Sending Payload to %s --\n%s\n -- END. Sending Payload --" % (url, payload), system=LOG_SYSTEM, payload=True)
 
-    scheme, netloc, _ , _, _, _ = twhttp.urlparse(url)
-    if not ':' in netloc:
-        host = netloc
-        port = 80 if scheme == 'http' else 443
-    else:
-        host, s_port = netloc.split(':',1)
-        port = int(s_port)
 
-    factory = twclient.HTTPClientFactory(url, method, postdata=payload, timeout=timeout)
-    factory.noisy = False # stop spewing about factory start/stop
-    factory.protocol.handleStatus_204 = lambda _ : None # 204 is an ok reply, needed by NCS VPN backend
+def _readBody(response):
+    # servers without content-length or chunking end the body by closing, which is fine here
+    def partialBody(err):
+        err.trap(twclient.PartialDownloadError)
+        return err.value.response
 
-    # fix missing port in header (bug in twisted.web.client)
-    factory.headers['host'] = host + ':' + str(port)
-    factory.headers['User-Agent'] = 'OpenNSA/Twisted'
+    d = twclient.readBody(response)
+    d.addErrback(partialBody)
+    return d
 
-    for header, value in headers.items():
-        factory.headers[header] = value
 
-    if scheme == 'https':
-        if ctx_factory is None:
-            return defer.fail(HTTPRequestError('Cannot perform https request without context factory'))
-        reactor.connectSSL(host, port, factory, ctx_factory)
-    else:
-        reactor.connectTCP(host, port, factory)
+
+def _checkStatus(body, response):
+    # 2xx replies are ok (204 is needed by NCS VPN backend), everything else is an error
+    if 200 <= response.code < 300:
+        return body
+    raise WebError(str(response.code), response.phrase, body)
+
+
+
+def _connectionClosed(err):
+    # true if the connection closed (both directly and from the http client)
+    if err.check(ConnectionClosed):
+        return True
+    if err.check(twclient.ResponseNeverReceived, twclient.ResponseFailed, twclient.RequestTransmissionFailed):
+        return all( [ r.check(ConnectionClosed) for r in err.value.reasons ] )
+    return False
+
+
+
+def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None):
+
+    e = _checkURL(url)
+    if e:
+        return defer.fail(e)
+
+    logging.logPayload(LOG_SYSTEM, payload, 'Sending Payload to %s', url)
+
+    def gotResponse(response):
+        d = _readBody(response)
+        d.addCallback(_checkStatus, response)
+        return d
 
     def invocationError(err):
-        if isinstance(err.value, ConnectionClosed): # note: this also includes ConnectionDone and ConnectionLost
+        if _connectionClosed(err): # note: this also includes ConnectionDone and ConnectionLost
             pass # these are pretty common when the remote shuts down
         elif isinstance(err.value, WebError):
             data = err.value.response
-            log.msg(' -- Received Reply (fault) --\n%s\n -- END. Received Reply (fault) --' % data, system=LOG_SYSTEM, payload=True)
+            logging.logPayload(LOG_SYSTEM, data, 'Received Reply (fault)')
             return err
         elif isinstance(err.value, ConnectionRefusedError):
             log.msg('Connection refused while issuing http request to %s' % url, system=LOG_SYSTEM)
@@ -90,10 +246,71 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
             return err
 
     def logReply(data):
-        log.msg(" -- Received Reply --\n%s\n -- END. Received Reply --" % data, system=LOG_SYSTEM, payload=True)
+        logging.logPayload(LOG_SYSTEM, data, 'Received Reply')
         return data
 
-    factory.deferred.addCallbacks(logReply, invocationError)
+    d = getClient().request(url, method, headers, payload, timeout, ctx_factory, gotResponse)
+    d.addCallbacks(logReply, invocationError)
+    return d
+
+
+
+class _ConsumerProtocol(protocol.Protocol):
+    # gives the body of a response to a consumer
+
+    def __init__(self, consumer, finished):
+        self.consumer = consumer
+        self.finished = finished
+
+
+    def dataReceived(self, data):
+        self.consumer.write(data)
+
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return # cancelled
+        if reason.check(twclient.ResponseDone, twhttp.PotentialDataLoss):
+            self.consumer.close()
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
+
+def httpDownload(url, consumer, headers=None, timeout=DEFAULT_TIMEOUT, ctx_factory=None):
+    """
+    Retrieve url with a GET request. The body is not kept, but given to the
+    consumer as it arrives, by calling consumer.write(data) for each part
+    and consumer.close() at the end. If the consumer has a headersReceived
+    method, it is called with the response headers before the body is
+    delivered, e.g., for the content encoding. Returns a deferred, which fires with
+    the response headers when the body has been delivered, or with None if
+    the server replied 304 Not Modified to a conditional request.
+    Response header names are lower case, and each has a list of values.
+    """
+    e = _checkURL(url)
+    if e:
+        return defer.fail(e)
+
+    log.msg('Downloading %s' % url, debug=True, system=LOG_SYSTEM)
+
+    def gotResponse(response):
+        if response.code == twhttp.NOT_MODIFIED:
+            log.msg('%s not modified' % url, debug=True, system=LOG_SYSTEM)
+            return _readBody(response).addCallback(lambda _ : None)
+
+        if not 200 <= response.code < 300:
+            return _readBody(response).addCallback(_checkStatus, response)
 
-    return factory.deferred
+        response_headers = dict( [ (name.lower(), values) for name, values in response.headers.getAllRawHeaders() ] )
+        if hasattr(consumer, 'headersReceived'):
+            consumer.headersReceived(response_headers)
+        consumer_protocol = _ConsumerProtocol(consumer, None)
+        finished = defer.Deferred(lambda _ : consumer_protocol.transport.stopProducing())
+        consumer_protocol.finished = finished
+        response.deliverBody(consumer_protocol)
+        finished.addCallback(lambda _ : response_headers)
+        return finished
 
+    return getClient().request(url, 'GET', headers or {}, None, timeout, ctx_factory, gotResponse)
@@ -21,23 +21,6 @@ SOAP_FAULT              = ET.QName("{%s}Fault"      % SOAP_ENVELOPE_NS)
 ET.register_namespace('soap', SOAP_ENVELOPE_NS)
 
 
-def _indent(elem, level=0):
-    i = "\n" + level*"   "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "   "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            _indent(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-
-
-
 def createSoapEnvelope():
 
     envelope = ET.Element(SOAP_ENV)
@@ -49,6 +32,7 @@ def createSoapEnvelope():
 
 
 def createSoapPayload(body_element=None, header_element=None):
+    # payloads are compact on the wire, logging.logPayload indents the logged copy
 
     envelope, header, body = createSoapEnvelope()
 
@@ -60,7 +44,6 @@ def createSoapPayload(body_element=None, header_element=None):
         else:
             body.append(body_element)
 
-    _indent(envelope)
     payload = ET.tostring(envelope, 'utf-8')
 
     return payload
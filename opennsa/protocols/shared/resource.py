@@ -9,6 +9,8 @@ from twisted.python import log
 from twisted.internet import defer
 from twisted.web import resource, server
 
+from opennsa import logging
+
 from xml.sax.saxutils import escape as xml_escape
 
 
@@ -91,7 +93,7 @@ class SOAPResource(resource.Resource):
         soap_action = request.requestHeaders.getRawHeaders('soapaction',[None])[0]
 
         soap_data = request.content.read()
-        log.msg(" -- Received payload --\n%s\n -- END. Received payload --" % soap_data, system=LOG_SYSTEM, payload=True)
+        logging.logPayload(LOG_SYSTEM, soap_data, 'Received payload')
 
         if not soap_action in self.soap_actions:
             log.msg('Got request with unknown SOAP action: %s' % soap_action, system=LOG_SYSTEM)
@@ -109,7 +111,7 @@ class SOAPResource(resource.Resource):
             if reply_data is None or len(reply_data) == 0:
                 log.msg('None/empty reply data supplied for SOAPResource. This is probably wrong', system=LOG_SYSTEM)
             else:
-                log.msg(" -- Sending response --\n%s\n -- END: Sending response --" % reply_data, system=LOG_SYSTEM, payload=True)
+                logging.logPayload(LOG_SYSTEM, reply_data, 'Sending response')
 
             request.setHeader('Content-Type', 'text/xml') # Keeps some SOAP implementations happy
             request.write(reply_data)
@@ -122,7 +124,7 @@ class SOAPResource(resource.Resource):
             log.msg('SOAP Payload that caused error:\n%s\n' % soap_data)
             error_payload = SOAPFault(err.getErrorMessage()).createPayload()
 
-            log.msg(" -- Sending response (fault) --\n%s\n -- END: Sending response (fault) --" % error_payload, system=LOG_SYSTEM, payload=True)
+            logging.logPayload(LOG_SYSTEM, error_payload, 'Sending response (fault)')
 
             request.setResponseCode(500) # Internal server error
             request.setHeader('Content-Type', 'text/xml')
@@ -9,7 +9,7 @@ from twisted.web import resource, server
 from twisted.application import internet, service as twistedservice
 
 from opennsa import config, logging, constants as cnt, nsa, provreg, database, aggregator, viewresource
-from opennsa.topology import nrmparser, nml, http as nmlhttp, fetcher
+from opennsa.topology import nrmparser, nml, http as nmlhttp, fetcher, cache
 from opennsa.protocols import nsi2
 
 
@@ -134,6 +134,9 @@ class OpenNSAService(twistedservice.MultiService):
 
         provider_registry = provreg.ProviderRegistry({}, { cnt.CS2_SERVICE_TYPE : requester_creator.create } )
         aggr = aggregator.Aggregator(network_topology.id_, ns_agent, topology, None, provider_registry) # set parent requester later
+        aggr.probe_paths = vc[config.PROBE_PATHS]
+        aggr.reserve_attempts = vc[config.RESERVE_ATTEMPTS]
+        aggr.reserve_time_budget = vc[config.RESERVE_TIME_BUDGET]
 
         requester_creator.aggregator = aggr
 
@@ -152,7 +155,9 @@ class OpenNSAService(twistedservice.MultiService):
 
         # fetcher
         if vc[config.PEERS]:
-            fetcher_service = fetcher.FetcherService(vc[config.PEERS], topology, provider_registry, ctx_factory=ctx_factory)
+            topology_cache = cache.TopologyCache(vc[config.TOPOLOGY_CACHE]) if vc[config.TOPOLOGY_CACHE] else None
+            fetcher_service = fetcher.FetcherService(vc[config.PEERS], topology, provider_registry, ctx_factory=ctx_factory,
+                                                     concurrency=vc[config.FETCH_CONCURRENCY], parse_threads=vc[config.PARSE_THREADS], cache=topology_cache)
             fetcher_service.setServiceParent(self)
 
         # wire up the http stuff
@@ -209,6 +214,7 @@ def createApplication(config_file=config.DEFAULT_CONFIG_FILE, debug=False, paylo
         nsa_service = OpenNSAService(vc)
         nsa_service.setServiceParent(application)
 
+        logging.setPayloadLogging(payload)
         application.setComponent(log.ILogObserver, logging.DebugLogObserver(log_file, debug, payload=payload).emit)
         return application
 
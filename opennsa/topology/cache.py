@@ -0,0 +1,97 @@
+"""
+On-disk cache of peer topologies.
+
+Keeps the topologies fetched from peers, so they can be used right after a
+restart, instead of after the first round of fetches. The topologies are
+stored as pickled NML objects, so nothing has to be parsed when loading.
+Each peer has its own file in the cache directory, so a changed topology
+only rewrites the file of that peer.
+"""
+
+import os
+import errno
+import urllib
+import cPickle
+import threading
+
+from twisted.python import log
+
+
+LOG_SYSTEM = 'topology.Cache'
+
+CACHE_FORMAT = 2 # bump when the NML classes change in an incompatible way
+CACHE_SUFFIX = '.topology'
+
+# what loading a pickle from another version, or a damaged file, tends to raise
+UNPICKLE_ERRORS = (cPickle.UnpicklingError, EOFError, ValueError, TypeError, IndexError, KeyError, AttributeError, ImportError)
+
+
+
+class TopologyCache:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def filename(self, network_name):
+        return os.path.join(self.directory, urllib.quote(network_name, safe='') + CACHE_SUFFIX)
+
+
+    def load(self):
+        # returns { network name : ( nsi agent, network, validators ) }, files which cannot be used are discarded
+        try:
+            filenames = [ fn for fn in os.listdir(self.directory) if fn.endswith(CACHE_SUFFIX) ]
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.msg('Error reading topology cache directory %s. Reason: %s' % (self.directory, str(e)), system=LOG_SYSTEM)
+            return {}
+
+        entries = {}
+        for fn in filenames:
+            filename = os.path.join(self.directory, fn)
+            try:
+                with open(filename, 'rb') as f:
+                    cache_format, network_name, entry = cPickle.load(f)
+            except IOError as e:
+                log.msg('Error reading topology cache file %s. Reason: %s' % (filename, str(e)), system=LOG_SYSTEM)
+                continue
+            except UNPICKLE_ERRORS as e:
+                log.msg('Error loading topology cache file %s, discarding it. Reason: %s' % (filename, str(e)), system=LOG_SYSTEM)
+                self.discard(filename)
+                continue
+
+            if cache_format != CACHE_FORMAT:
+                log.msg('Topology cache file %s has format %s, expected %s, discarding it' % (filename, cache_format, CACHE_FORMAT), system=LOG_SYSTEM)
+                self.discard(filename)
+                continue
+
+            entries[network_name] = entry
+
+        return entries
+
+
+    def save(self, network_name, entry):
+        # does blocking io, so should be called in a thread
+        # write to a temporary file first, so a crash cannot leave a partial file behind
+        filename = self.filename(network_name)
+        tmp_filename = '%s.%i.tmp' % (filename, threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp_filename, 'wb') as f:
+                cPickle.dump( (CACHE_FORMAT, network_name, entry), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError, cPickle.PicklingError) as e:
+            log.msg('Error saving topology cache file %s. Reason: %s' % (filename, str(e)), system=LOG_SYSTEM)
+
+
+    def remove(self, network_name):
+        self.discard(self.filename(network_name))
+
+
+    def discard(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.msg('Error removing topology cache file %s. Reason: %s' % (filename, str(e)), system=LOG_SYSTEM)
@@ -1,9 +1,11 @@
 # Fetches topology representations from other
 
-import StringIO
+import zlib
+import time
+import random
 
-from twisted.python import log
-from twisted.internet import defer, task, reactor
+from twisted.python import log, threadpool
+from twisted.internet import defer, reactor, threads
 from twisted.application import service
 
 from opennsa.protocols.shared import httpclient
@@ -12,13 +14,143 @@ from opennsa.topology import nmlxml
 
 LOG_SYSTEM = 'topology.Fetcher'
 
-FETCH_INTERVAL = 1200 # seconds
+FETCH_INTERVAL    = 1200 # seconds
+FETCH_TIMEOUT     = 10   # seconds
+FETCH_CONCURRENCY = 10   # max number of topology fetches in progress at the same time
+PARSE_THREADS     = 2    # max number of threads parsing topologies
+FETCH_JITTER      = 0.1  # intervals are varied up to this fraction, so the peers get spread out over time
+BACKOFF_START     = 60   # seconds, delay after a failed fetch, doubled for each failure in a row
+BACKOFF_MAX       = 7200 # seconds
+
+
+
+class TopologyConsumer:
+    """
+    Parses a topology document as it is being downloaded. Each part is fed to
+    the parser in a worker thread as it arrives, one part at a time and in
+    order, so parsing a large document does not stall the reactor, and only
+    the parts waiting for the parser are kept in memory.
+    """
+    def __init__(self, parse_pool):
+        self.parse_pool = parse_pool
+        self.parser = nmlxml.NSITopologyParser()
+        self.decompressor = None # set if the document is gzip encoded
+        self.size = 0
+        self.parse_time = 0 # seconds spent parsing
+        self.complete = False
+        self.error = None # failure from the parser, the rest of the document is not parsed
+        self.feeding = defer.succeed(None) # fires when the parts written so far have been parsed
+
+
+    def headersReceived(self, headers):
+        if 'gzip' in [ ce.lower() for ce in headers.get('content-encoding', []) ]:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+    def write(self, data):
+        self.size += len(data)
+        self.feeding.addCallback(self._feedPart, data)
+
+
+    def close(self):
+        self.complete = True
+
+
+    def _feedPart(self, _, data):
+        if self.error is not None:
+            return
+        d = threads.deferToThreadPool(reactor, self.parse_pool, self._feed, data)
+        d.addErrback(self._feedFailed)
+        return d
+
+
+    def _feedFailed(self, err):
+        self.error = err
+
+
+    def _feed(self, data):
+        # runs in the parse pool, parts are never fed concurrently
+        start_time = time.time()
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.parser.feed(data)
+        self.parse_time += time.time() - start_time
+
+
+    def _finish(self):
+        # runs in the parse pool
+        start_time = time.time()
+        if self.decompressor is not None:
+            self.parser.feed(self.decompressor.flush())
+        topology = self.parser.close()
+        self.parse_time += time.time() - start_time
+        return topology
+
+
+    def parse(self):
+        # returns a deferred, which fires with (nsi agent, network) when the rest of the document has been parsed
+        if not self.complete:
+            return defer.fail(ValueError('Topology document is incomplete'))
+
+        def finish(_):
+            if self.error is not None:
+                return self.error
+            return threads.deferToThreadPool(reactor, self.parse_pool, self._finish)
+
+        return self.feeding.addCallback(finish)
+
+
+
+class PeerStatistics:
+    """
+    Fetch metrics for a single peer. Latencies are in seconds, the fetch
+    latency covers the entire fetch, the parse latency only the parsing.
+    """
+    def __init__(self):
+        self.fetches = 0
+        self.not_modified = 0
+        self.failures = 0 # failures in a row, reset by a successful fetch
+        self.total_failures = 0
+        self.fetch_latency = None # last fetch
+        self.parse_latency = None # last fetch
+        self.total_fetch_time = 0
+        self.total_parse_time = 0
+
+
+    def fetched(self, fetch_latency, parse_latency):
+        self.fetches += 1
+        self.failures = 0
+        self.fetch_latency = fetch_latency
+        self.parse_latency = parse_latency
+        self.total_fetch_time += fetch_latency
+        self.total_parse_time += parse_latency
+
+
+    def notModified(self, fetch_latency):
+        self.not_modified += 1
+        self.failures = 0
+        self.fetch_latency = fetch_latency
+
+
+    def failed(self):
+        self.failures += 1
+        self.total_failures += 1
+
+
+    def averageFetchLatency(self):
+        if self.fetches:
+            return self.total_fetch_time / self.fetches
+
+
+    def averageParseLatency(self):
+        if self.fetches:
+            return self.total_parse_time / self.fetches
 
 
 
 class FetcherService(service.Service):
 
-    def __init__(self, peering_entries, topology, provider_registry, ctx_factory=None):
+    def __init__(self, peering_entries, topology, provider_registry, ctx_factory=None, concurrency=FETCH_CONCURRENCY, parse_threads=PARSE_THREADS, cache=None):
         # peering entries is a list of two-tuples, where each tuple contains
         # a network name and the url of the network topology
         #for network, topo_url in peering_pairs:
@@ -26,74 +158,194 @@ class FetcherService(service.Service):
             assert len(pe) is 2, 'Peering entry %s is not two-tuple' % pe
             network, topo_url = pe
             assert topo_url.startswith('http'), 'Topology URL %s does not start with http' % topo_url
+        assert concurrency >= 1, 'Fetch concurrency must be at least 1'
+        assert parse_threads >= 1, 'Number of parse threads must be at least 1'
 
         self.peering_entries = peering_entries
         self.topology = topology
         self.provider_registry = provider_registry
         self.ctx_factory = ctx_factory
+        self.cache = cache # TopologyCache or None
 
-        self.blacklist = {}
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.parse_pool = threadpool.ThreadPool(0, parse_threads, 'TopologyParser')
+        self.jitter = FETCH_JITTER
+        self.clock = reactor
 
-        self.call = task.LoopingCall(self.fetchTopologies)
+        self.calls = {} # network name -> delayed call for the next fetch
+        self.validators = {} # network name -> { request header : value }, for conditional requests
+        self.statistics = dict( [ (network_name, PeerStatistics()) for network_name, _ in peering_entries ] )
 
 
     def startService(self):
-        reactor.callWhenRunning(self.call.start, FETCH_INTERVAL)
+        self.parse_pool.start()
+        if self.cache is not None:
+            self.loadCache()
+        reactor.callWhenRunning(self.scheduleFetches)
         service.Service.startService(self)
 
 
     def stopService(self):
-        self.call.stop()
-        for delayed_call in self.blacklist.values():
-            delayed_call.cancel()
+        for delayed_call in self.calls.values():
+            if delayed_call.active():
+                delayed_call.cancel()
+        self.calls = {}
+        self.parse_pool.stop()
         service.Service.stopService(self)
 
 
-    def blacklistNetwork(self, network_name, seconds=7200): # 7200 seconds = 2 hours
-        # blacklist a network for a certain amount of time
-        delayed_call = reactor.callLater(seconds, self.blacklist.pop, network_name)
-        self.blacklist[network_name] = delayed_call
-        log.msg('Network %s blacklisted from topology retrieval for %i seconds' % (network_name, seconds), system=LOG_SYSTEM)
+    def loadCache(self):
+        # cached topologies are put in place right away, and replaced by the fetches when they change
+        # this is done before the reactor runs, so reading the files here does not stall anything
+        peer_names = set( [ network_name for network_name, _ in self.peering_entries ] )
+        loaded = 0
+        for network_name, entry in self.cache.load().items():
+            if network_name not in peer_names:
+                self.cache.remove(network_name) # peer is no longer configured
+                continue
+            try:
+                nsi_agent, nml_network, validators = entry
+                self.topology.updateNetwork(nml_network, nsi_agent)
+            except Exception as e:
+                # objects pickled by an older version can fail in pretty much any way
+                log.msg('Error loading cached topology for %s, discarding it. Reason: %s' % (network_name, str(e)), system=LOG_SYSTEM)
+                self.cache.remove(network_name)
+                continue
+            self.provider_registry.spawnProvider(nsi_agent)
+            self.validators[network_name] = validators
+            loaded += 1
+
+        log.msg('Loaded %i topologies from cache' % loaded, system=LOG_SYSTEM)
+
+
+    def scheduleFetches(self):
+        # every peer is fetched right away, the concurrency limit keeps the load down,
+        # and the jittered intervals spread the subsequent fetches out
+        for network_name, topology_url in self.peering_entries:
+            self.scheduleFetch(network_name, topology_url, 0)
+
+
+    def scheduleFetch(self, network_name, topology_url, delay):
+        # replaces any pending fetch of the peer
+        delayed_call = self.calls.get(network_name)
+        if delayed_call is not None and delayed_call.active():
+            delayed_call.cancel()
+        self.calls[network_name] = self.clock.callLater(delay, self.scheduledFetch, network_name, topology_url)
+
+
+    def scheduledFetch(self, network_name, topology_url):
+
+        def fetchError(err):
+            # fetch errors are handled further down, so this is a bug, but the peer must still be fetched again
+            log.msg('Unexpected error fetching topology for %s: %s' % (network_name, err.getErrorMessage()), system=LOG_SYSTEM)
+            log.err(err)
+            self.statistics[network_name].failed()
+
+        def fetchDone(_):
+            if self.running:
+                delay = self.nextDelay(network_name)
+                log.msg('Next topology fetch for %s in %i seconds' % (network_name, delay), debug=True, system=LOG_SYSTEM)
+                self.scheduleFetch(network_name, topology_url, delay)
 
+        d = self.fetchTopology(network_name, topology_url)
+        d.addErrback(fetchError)
+        d.addBoth(fetchDone)
+        return d
 
-    def getPeeringEntries(self):
-        # filters out the blacklisted sites - returns non-blacklisted entries
-        return [ (nw, tu) for nw, tu in self.peering_entries if nw not in self.blacklist ]
+
+    def nextDelay(self, network_name):
+        # regular interval, or exponential backoff after failures
+        failures = self.statistics[network_name].failures
+        if failures:
+            delay = min(BACKOFF_START * 2 ** (failures - 1), BACKOFF_MAX)
+        else:
+            delay = FETCH_INTERVAL
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
 
 
     def fetchTopologies(self):
-        log.msg('Fetching topologies. %i sources, %i blacklisted' % (len(self.peering_entries), len(self.blacklist)), system=LOG_SYSTEM)
+        # fetch all topologies now, still within the concurrency limit
+        log.msg('Fetching topologies. %i sources' % len(self.peering_entries), system=LOG_SYSTEM)
+        defs = [ self.fetchTopology(network_name, topology_url) for network_name, topology_url in self.peering_entries ]
+        return defer.DeferredList(defs)
+
+
+    def fetchTopology(self, network_name, topology_url):
+        # the returned deferred fires with None when the fetch is done, errors are handled here
+        return self.semaphore.run(self.retrieveTopology, network_name, topology_url)
 
-        defs = []
-        for network_name, topology_url in self.getPeeringEntries():
-            log.msg('Fetchin topology for network %s from %s' % (network_name, topology_url), debug=True, system=LOG_SYSTEM)
-            d = httpclient.httpRequest(topology_url, '', {}, 'GET', timeout=10, ctx_factory=self.ctx_factory)
-            ca = (network_name, topology_url)
-            d.addCallbacks(self.gotTopology, self.retrievalFailed, callbackArgs=ca, errbackArgs=ca)
-            defs.append(d)
 
-        if defs:
-            return defer.DeferredList(defs)
+    def retrieveTopology(self, network_name, topology_url):
+        log.msg('Fetching topology for network %s from %s' % (network_name, topology_url), debug=True, system=LOG_SYSTEM)
+        consumer = TopologyConsumer(self.parse_pool)
+        headers = self.validators.get(network_name, {}).copy()
+        headers['Accept-Encoding'] = 'gzip'
+        start_time = self.clock.seconds()
+        d = httpclient.httpDownload(topology_url, consumer, headers, timeout=FETCH_TIMEOUT, ctx_factory=self.ctx_factory)
+        ca = (consumer, network_name, topology_url, start_time)
+        ea = (network_name, topology_url)
+        d.addCallbacks(self.gotTopology, self.retrievalFailed, callbackArgs=ca, errbackArgs=ea)
+        return d
 
 
-    def gotTopology(self, result, network_name, topology_url):
-        log.msg('Got topology for %s (%i bytes)' % (network_name, len(result)), debug=True, system=LOG_SYSTEM)
+    def gotTopology(self, response_headers, consumer, network_name, topology_url, start_time):
+        stats = self.statistics[network_name]
+        if response_headers is None:
+            log.msg('Topology for %s not modified' % network_name, debug=True, system=LOG_SYSTEM)
+            stats.notModified(self.clock.seconds() - start_time)
+            return
+
+        log.msg('Got topology for %s (%i bytes)' % (network_name, consumer.size), debug=True, system=LOG_SYSTEM)
+        # here we should let the parser know that it should not go outside the network name when parsing - later man...
+        d = consumer.parse()
+        ca = (response_headers, consumer, network_name, topology_url, start_time)
+        ea = (network_name, topology_url)
+        d.addCallbacks(self.topologyParsed, self.parseFailed, callbackArgs=ca, errbackArgs=ea)
+        return d
+
+
+    def topologyParsed(self, topology, response_headers, consumer, network_name, topology_url, start_time):
+        # back in the reactor thread, so the network can be swapped in without anyone seeing a partial update
+        nsi_agent, nml_network = topology
         try:
-            # here we should let the parser know that it should not go outside the network name when parsing - later man...
-            nsi_agent, nml_network = nmlxml.parseNSITopology(StringIO.StringIO(result))
-            # here we could do some version checking first
+            # only the changed ports are replaced, so an unchanged topology does not disturb anything
             self.topology.updateNetwork(nml_network, nsi_agent)
             log.msg('Topology for %s updated' % nml_network.name, system=LOG_SYSTEM)
             self.provider_registry.spawnProvider(nsi_agent)
+            self.validators[network_name] = self.getValidators(response_headers)
+            self.statistics[network_name].fetched(self.clock.seconds() - start_time, consumer.parse_time)
+            if self.cache is not None:
+                # only this peer is written, and in the thread pool, as pickling a large topology takes a while
+                # networks are replaced, not changed, on updates, so it can be pickled outside the reactor thread
+                entry = (nsi_agent, self.topology.getNetwork(nml_network.id_), self.validators[network_name])
+                return threads.deferToThreadPool(reactor, self.parse_pool, self.cache.save, network_name, entry)
 
         except Exception as e:
-            log.msg('Error parsing topology for network %s, url %s. Reason %s' % (network_name, topology_url, str(e)), system=LOG_SYSTEM)
-            self.blacklistNetwork(network_name)
+            log.msg('Error updating topology for network %s, url %s. Reason %s' % (network_name, topology_url, str(e)), system=LOG_SYSTEM)
+            self.validators.pop(network_name, None)
+            self.statistics[network_name].failed()
             import traceback
             traceback.print_exc()
 
 
+    def parseFailed(self, err, network_name, topology_url):
+        log.msg('Error parsing topology for network %s, url %s. Reason %s' % (network_name, topology_url, err.getErrorMessage()), system=LOG_SYSTEM)
+        self.validators.pop(network_name, None)
+        self.statistics[network_name].failed()
+
+
+    def getValidators(self, response_headers):
+        # request headers for asking if the topology has changed since it was retrieved
+        # response header names are lower case, and each has a list of values
+        validators = {}
+        if 'last-modified' in response_headers:
+            validators['If-Modified-Since'] = response_headers['last-modified'][0]
+        if 'etag' in response_headers:
+            validators['If-None-Match'] = response_headers['etag'][0]
+        return validators
+
+
     def retrievalFailed(self, result, network_name, topology_url):
         log.msg('Topology retrieval failed for %s. Reason: %s. URL %s' % (network_name, result.getErrorMessage(), topology_url), system=LOG_SYSTEM)
-        self.blacklistNetwork(network_name)
+        self.statistics[network_name].failed()
 
@@ -6,6 +6,7 @@ Currently this means an XML representation of an NML topology.
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2013)
 """
+import zlib
 import datetime
 from xml.etree import ElementTree as ET
 
@@ -25,7 +26,15 @@ class TopologyResource(resource.Resource):
 
     RFC850_FORMAT       = '%a, %d %b %Y %H:%M:%S GMT'
     LAST_MODIFIED       = 'Last-modified'
+    ETAG                = 'ETag'
+    VARY                = 'Vary'
+    CONTENT_ENCODING    = 'Content-Encoding'
     IF_MODIFIED_SINCE   = 'if-modified-since'
+    IF_NONE_MATCH       = 'if-none-match'
+    ACCEPT_ENCODING     = 'accept-encoding'
+
+    GZIP                = 'gzip'
+    GZIP_LEVEL          = 9 # the representation is compressed once per version, so it might as well be small
 
     def __init__(self, nsi_agent, nml_network):
         resource.Resource.__init__(self)
@@ -37,29 +46,82 @@ class TopologyResource(resource.Resource):
 
 
     def updateRepresentation(self):
+        # the representations are made once for every network version, and then served as they are
         xml = nmlxml.nsiXML(self.nsi_agent, self.nml_network)
         self.topology_representation = ET.tostring(xml)
+        compressor = zlib.compressobj(self.GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip format
+        self.topology_representation_gzip = compressor.compress(self.topology_representation) + compressor.flush()
+
+        self.representation_version = self.nml_network.version
         self.topology_version = self.nml_network.version.replace(microsecond=0)
         self.topology_version_http = datetime.datetime.strftime(self.nml_network.version, self.RFC850_FORMAT)
+        # strong etags, so each representation has its own
+        self.etag      = '"%s"' % self.nml_network.version.strftime('%Y%m%dT%H%M%S.%f')
+        self.etag_gzip = '"%s-%s"' % (self.nml_network.version.strftime('%Y%m%dT%H%M%S.%f'), self.GZIP)
+
+
+    def acceptsGzip(self, request):
+        # true if the client accepts gzip content encoding, q=0 means it does not
+        ae_header = request.getHeader(self.ACCEPT_ENCODING)
+        if not ae_header:
+            return False
+        for coding in ae_header.split(','):
+            params = [ p.strip() for p in coding.split(';') ]
+            if params[0].lower() in (self.GZIP, 'x-gzip', '*'):
+                for param in params[1:]:
+                    name, _, value = param.partition('=')
+                    if name.strip() == 'q':
+                        try:
+                            return float(value) > 0
+                        except ValueError:
+                            return False
+                return True
+        return False
+
+
+    def notModified(self, request):
+        # if-none-match takes precedence over if-modified-since
+        inm_header = request.getHeader(self.IF_NONE_MATCH)
+        if inm_header:
+            etags = [ etag.strip() for etag in inm_header.split(',') ]
+            # weak comparison, any representation of the current version is fine
+            etags = [ etag[2:] if etag.startswith('W/') else etag for etag in etags ]
+            return '*' in etags or self.etag in etags or self.etag_gzip in etags
 
-
-    def render_GET(self, request):
-
-        # check for if-modified-since header, and send 304 back if it is not been modified
         msd_header = request.getHeader(self.IF_MODIFIED_SINCE)
         if msd_header:
             try:
                 msd = datetime.datetime.strptime(msd_header, self.RFC850_FORMAT)
-                if msd >= self.topology_version:
-                    log.msg('Topology request from %s. Provided IMS %s (after last modification), sending 304 reply.' % (request.getClient(), msd_header), system=LOG_SYSTEM)
-                    request.setResponseCode(304)
-                    return ''
+                return msd >= self.topology_version
             except ValueError:
                 pass # error parsing timestamp
 
-        log.msg('Topology request from %s. Sending %i bytes' % (request.getClient(), len(self.topology_representation)), system=LOG_SYSTEM)
+        return False
+
+
+    def render_GET(self, request):
+
+        if self.nml_network.version != self.representation_version:
+            self.updateRepresentation()
+
+        gzip = self.acceptsGzip(request)
 
         request.setHeader(self.LAST_MODIFIED, self.topology_version_http)
+        request.setHeader(self.ETAG, self.etag_gzip if gzip else self.etag)
+        request.setHeader(self.VARY, 'Accept-Encoding')
+
+        # check for if-none-match and if-modified-since headers, and send 304 back if it is not been modified
+        if self.notModified(request):
+            log.msg('Topology request from %s. Not modified, sending 304 reply.' % request.getClientAddress().host, system=LOG_SYSTEM)
+            request.setResponseCode(304)
+            return ''
+
+        if gzip:
+            request.setHeader(self.CONTENT_ENCODING, self.GZIP)
+            body = self.topology_representation_gzip
+        else:
+            body = self.topology_representation
 
-        return self.topology_representation
+        log.msg('Topology request from %s. Sending %i bytes%s' % (request.getClientAddress().host, len(body), ' (gzip)' if gzip else ''), system=LOG_SYSTEM)
 
+        return body
@@ -6,8 +6,11 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2013)
 """
 
+import sys
 import itertools
+import heapq
 import datetime
+import collections
 
 from twisted.python import log
 
@@ -21,6 +24,106 @@ EGRESS  = 'egress'
 
 URN_OGF_NETWORK = 'urn:ogf:network:'
 
+PATH_SEARCH_LIMIT        = 50000 # max number of hops to expand in a single path search
+PATH_CACHE_SIZE          = 1000  # number of path search results to keep
+UNIDIRECTIONAL_MAX_PATHS = 10    # paths found between unidirectional STPs, if max_paths is not given
+
+
+
+# path cost functions, they get the port used to leave a network (bidirectional port or outbound port)
+
+def hopCost(port):
+    return 1
+
+
+def bandwidthCost(port):
+    # prefer links with more bandwidth
+    if port.isBidirectional():
+        bandwidth = min(port.inbound_port.bandwidth, port.outbound_port.bandwidth)
+    else:
+        bandwidth = port.bandwidth
+    return 1.0 / max(1, bandwidth)
+
+
+def weightCost(weights, default=1):
+    # weights is a dict: port_id -> weight
+    cost = lambda port : weights.get(port.id_, default)
+    cost.cost_key = ('weightCost', tuple(sorted(weights.items())), default)
+    return cost
+
+
+def _costKey(cost):
+    # stable identifier of a cost function, for the path cache, None if there is none
+    # (a new lambda for each search would otherwise fill the cache with entries which are never hit)
+    cost_key = getattr(cost, 'cost_key', None)
+    if cost_key is not None:
+        return cost_key
+    module = sys.modules.get(getattr(cost, '__module__', None))
+    name = getattr(cost, '__name__', None)
+    if module is not None and name is not None and getattr(module, name, None) is cost:
+        return (cost.__module__, name) # module level function
+    return None
+
+
+
+def _labelsKey(labels):
+    # ports may have no labels, and labels may have no values (e.g., from an empty label group)
+    return tuple( [ (label.type_, tuple(label.values or ())) for label in labels or () ] )
+
+
+def _portKey(port):
+    # everything about a port which matters for the topology, used for finding changed ports
+    if port.isBidirectional():
+        return (port.id_, port.name, port.inbound_port.id_, port.outbound_port.id_)
+    return (type(port), port.id_, port.name, port.orientation, _labelsKey(port.labels()), port.remote_port, getattr(port, 'bandwidth', None))
+
+
+def _portUnits(network):
+    # ports which are replaced together: a bidirectional port and its unidirectional ports, or a lone unidirectional port
+    units = {}
+    grouped = set()
+    for port in network.bidirectional_ports:
+        units[port.id_] = (port, port.inbound_port, port.outbound_port)
+        grouped.update( [ port.inbound_port.id_, port.outbound_port.id_ ] )
+    for port in itertools.chain(network.inbound_ports, network.outbound_ports):
+        if port.id_ not in grouped:
+            units[port.id_] = (port,)
+    return units
+
+
+def _diffPorts(old_network, new_network):
+    # returns the ports to remove from the old network, and the ports to add from the new network
+    old_units = _portUnits(old_network)
+    new_units = _portUnits(new_network)
+
+    def changed(unit, other_unit):
+        return other_unit is None or [ _portKey(p) for p in unit ] != [ _portKey(p) for p in other_unit ]
+
+    removed = []
+    for unit_id, unit in old_units.items():
+        if changed(unit, new_units.get(unit_id)):
+            removed.extend(unit)
+    added = []
+    for unit_id, unit in new_units.items():
+        if changed(unit, old_units.get(unit_id)):
+            added.extend(unit)
+    return removed, added
+
+
+def _pathHops(last_hop):
+    # the hops of a path, first hop first
+    hops = []
+    while last_hop is not None:
+        hops.append(last_hop)
+        last_hop = last_hop[5]
+    hops.reverse()
+    return hops
+
+
+def _pathKey(last_hop):
+    # identifies the way a path goes, the key of a path prefix is a prefix of the path key
+    return tuple( [ (h[0], h[1].id_, h[4].id_ if h[4] else None) for h in _pathHops(last_hop) ] )
+
 
 
 class Port(object):
@@ -38,6 +141,7 @@ class Port(object):
         self.name           = name              # String  ; Base name, no network name or uri prefix
         self._labels        = labels            # [ nsa.Label ]  ; can be empty
         self.remote_port    = remote_port       # String
+        self.orientation    = None              # INGRESS or EGRESS, set when the port is added to a network
 
 
     def canMatchLabels(self, labels):
@@ -50,11 +154,7 @@ class Port(object):
         elif len(self._labels) == 1: # len(labels) is identical
             if self._labels[0].type_ != labels[0].type_:
                 return False
-            try:
-                self._labels[0].intersect(labels[0])
-                return True
-            except nsa.EmptyLabelSet:
-                return False
+            return self._labels[0].intersects(labels[0])
         else:
             raise NotImplementedError('Multi-label matching not yet implemented')
 
@@ -67,6 +167,10 @@ class Port(object):
         return self._labels
 
 
+    def canProvideBandwidth(self, desired_bandwidth):
+        return True # bandwidth is unknown for plain ports, so we assume it is there
+
+
     def hasRemote(self):
         return self.remote_port != None
 
@@ -158,14 +262,32 @@ class Network(object):
         self.bidirectional_ports = bidirectional_ports or []
         self.version             = version or datetime.datetime.utcnow()
 
+        for port in self.inbound_ports:
+            port.orientation = INGRESS
+        for port in self.outbound_ports:
+            port.orientation = EGRESS
 
-    def getPort(self, port_id):
+        # indexes for port lookup, the port lists are not changed after construction
+        self.ports = {} # port_id -> port
         for port in itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports):
-            if port.id_ == port_id:
-                return port
-        # better error message
-        ports = [ p.id_ for p in list(itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports)) ]
-        raise error.TopologyError('No port named %s for network %s (ports: %s)' %(port_id, self.name, str(ports)))
+            self.ports[port.id_] = port
+        self.bidirectional_port_index = {} # ( inbound_port_id, outbound_port_id ) -> BidirectionalPort
+        for port in self.bidirectional_ports:
+            self.bidirectional_port_index[ (port.inbound_port.id_, port.outbound_port.id_) ] = port
+
+
+    def getPort(self, port_id):
+        try:
+            return self.ports[port_id]
+        except KeyError:
+            # better error message
+            ports = [ p.id_ for p in itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports) ]
+            raise error.TopologyError('No port named %s for network %s (ports: %s)' %(port_id, self.name, str(ports)))
+
+
+    def findBidirectionalPort(self, inbound_port_id, outbound_port_id):
+        # returns the bidirectional port made of the two unidirectional ports, or None if there is no such port
+        return self.bidirectional_port_index.get( (inbound_port_id, outbound_port_id) )
 
 
     def findPorts(self, bidirectionality, labels=None, exclude=None):
@@ -183,33 +305,270 @@ class Network(object):
 
 
 
+class PathCache(object):
+    """
+    LRU cache for path search results. Each entry remembers the versions of the
+    networks its paths go through. An entry is never returned if any of these
+    networks has been replaced by another version.
+    """
+    def __init__(self, size=PATH_CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict() # key -> ( paths, { network_id : version } ), least recently used first
+        self.network_keys = {} # network_id -> set of keys for entries with paths through the network
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, networks):
+        # networks is the network dict of the topology, to check the network versions
+        try:
+            paths, versions = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        for network_id, version in versions.items():
+            if network_id not in networks or networks[network_id][0].version != version:
+                self._forget(key, versions)
+                self.misses += 1
+                return None
+
+        self.entries[key] = (paths, versions)
+        self.hits += 1
+        return paths
+
+
+    def put(self, key, paths, networks):
+        versions = {}
+        for path in paths:
+            for link in path:
+                versions[link.network] = networks[link.network][0].version
+
+        if key in self.entries:
+            self._forget(key, self.entries.pop(key)[1])
+
+        self.entries[key] = (paths, versions)
+        for network_id in versions:
+            self.network_keys.setdefault(network_id, set()).add(key)
+
+        while len(self.entries) > self.size:
+            old_key, (_, old_versions) = self.entries.popitem(last=False)
+            self._forget(old_key, old_versions)
+
+
+    def _forget(self, key, versions):
+        for network_id in versions:
+            keys = self.network_keys.get(network_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.network_keys[network_id]
+
+
+    def invalidateNetwork(self, network_id):
+        # drop entries with paths through the network
+        for key in self.network_keys.pop(network_id, set()):
+            _, versions = self.entries.pop(key)
+            self._forget(key, versions)
+
+
+    def clear(self):
+        self.entries.clear()
+        self.network_keys.clear()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
 class Topology(object):
 
-    def __init__(self):
+    def __init__(self, path_cache_size=PATH_CACHE_SIZE):
         self.networks = {} # network_name -> ( Network, nsa.NetworkServiceAgent)
+        self.port_networks = {} # port_id -> network_id, for all ports in all networks
+        # inter-network graph, derived from the networks, and kept up to date when networks are added or updated
+        self.adjacency = {} # network_id -> [ ( BidirectionalPort, remote_network_id, remote_port_id ) ]
+        self.unidirectional_adjacency = {} # network_id -> [ ( outbound port, remote_network_id, remote inbound port_id ) ]
+        self.remote_port_references = {} # remote port_id -> set of network ids with ports pointing to it
+        self.path_cache = PathCache(path_cache_size)
 
 
     def addNetwork(self, network, managing_nsa):
+        self._addNetwork(network, managing_nsa)
+        # a new network can give new (and shorter) paths anywhere
+        self.path_cache.clear()
+
+
+    def _addNetwork(self, network, managing_nsa):
         assert type(network) is Network
         assert type(managing_nsa) is nsa.NetworkServiceAgent
 
         if network.id_ in self.networks:
             raise error.TopologyError('Entry for network with id %s already exists' % network.id_)
 
+        # check everything before changing anything, so a failed add leaves the topology untouched
+        for port_id in network.ports:
+            if port_id in self.port_networks:
+                raise error.TopologyError('Port %s in network %s already exists in network %s' % (port_id, network.id_, self.port_networks[port_id]))
+
         self.networks[network.id_] = (network, managing_nsa)
+        for port_id in network.ports:
+            self.port_networks[port_id] = network.id_
+
+        self._updateAdjacency(network)
+
+
+    def _removeNetwork(self, network_id):
+        # returns the removed entry, or None if the network did not exist
+        entry = self.networks.pop(network_id, None)
+        if entry is not None:
+            for port_id in entry[0].ports:
+                self.port_networks.pop(port_id, None)
+            self._updateAdjacency(entry[0], removed=True)
+        return entry
+
+
+    def _remotePorts(self, network):
+        # bidirectional ports are made of inbound and outbound ports, so this covers all of them
+        for port in itertools.chain(network.inbound_ports, network.outbound_ports):
+            if port.hasRemote():
+                yield port.remote_port
+
+
+    def _updateAdjacency(self, network, removed=False):
+        # the edges out of a network depend on the network itself, and on the networks its ports point to,
+        # so the network and every network pointing into it have their edges recomputed
+        for remote_port_id in self._remotePorts(network):
+            if removed:
+                self.remote_port_references.get(remote_port_id, set()).discard(network.id_)
+            else:
+                self.remote_port_references.setdefault(remote_port_id, set()).add(network.id_)
+
+        affected = set( [ network.id_ ] )
+        for port_id in network.ports:
+            affected.update( self.remote_port_references.get(port_id, ()) )
+
+        self._recomputeEdges(affected)
+
+
+    def _recomputeEdges(self, network_ids):
+        for network_id in network_ids:
+            if network_id in self.networks:
+                self.adjacency[network_id] = self._findNetworkEdges(self.networks[network_id][0])
+                self.unidirectional_adjacency[network_id] = self._findUnidirectionalEdges(self.networks[network_id][0])
+            else:
+                self.adjacency.pop(network_id, None)
+                self.unidirectional_adjacency.pop(network_id, None)
+
+
+    def _findNetworkEdges(self, network):
+        edges = []
+        for port in network.bidirectional_ports:
+            if not (port.inbound_port.remote_port in self.port_networks and port.outbound_port.remote_port in self.port_networks):
+                continue # remote network not in topology (yet), skip it quietly
+            demarcation = self.findDemarcationPort(port)
+            if demarcation is not None:
+                edges.append( (port, demarcation[0], demarcation[1]) )
+        return edges
+
+
+    def _findUnidirectionalEdges(self, network):
+        # outbound ports lead directly to an inbound port in the remote network
+        edges = []
+        for port in network.outbound_ports:
+            if port.remote_port in self.port_networks:
+                remote_network_id = self.port_networks[port.remote_port]
+                if self.networks[remote_network_id][0].ports[port.remote_port].orientation == INGRESS:
+                    edges.append( (port, remote_network_id, port.remote_port) )
+        return edges
 
 
     def updateNetwork(self, network, managing_nsa):
-        # update an existing network entry
-        existing_entry = self.networks.pop(network.id_, None) # note - we may get none here (for new network)
+        # update an existing network entry, only the ports which have changed are replaced
+        existing_entry = self.networks.get(network.id_)
+        if existing_entry is None or existing_entry[0].name != network.name:
+            return self._replaceNetwork(network, managing_nsa)
+
+        existing_network = existing_entry[0]
+        removed_ports, added_ports = _diffPorts(existing_network, network)
+        if not (removed_ports or added_ports):
+            # same ports, keep the existing network, so cached paths through it stay valid
+            self.networks[network.id_] = (existing_network, managing_nsa)
+            return
+
+        removed_ids = set( [ p.id_ for p in removed_ports ] )
+        added_ids   = set( [ p.id_ for p in added_ports ] )
+        for port_id in added_ids - removed_ids:
+            if port_id in self.port_networks:
+                e = error.TopologyError('Port %s in network %s already exists in network %s' % (port_id, network.id_, self.port_networks[port_id]))
+                log.msg('Error updating network entry for %s. Reason: %s' % (network.id_, str(e)))
+                raise e
+
+        # unchanged ports are kept, changed and new ports are taken from the new network
+        def patchPorts(existing_ports, ports):
+            return [ p for p in existing_ports if p.id_ not in removed_ids ] + [ p for p in ports if p.id_ in added_ids ]
+
+        patched_network = Network(network.id_, network.name,
+                                  patchPorts(existing_network.inbound_ports, network.inbound_ports),
+                                  patchPorts(existing_network.outbound_ports, network.outbound_ports),
+                                  patchPorts(existing_network.bidirectional_ports, network.bidirectional_ports),
+                                  network.version)
+
+        # only the network and the networks pointing to the changed ports can get different edges
+        affected = set( [ network.id_ ] )
+        for port_id in removed_ids | added_ids:
+            affected.update( self.remote_port_references.get(port_id, ()) )
+        existing_edges = dict( [ (network_id, self._edgeKeys(network_id)) for network_id in affected ] )
+
+        for port in removed_ports:
+            if not port.isBidirectional() and port.hasRemote():
+                self.remote_port_references.get(port.remote_port, set()).discard(network.id_)
+        for port in added_ports:
+            if not port.isBidirectional() and port.hasRemote():
+                self.remote_port_references.setdefault(port.remote_port, set()).add(network.id_)
+
+        self.networks[network.id_] = (patched_network, managing_nsa)
+        for port_id in removed_ids - added_ids:
+            self.port_networks.pop(port_id, None)
+        for port_id in added_ids - removed_ids:
+            self.port_networks[port_id] = network.id_
+
+        self._recomputeEdges(affected)
+
+        log.msg('Network %s updated, %i ports replaced, %i ports removed, %i ports added' % \
+                (network.id_, len(removed_ids & added_ids), len(removed_ids - added_ids), len(added_ids - removed_ids)), debug=True, system=LOG_SYSTEM)
+
+        if any( [ existing_edges[network_id] != self._edgeKeys(network_id) for network_id in affected ] ):
+            # the network graph changed, which can give new paths anywhere
+            self.path_cache.clear()
+        else:
+            self.path_cache.invalidateNetwork(network.id_)
+
+
+    def _replaceNetwork(self, network, managing_nsa):
+        # replace the entire network entry
+        existing_edges = self._edgeKeys(network.id_)
+        existing_entry = self._removeNetwork(network.id_) # note - we may get none here (for new network)
         try:
-            self.addNetwork(network, managing_nsa)
+            self._addNetwork(network, managing_nsa)
         except error.TopologyError as e:
             log.msg('Error updating network entry for %s. Reason: %s' % (network.id_, str(e)))
             if existing_entry:
-                self.networks[network.id_] = existing_entry # restore old entry
+                self._addNetwork(*existing_entry) # restore old entry
             raise e
 
+        if existing_entry is None or set(existing_entry[0].ports) != set(network.ports) or existing_edges != self._edgeKeys(network.id_):
+            # the network graph changed, which can give new paths anywhere
+            self.path_cache.clear()
+        elif existing_entry[0].version != network.version:
+            self.path_cache.invalidateNetwork(network.id_)
+
+
+    def _edgeKeys(self, network_id):
+        edges = self.adjacency.get(network_id, []) + self.unidirectional_adjacency.get(network_id, [])
+        return [ (lp.id_, d_network_id, d_port_id) for lp, d_network_id, d_port_id in edges ]
+
 
     def getNetwork(self, network_id):
         try:
@@ -219,14 +578,11 @@ class Topology(object):
 
 
     def getNetworkPort(self, port_id):
-        for network_id, (network,_) in self.networks.items():
-            try:
-                port = network.getPort(port_id)
-                return network_id, port
-            except error.TopologyError:
-                continue
-        else:
+        try:
+            network_id = self.port_networks[port_id]
+        except KeyError:
             raise error.TopologyError('Cannot find port with id %s in topology' % port_id)
+        return network_id, self.networks[network_id][0].ports[port_id]
 
 
     def getNSA(self, network_id):
@@ -256,13 +612,110 @@ class Topology(object):
 
         remote_network = self.getNetwork(remote_network_in)
 
-        for rp in remote_network.findPorts(True):
-            if isinstance(rp, BidirectionalPort) and rp.inbound_port.id_ == remote_port_in.id_ and rp.outbound_port.id_ == remote_port_out.id_:
-                return remote_network.id_, rp.id_
-        return None
-
+        rp = remote_network.findBidirectionalPort(remote_port_in.id_, remote_port_out.id_)
+        if rp is None:
+            return None
+        return remote_network.id_, rp.id_
+
+
+    def findPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None, max_paths=None, cost=hopCost):
+        """
+        Find paths between two STPs. Without max_paths, all loop free paths
+        are returned. With max_paths, the (up to) max_paths cheapest paths are
+        returned, cheapest first, found with Yen's k shortest paths algorithm.
+        The cost of a path is the sum of the cost function for the link ports
+        used to leave each network.
+
+        Paths between unidirectional STPs go from the ingress STP to the
+        egress STP, over outbound ports and the inbound ports they lead to.
+        If the source STP is the egress STP, the links are still listed from
+        the source STP, but traffic flows the other way. Paths between
+        unidirectional STPs are always found with the k shortest paths
+        search, without max_paths the UNIDIRECTIONAL_MAX_PATHS cheapest.
+        """
+        source_port, dest_port = self._checkEndpoints(source_stp, dest_stp, bandwidth)
+
+        if source_port.isBidirectional():
+            if max_paths is None:
+                return self._findPathsRecurse(source_stp, dest_stp, bandwidth, exclude_networks)
+            adjacency = self.adjacency
+        else:
+            if source_port.orientation == EGRESS:
+                paths = self.findPaths(dest_stp, source_stp, bandwidth, exclude_networks, max_paths, cost)
+                return [ [ nsa.Link(l.network, l.dst_port, l.src_port, l.dst_labels, l.src_labels) for l in reversed(path) ] for path in paths ]
+            adjacency = self.unidirectional_adjacency
+            max_paths = max_paths or UNIDIRECTIONAL_MAX_PATHS
+
+        cost_key = _costKey(cost)
+        if cost_key is None:
+            # no way of knowing if another cost function is the same, so no caching
+            return self._findKShortestPaths(source_stp, source_port, dest_stp, dest_port, bandwidth, exclude_networks, max_paths, cost, adjacency)
+
+        cache_key = (source_stp.network, source_stp.port, _labelsKey(source_stp.labels), dest_stp.network, dest_stp.port,
+                     _labelsKey(dest_stp.labels), bandwidth, tuple(exclude_networks or []), max_paths, cost_key)
+        paths = self.path_cache.get(cache_key, self.networks)
+        if paths is None:
+            paths = self._findKShortestPaths(source_stp, source_port, dest_stp, dest_port, bandwidth, exclude_networks, max_paths, cost, adjacency)
+            if paths: # no paths are not cached, as any network change might give a path
+                self.path_cache.put(cache_key, paths, self.networks)
+        return list(paths)
+
+
+    def _findKShortestPaths(self, source_stp, source_port, dest_stp, dest_port, bandwidth, exclude_networks, max_paths, cost, adjacency):
+
+        source_label = source_stp.labels[0]
+        path_networks = frozenset( [ source_stp.network ] + (exclude_networks or []) )
+        first_hop = (source_stp.network, source_port, source_label, source_label, None, None, path_networks)
+
+        remaining_costs = self._costsToNetwork(dest_stp.network, bandwidth, cost, adjacency)
+        port_labels = {} # port_id -> label, bidirectional ports compute their labels on every call, so we keep them
+
+        result = self._searchPath(first_hop, 0, dest_stp, dest_port, bandwidth, cost, adjacency, remaining_costs, port_labels, ())
+        if result is None:
+            return []
 
-    def findPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None):
+        found = [ result + (0,) ] # [ ( cost, last_hop, deviation index ) ]
+        found_keys = [ _pathKey(result[1]) ]
+        candidates = [] # heap of ( cost, sequence, last_hop, deviation index )
+        candidate_keys = set(found_keys)
+        sequence = itertools.count()
+
+        while len(found) < max_paths:
+            # Spur from the hops of the latest path, except the last one, as we do not leave the destination network.
+            # Spurring before the hop where the path deviated from its parent path only finds paths found already.
+            hops = _pathHops(found[-1][1])
+            path_key = found_keys[-1]
+            deviation = found[-1][2]
+            root_cost = sum( [ cost(hop[4]) for hop in hops[:deviation] ] )
+            for idx in range(deviation, len(hops) - 1):
+                spur_hop = hops[idx]
+                root_key = path_key[:idx]
+                # do not take the same way out of the spur hop as any found path with the same root
+                exclude_ports = set()
+                for key in found_keys:
+                    if len(key) > idx + 1 and key[:idx] == root_key:
+                        exclude_ports.add(key[idx][2])
+
+                start_hop = spur_hop[:4] + (None,) + spur_hop[5:]
+                result = self._searchPath(start_hop, root_cost, dest_stp, dest_port, bandwidth, cost, adjacency, remaining_costs, port_labels, exclude_ports)
+                if result is not None:
+                    key = _pathKey(result[1])
+                    if key not in candidate_keys:
+                        candidate_keys.add(key)
+                        heapq.heappush(candidates, (result[0], sequence.next(), result[1], idx) )
+
+                root_cost += cost(spur_hop[4])
+
+            if not candidates:
+                break
+            path_cost, _, last_hop, deviation = heapq.heappop(candidates)
+            found.append( (path_cost, last_hop, deviation) )
+            found_keys.append( _pathKey(last_hop) )
+
+        return [ self._createPath(last_hop, dest_stp, dest_port) for _, last_hop, _ in found ]
+
+
+    def _checkEndpoints(self, source_stp, dest_stp, bandwidth):
 
         source_port = self.getNetwork(source_stp.network).getPort(source_stp.port)
         dest_port   = self.getNetwork(dest_stp.network).getPort(dest_stp.port)
@@ -283,12 +736,170 @@ class Topology(object):
             raise error.TopologyError('Source port %s (labels %s) cannot match labels for source STP (%s)' % (source_port.id_, source_port.labels(), source_stp.labels))
         if not dest_port.canMatchLabels(dest_stp.labels):
             raise error.TopologyError('Desitination port %s (labels %s) cannot match labels for destination STP %s' % (dest_port.id_, dest_port.labels(), dest_stp.labels))
-#        if not source_port.canProvideBandwidth(bandwidth):
-#            raise error.BandwidthUnavailableError('Source port cannot provide enough bandwidth (%i)' % bandwidth)
-#        if not dest_port.canProvideBandwidth(bandwidth):
-#            raise error.BandwidthUnavailableError('Destination port cannot provide enough bandwidth (%i)' % bandwidth)
+        if not source_port.canProvideBandwidth(bandwidth):
+            raise error.BandwidthUnavailableError('Source port cannot provide enough bandwidth (%i)' % bandwidth)
+        if not dest_port.canProvideBandwidth(bandwidth):
+            raise error.BandwidthUnavailableError('Destination port cannot provide enough bandwidth (%i)' % bandwidth)
+
+        return source_port, dest_port
+
+
+    def findPath(self, source_stp, dest_stp, bandwidth, cost=hopCost):
+        """
+        Find the cheapest path between two STPs, or None if there is no path.
+        With the default cost, this is the path with fewest networks, and the
+        same path as the first of findPaths without max_paths.
+        """
+        paths = self.findPaths(source_stp, dest_stp, bandwidth, max_paths=1, cost=cost)
+        return paths[0] if paths else None
+
+
+    def _costsToNetwork(self, network_id, bandwidth, cost, adjacency):
+        # Cost of the cheapest way to a network, from all networks which can reach it, not considering labels.
+        # This is a lower bound of the actual cost, and is used to guide the path search towards the network.
+        reverse_adjacency = {} # network_id -> [ ( cost, network_id ) ]
+        for source_network_id, edges in adjacency.items():
+            for lp, d_network_id, _ in edges:
+                if lp.canProvideBandwidth(bandwidth):
+                    reverse_adjacency.setdefault(d_network_id, []).append( (cost(lp), source_network_id) )
+
+        costs = {}
+        queue = [ (0, network_id) ]
+        while queue:
+            c, nw_id = heapq.heappop(queue)
+            if nw_id in costs:
+                continue
+            costs[nw_id] = c
+            for edge_cost, source_network_id in reverse_adjacency.get(nw_id, []):
+                if source_network_id not in costs:
+                    heapq.heappush(queue, (c + edge_cost, source_network_id) )
+        return costs
+
+
+    def _searchPath(self, start_hop, start_cost, dest_stp, dest_port, bandwidth, cost, adjacency, remaining_costs, port_labels, exclude_ports):
+        # Cheapest first search (A*) from start_hop to the destination, returns ( cost, last hop ) or None. The
+        # remaining costs (from _costsToNetwork) are added to the cost of a hop when ordering the search.
+        #
+        # A hop is: ( network_id, port into the network, label into the network, labels usable in the network,
+        # egress port, previous hop, networks on the path ). The usable labels are the label restrictions for the
+        # network given the path so far, if they become empty, the path cannot be used. The labels of a non-swapping
+        # network are restricted by all networks since the last swapping network. The networks on the path include
+        # excluded networks, and are used to avoid loops. The exclude_ports are only for leaving the start hop.
+        dest_label = dest_stp.labels[0]
+        label_type = dest_label.type_
+
+        def portLabel(port):
+            try:
+                return port_labels[port.id_]
+            except KeyError:
+                label = port_labels[port.id_] = port.labels()[0]
+                return label
+
+        seen = {} # ( network_id, port_id ) -> [ usable labels ], a later hop with a subset of these cannot do better
+        sequence = itertools.count()
+        if start_hop[0] not in remaining_costs:
+            return None
+        # among hops of same estimated cost, the one furthest along is taken first, this avoids expanding all the
+        # alternatives of same cost, before getting to the destination
+        queue = [ (start_cost + remaining_costs[start_hop[0]], -start_cost, sequence.next(), start_hop) ]
+        expanded = 0
+
+        while queue:
+            _, hop_cost, _, hop = heapq.heappop(queue)
+            hop_cost = -hop_cost
+            network_id, in_port, in_label, usable, _, previous, path_networks = hop
+            network = self.getNetwork(network_id)
+            swap = network.canSwapLabel(label_type)
+
+            try:
+                usable = portLabel(in_port).intersect(in_label if swap else usable)
+            except nsa.EmptyLabelSet:
+                continue
+
+            seen_labels = seen.setdefault( (network_id, in_port.id_), [])
+            if any( [ usable.issubset(sl) for sl in seen_labels ] ):
+                continue
+            seen_labels.append(usable)
+
+            if network_id == dest_stp.network:
+                # like findPaths, we do not go through other networks to get back to the destination network
+                try:
+                    if swap:
+                        portLabel(dest_port).intersect(dest_label)
+                    else:
+                        usable.intersect(portLabel(dest_port)).intersect(dest_label)
+                except nsa.EmptyLabelSet:
+                    continue
+                return hop_cost, (network_id, in_port, in_label, usable, None, previous, path_networks)
+
+            expanded += 1
+            if expanded > PATH_SEARCH_LIMIT:
+                log.msg('Path search from %s to %s stopped after %i hops' % (start_hop[0], dest_stp.network, PATH_SEARCH_LIMIT), system=LOG_SYSTEM)
+                return None
 
-        return self._findPathsRecurse(source_stp, dest_stp, bandwidth)
+            for lp, d_network_id, d_port_id in adjacency.get(network_id, []):
+                if lp.id_ == in_port.id_ or d_network_id in path_networks or d_network_id not in remaining_costs:
+                    continue
+                if not lp.canProvideBandwidth(bandwidth):
+                    continue
+                if hop is start_hop and lp.id_ in exclude_ports:
+                    continue
+                lp_label = portLabel(lp)
+                if not lp_label.intersects(in_label if swap else usable):
+                    continue
+
+                d_port = self.getNetwork(d_network_id).getPort(d_port_id)
+                if not d_port.canProvideBandwidth(bandwidth):
+                    continue
+
+                if swap:
+                    next_label  = lp_label
+                    next_usable = lp_label
+                else:
+                    next_label  = in_label.intersect(lp_label)
+                    next_usable = usable.intersect(lp_label)
+
+                next_cost = hop_cost + cost(lp)
+                parent   = (network_id, in_port, in_label, usable, lp, previous, path_networks)
+                next_hop = (d_network_id, d_port, next_label, next_usable, None, parent, path_networks | set( [ d_network_id ] ))
+                heapq.heappush(queue, (next_cost + remaining_costs[d_network_id], -next_cost, sequence.next(), next_hop) )
+
+        return None
+
+
+    def _createPath(self, last_hop, dest_stp, dest_port):
+        # create the links for path, going back from the destination, the labels are computed the same way as in findPaths
+        links = []
+        next_src_label = None
+        network_id, in_port, in_label, _, lp, previous, _ = last_hop
+        while True:
+            swap = self.getNetwork(network_id).canSwapLabel(in_label.type_)
+            if lp is None: # last network
+                out_port_id = dest_stp.port
+                if swap:
+                    src_label = in_port.labels()[0].intersect(in_label)
+                    dst_label = dest_port.labels()[0].intersect(dest_stp.labels[0])
+                else:
+                    src_label = in_port.labels()[0].intersect(dest_port.labels()[0]).intersect(in_label).intersect(dest_stp.labels[0])
+                    dst_label = src_label
+            else:
+                out_port_id = lp.id_
+                if swap:
+                    src_label = in_port.labels()[0].intersect(in_label)
+                    dst_label = lp.labels()[0].intersect(next_src_label)
+                else:
+                    src_label = in_port.labels()[0].intersect(in_label).intersect(lp.labels()[0]).intersect(next_src_label)
+                    dst_label = src_label
+
+            links.append( nsa.Link(network_id, in_port.id_, out_port_id, [src_label], [dst_label]) )
+            next_src_label = src_label
+
+            if previous is None:
+                break
+            network_id, in_port, in_label, _, lp, previous, _ = previous
+
+        links.reverse()
+        return links
 
 
     def _findPathsRecurse(self, source_stp, dest_stp, bandwidth, exclude_networks=None):
@@ -300,65 +911,65 @@ class Topology(object):
 
         if not (source_port.canMatchLabels(source_stp.labels) or dest_port.canMatchLabels(dest_stp.labels)):
             return []
-#        if not (source_port.canProvideBandwidth(bandwidth) and dest_port.canProvideBandwidth(bandwidth)):
-#            return []
+        if not (source_port.canProvideBandwidth(bandwidth) and dest_port.canProvideBandwidth(bandwidth)):
+            return []
 
         # this code heavily relies on the assumption that ports only have one label
 
-        if source_port.isBidirectional() and dest_port.isBidirectional():
-            # bidirectional path finding, easy case first
-            if source_stp.network == dest_stp.network:
-                # while it is possible to cross other network in order to connect to intra-network STPs
-                # it is not something we really want to do in the real world, so we don't
-                try:
-                    if source_network.canSwapLabel(source_stp.labels[0].type_):
-                        source_labels = source_port.labels()[0].intersect(source_stp.labels[0])
-                        dest_labels   = dest_port.labels()[0].intersect(dest_stp.labels[0])
-                    else:
-                        source_labels = source_port.labels()[0].intersect(dest_port.labels()[0]).intersect(source_stp.labels[0]).intersect(dest_stp.labels[0])
-                        dest_labels   = source_labels
-                    link = nsa.Link(source_stp.network, source_stp.port, dest_stp.port, [source_labels], [dest_labels])
-                    return [ [ link ] ]
-                except nsa.EmptyLabelSet:
-                    return [] # no path
-            else:
-                # ok, time for real pathfinding
-                link_ports = source_network.findPorts(True, source_stp.labels, source_stp.port)
-                link_ports = [ port for port in link_ports if port.hasRemote() ] # filter out termination ports
-                links = []
-                for lp in link_ports:
-                    demarcation = self.findDemarcationPort(lp)
-                    if demarcation is None:
-                        continue
+        # only used for bidirectional stps, unidirectional ones are found with the k shortest paths search
+        assert source_port.isBidirectional() and dest_port.isBidirectional(), 'Recursive path search is only for bidirectional STPs'
 
-                    d_network_id, d_port_id = demarcation
+        # bidirectional path finding, easy case first
+        if source_stp.network == dest_stp.network:
+            # while it is possible to cross other network in order to connect to intra-network STPs
+            # it is not something we really want to do in the real world, so we don't
+            try:
+                if source_network.canSwapLabel(source_stp.labels[0].type_):
+                    source_labels = source_port.labels()[0].intersect(source_stp.labels[0])
+                    dest_labels   = dest_port.labels()[0].intersect(dest_stp.labels[0])
+                else:
+                    source_labels = source_port.labels()[0].intersect(dest_port.labels()[0]).intersect(source_stp.labels[0]).intersect(dest_stp.labels[0])
+                    dest_labels   = source_labels
+                link = nsa.Link(source_stp.network, source_stp.port, dest_stp.port, [source_labels], [dest_labels])
+                return [ [ link ] ]
+            except nsa.EmptyLabelSet:
+                return [] # no path
+        else:
+            # ok, time for real pathfinding
+            links = []
+            for lp, d_network_id, d_port_id in self.adjacency.get(source_network.id_, []):
+                if lp.id_ == source_stp.port or not lp.canMatchLabels(source_stp.labels) or not lp.canProvideBandwidth(bandwidth):
+                    continue
 
-                    if exclude_networks is not None and demarcation[0] in exclude_networks:
-                        continue # don't do loops in path finding
+                demarcation = (d_network_id, d_port_id)
 
-                    demarcation_label = lp.labels()[0] if source_network.canSwapLabel(source_stp.labels[0].type_) else source_stp.labels[0].intersect(lp.labels()[0])
-                    demarcation_stp = nsa.STP(demarcation[0], demarcation[1], [ demarcation_label ] )
-                    sub_exclude_networks = [ source_network.id_ ] + (exclude_networks or [])
-                    sub_links = self._findPathsRecurse(demarcation_stp, dest_stp, bandwidth, sub_exclude_networks)
-                    # if we didn't find any sub paths, just continue
-                    if not sub_links:
-                        continue
+                if exclude_networks is not None and demarcation[0] in exclude_networks:
+                    continue # don't do loops in path finding
 
-                    for sl in sub_links:
-                        # --
+                demarcation_label = lp.labels()[0] if source_network.canSwapLabel(source_stp.labels[0].type_) else source_stp.labels[0].intersect(lp.labels()[0])
+                demarcation_stp = nsa.STP(demarcation[0], demarcation[1], [ demarcation_label ] )
+                sub_exclude_networks = [ source_network.id_ ] + (exclude_networks or [])
+                sub_links = self._findPathsRecurse(demarcation_stp, dest_stp, bandwidth, sub_exclude_networks)
+                # if we didn't find any sub paths, just continue
+                if not sub_links:
+                    continue
+
+                for sl in sub_links:
+                    # a sub path which cannot be joined with the first link is skipped, it should not fail the search
+                    try:
                         if source_network.canSwapLabel(source_stp.labels[0].type_):
                             source_label = source_port.labels()[0].intersect(source_stp.labels[0])
                             dest_label   = lp.labels()[0].intersect(sl[0].src_labels[0])
                         else:
                             source_label = source_port.labels()[0].intersect(source_stp.labels[0]).intersect(lp.labels()[0]).intersect(sl[0].src_labels[0])
                             dest_label   = source_label
+                    except nsa.EmptyLabelSet:
+                        continue
 
-                        first_link = nsa.Link(source_stp.network, source_stp.port, lp.id_, [source_label], [dest_label])
-                        path = [ first_link ] + sl
-                        links.append(path)
+                    first_link = nsa.Link(source_stp.network, source_stp.port, lp.id_, [source_label], [dest_label])
+                    path = [ first_link ] + sl
+                    links.append(path)
 
-                return sorted(links, key=len) # sort by length, shortest first
+            return sorted(links, key=len) # sort by length, shortest first
 
-        else:
-            raise error.TopologyError('Unidirectional path-finding not implemented yet')
 
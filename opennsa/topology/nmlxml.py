@@ -18,6 +18,8 @@ from opennsa.topology import nml
 
 LOG_SYSTEM = 'topology.nmlxml'
 
+PARSE_CHUNK_SIZE = 65536 # bytes read at a time when parsing from a file
+
 
 NML_NS = 'http://schemas.ogf.org/nml/2013/05/base#'
 NSI_NS = 'http://schemas.ogf.org/nsi/2013/09/topology#'
@@ -185,6 +187,40 @@ def parseNMLPort(nml_port):
 
 
 
+def _parseBidirectionalPort(nml_bd_port):
+
+    port_id = _baseName( nml_bd_port.attrib[ID] )
+    name = None
+    sub_ports = []
+    for pel in nml_bd_port:
+        if pel.tag == NML_NAME:
+            name = pel.text
+        elif pel.tag in (NML_PORT, NML_PORTGROUP):
+            sub_ports.append( _baseName( pel.attrib[ID] ) )
+    assert len(sub_ports) == 2, 'The number of ports in a bidirectional port must be 2'
+    return (port_id, name, sub_ports)
+
+
+
+def _buildNetwork(topology_id, network_name, inbound_ports, outbound_ports, bd_ports):
+
+    # construct the bidirectional ports
+    bidirectional_ports = []
+
+    for port_id, name, (p1, p2) in bd_ports:
+        if p1 in inbound_ports:
+            in_port  = inbound_ports[p1]
+            out_port = outbound_ports[p2]
+        else:
+            in_port  = inbound_ports[p2]
+            out_port = outbound_ports[p1]
+        bidirectional_ports.append( nml.BidirectionalPort(port_id, name, in_port, out_port) )
+
+    network = nml.Network(topology_id, network_name, inbound_ports.values(), outbound_ports.values(), bidirectional_ports)
+    return network
+
+
+
 def parseNMLTopology(nml_topology):
 
     assert nml_topology.tag == NML_TOPOLOGY, 'Top level container must be nml:Topology'
@@ -217,34 +253,12 @@ def parseNMLTopology(nml_topology):
                 outbound_ports[port.id_] = port
 
         elif nte.tag == NML_BIDIRECTIONALPORT:
-            port_id = _baseName( nte.attrib[ID] )
-            name = None
-            sub_ports = []
-            for pel in nte:
-                if pel.tag == NML_NAME:
-                    name = pel.text
-                elif pel.tag in (NML_PORT, NML_PORTGROUP):
-                    sub_ports.append( _baseName( pel.attrib[ID] ) )
-            assert len(sub_ports) == 2, 'The number of ports in a bidirectional port must be 2'
-            bd_ports.append( (port_id, name, sub_ports) )
+            bd_ports.append( _parseBidirectionalPort(nte) )
 
         else:
             log.msg('Unknown topology element %s, ignoring' % nte.tag, system=LOG_SYSTEM)
 
-    # construct the bidirectional ports
-    bidirectional_ports = []
-
-    for port_id, name, (p1, p2) in bd_ports:
-        if p1 in inbound_ports:
-            in_port  = inbound_ports[p1]
-            out_port = outbound_ports[p2]
-        else:
-            in_port  = inbound_ports[p2]
-            out_port = outbound_ports[p1]
-        bidirectional_ports.append( nml.BidirectionalPort(port_id, name, in_port, out_port) )
-
-    network = nml.Network(topology_id, network_name, inbound_ports.values(), outbound_ports.values(), bidirectional_ports)
-    return network
+    return _buildNetwork(topology_id, network_name, inbound_ports, outbound_ports, bd_ports)
 
 
 
@@ -264,33 +278,126 @@ def parseNSIService(nsi_service):
 
 
 
-def parseNSITopology(nsi_topology_source):
+class _NSITopologyBuilder(ET.TreeBuilder):
+    # Tree builder, which turns services, ports, and bidirectional ports into
+    # model objects as soon as their elements are complete. The elements are
+    # then removed from the tree, so it never holds more than a single port.
+
+    def __init__(self):
+        ET.TreeBuilder.__init__(self)
+        self.open_elements = []
 
-    tree = ET.parse(nsi_topology_source)
+        self.nsi_agent      = None
+        self.network        = None
 
-    nsi_nsa = tree.getroot()
-    assert nsi_nsa.tag == NSI_NSA, 'Top level container must be a nsi:NSA tag'
+        self.topology_id    = None
+        self.network_name   = None
+        self.inbound_ports  = {}
+        self.outbound_ports = {}
+        self.bd_ports       = [] # temporary construction
 
-    ## we currently don't use these for anything
-    # nsa_id  = nsi_nsa.attrib[ID]
-    # version = nsi_nsa.attrib[VERSION]
 
-    nsi_agent = None
-    network_topo = None
+    def start(self, tag, attrs):
+        if not self.open_elements:
+            assert tag == NSI_NSA, 'Top level container must be a nsi:NSA tag'
+        elif tag == NML_TOPOLOGY and len(self.open_elements) == 1:
+            assert self.topology_id is None, 'NSI Topology specifies more than one NML topology'
+            self.topology_id = _baseName( attrs[ID] )
+
+        element = ET.TreeBuilder.start(self, tag, attrs)
+        self.open_elements.append(element)
+        return element
+
+
+    def end(self, tag):
+        element = ET.TreeBuilder.end(self, tag)
+        self.open_elements.pop()
+
+        depth = len(self.open_elements)
+        if depth == 0:
+            return element
+
+        parent = self.open_elements[-1]
+
+        if depth == 1:
+            if element.tag == NSI_SERVICE:
+                # we only support nsi agent service type for now
+                self.nsi_agent = parseNSIService(element)
+            elif element.tag == NML_TOPOLOGY:
+                self.network = _buildNetwork(self.topology_id, self.network_name, self.inbound_ports, self.outbound_ports, self.bd_ports)
+            parent.remove(element)
+
+        elif depth == 2 and parent.tag == NML_TOPOLOGY:
+            if element.tag == NML_NAME:
+                self.network_name = element.text
+            elif element.tag == NML_BIDIRECTIONALPORT:
+                self.bd_ports.append( _parseBidirectionalPort(element) )
+            elif element.tag == NML_RELATION and element.attrib[TYPE] in (NML_HASINBOUNDPORT, NML_HASOUTBOUNDPORT):
+                pass # ports have been parsed already
+            else:
+                log.msg('Unknown topology element %s, ignoring' % element.tag, system=LOG_SYSTEM)
+            parent.remove(element)
 
-    for ele in nsi_nsa:
+        elif depth == 3 and parent.tag == NML_RELATION and self.open_elements[1].tag == NML_TOPOLOGY:
+            relation_type = parent.attrib[TYPE]
+            if relation_type in (NML_HASINBOUNDPORT, NML_HASOUTBOUNDPORT):
+                if element.tag in (NML_PORT, NML_PORTGROUP):
+                    port = parseNMLPort(element)
+                    ports = self.inbound_ports if relation_type == NML_HASINBOUNDPORT else self.outbound_ports
+                    ports[port.id_] = port
+                else:
+                    log.msg('Relation with port type has non-Port element (%s), ignoring' % element.tag, system=LOG_SYSTEM)
+                parent.remove(element)
 
-        if ele.tag == NSI_SERVICE:
-            # we only support nsi agent service type for now
-            nsi_agent = parseNSIService(ele)
+        return element
+
+
+
+class NSITopologyParser:
+    """
+    Incremental parser for NSI topology documents.
+
+    Data is given to the parser with feed, in chunks of any size, e.g., as it
+    arrives from the network. Ports are turned into model objects as soon as
+    they have been parsed, so the complete element tree is never built.
+    Calling close returns a (nsi agent, network) tuple.
+    """
+    def __init__(self):
+        self.builder = _NSITopologyBuilder()
+        self.parser  = ET.XMLParser(target=self.builder)
+
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+
+    def close(self):
+        self.parser.close()
+
+        ## we currently don't use the nsa id and version for anything
+
+        if self.builder.nsi_agent is None:
+            raise ValueError('NSI Topology does not specify an NSI agent')
+        if self.builder.network is None:
+            raise ValueError('NSI Topology does not specify an NML topology')
+
+        return self.builder.nsi_agent, self.builder.network
+
+
+
+def parseNSITopology(nsi_topology_source):
+    # source is a file-like object or a file name
 
-        elif ele.tag == NML_TOPOLOGY:
-            network_topo = parseNMLTopology(ele)
+    if not hasattr(nsi_topology_source, 'read'):
+        with open(nsi_topology_source) as f:
+            return parseNSITopology(f)
 
-    if nsi_agent is None:
-        raise ValueError('NSI Topology does not specify an NSI agent')
-    if network_topo is None:
-        raise ValueError('NSI Topology does not specify an NML topology')
+    parser = NSITopologyParser()
+    while True:
+        data = nsi_topology_source.read(PARSE_CHUNK_SIZE)
+        if not data:
+            break
+        parser.feed(data)
 
-    return nsi_agent, network_topo
+    return parser.close()
 
@@ -23,6 +23,9 @@ UNIDIRECTIONAL_ETHERNET = 'uni-ethernet'
 
 PORT_TYPES = [ BIDRECTIONAL_ETHERNET, UNIDIRECTIONAL_ETHERNET ]
 
+UNIDIRECTIONAL_IN_SUFFIX  = '-in'
+UNIDIRECTIONAL_OUT_SUFFIX = '-out'
+
 LABEL_TYPES = {
     'vlan'  : cnt.ETHERNET_VLAN
 }
@@ -86,6 +89,8 @@ def parsePortSpec(source, network_name):
     #bi-ethernet     ps              -                              vlan:1780-1783      em0
     #bi-ethernet     netherlight     netherlight#nordunet-(in|out)  vlan:1780-1783      em1
     #bi-ethernet     uvalight        uvalight#nordunet-(in|out)     vlan:1780-1783      em2
+    #uni-ethernet    ndn-in          uvalight#nordunet-out          vlan:1780-1783      em3
+    #uni-ethernet    ndn-out         uvalight#nordunet-in           vlan:1780-1783      em4
 
     # Line starting with # and blank lines should be ignored
 
@@ -149,7 +154,22 @@ def parsePortSpec(source, network_name):
             port_interface_map[port_id] = interface
 
         elif port_type == UNIDIRECTIONAL_ETHERNET:
-            raise NotImplementedError('Unidirectional ethernet ports not implemented yet')
+            # the direction of the port is given by the suffix of the name
+            if in_suffix or out_suffix:
+                raise NRMSpecificationError('Suffixes are not allowed for unidirectional port %s' % port_name)
+            remote = None if remote_network is None else remote_network + ':' + remote_port
+
+            port_id = network_name + ':' + port_name
+            port    = nml.InternalPort(port_id, port_name, bandwidth, labels, remote)
+
+            if port_name.endswith(UNIDIRECTIONAL_IN_SUFFIX):
+                inbound_ports.append(port)
+            elif port_name.endswith(UNIDIRECTIONAL_OUT_SUFFIX):
+                outbound_ports.append(port)
+            else:
+                raise NRMSpecificationError('Name of unidirectional port %s must end with %s or %s' % (port_name, UNIDIRECTIONAL_IN_SUFFIX, UNIDIRECTIONAL_OUT_SUFFIX))
+
+            port_interface_map[port_id] = interface
 
     return inbound_ports, outbound_ports, bidirectional_ports, port_interface_map
 
@@ -0,0 +1,305 @@
+import datetime
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa import nsa, error, state, provreg, database, aggregator, constants as cnt
+from opennsa.topology import nml, nrmparser
+from . import topology
+
+
+LABEL = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
+
+ARUBA_PS   = nsa.STP('aruba:topology',   'aruba:ps',   [LABEL])
+BONAIRE_PS = nsa.STP('bonaire:topology', 'bonaire:ps', [LABEL])
+
+
+
+class ProbedProvider:
+    # local provider, which can answer availability probes
+
+    def __init__(self, unavailable_ports):
+        self.unavailable_ports = unavailable_ports
+        self.probes = []
+
+    def checkAvailability(self, criteria):
+        sd = criteria.service_def
+        self.probes.append( (sd.source_stp.port, sd.dest_stp.port) )
+        if sd.dest_stp.port == 'error':
+            raise error.InternalNRMError('probe failed')
+        return sd.source_stp.port not in self.unavailable_ports and sd.dest_stp.port not in self.unavailable_ports
+
+
+
+class RemoteProvider:
+    # provider without availability probes, like the nsi2 provider
+
+    def __init__(self):
+        self.failing_ports = []
+        self.connections = {}
+        self.terminated = []
+
+    def reserve(self, header, connection_id, global_reservation_id, description, criteria):
+        sd = criteria.service_def
+        if sd.source_stp.port in self.failing_ports or sd.dest_stp.port in self.failing_ports:
+            return defer.fail( error.STPUnavailableError('Port not available') )
+        connection_id = 'SC-%i' % len(self.connections)
+        self.connections[connection_id] = (sd.source_stp.port, sd.dest_stp.port)
+        return defer.succeed(connection_id)
+
+    def terminate(self, header, connection_id):
+        self.terminated.append(connection_id)
+        return defer.succeed(None)
+
+
+
+class FakeConnection:
+    # just enough of database.ServiceConnection for reserving paths
+
+    def __init__(self):
+        self.id = 1
+        self.connection_id = 'AR-T1'
+        self.global_reservation_id = None
+        self.description = None
+        self.requester_nsa = 'test-requester:nsa'
+        self.reservation_state = state.RESERVE_CHECKING
+        self.provision_state = state.RELEASED
+        self.lifecycle_state = state.CREATED
+
+    def save(self):
+        return defer.succeed(self)
+
+
+
+class FakeRequester:
+
+    def __init__(self):
+        self.reserve_failures = []
+
+    def reserveFailed(self, header, connection_id, connection_states, err):
+        self.reserve_failures.append( (connection_id, connection_states, err) )
+
+
+
+class AggregatorSetup:
+
+    def setUp(self):
+        self.topology = nml.Topology()
+        self.providers = {}
+
+        for name, spec in [ ('aruba', topology.ARUBA_TOPOLOGY), ('bonaire', topology.BONAIRE_TOPOLOGY),
+                            ('curacao', topology.CURACAO_TOPOLOGY), ('dominica', topology.DOMINICA_TOPOLOGY) ]:
+            network, _ = nrmparser.parseTopologySpec(StringIO(spec), name)
+            nsi_agent = nsa.NetworkServiceAgent(name + ':nsa', name + '-endpoint')
+            self.topology.addNetwork(network, nsi_agent)
+            self.providers[nsi_agent.urn()] = RemoteProvider()
+
+        self.aruba = ProbedProvider( [] )
+        self.providers[ nsa.NetworkServiceAgent('aruba:nsa', 'aruba-endpoint').urn() ] = self.aruba
+        self.bonaire  = self.providers[ nsa.NetworkServiceAgent('bonaire:nsa',  'bonaire-endpoint').urn() ]
+        self.dominica = self.providers[ nsa.NetworkServiceAgent('dominica:nsa', 'dominica-endpoint').urn() ]
+
+        pr = provreg.ProviderRegistry(self.providers, {})
+        self.aggregator = aggregator.Aggregator('aruba:topology', nsa.NetworkServiceAgent('aruba:nsa', 'aruba-endpoint'), self.topology, None, pr)
+
+        self.clock = task.Clock()
+        self.aggregator.clock = self.clock
+        self.aggregator.availability_hints.clock = self.clock
+
+        start_time = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        schedule = nsa.Schedule(start_time, start_time + datetime.timedelta(hours=1))
+        sd = nsa.EthernetVLANService(ARUBA_PS, BONAIRE_PS, 100, 1500, 0)
+        self.criteria = nsa.Criteria(0, schedule, sd)
+
+        self.paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=3)
+        self.assertEquals( [ len(p) for p in self.paths ], [2, 3, 4] )
+
+
+
+class PathRankingTest(AggregatorSetup, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def testRankingKeepsOrder(self):
+
+        ranked = yield self.aggregator.rankPaths(self.paths, self.criteria)
+        self.assertEquals(ranked, self.paths)
+        self.assertEquals(len(self.aruba.probes), 3)
+
+        # identical links are only probed once
+        self.aruba.probes = []
+        ranked = yield self.aggregator.rankPaths(self.paths + self.paths, self.criteria)
+        self.assertEquals(len(ranked), 6)
+        self.assertEquals(len(self.aruba.probes), 3)
+
+
+    @defer.inlineCallbacks
+    def testUnavailableLink(self):
+
+        self.aruba.unavailable_ports.append('aruba:bon')
+
+        ranked = yield self.aggregator.rankPaths(self.paths, self.criteria)
+        self.assertEquals( [ len(p) for p in ranked ], [3, 4, 2] )
+
+
+    @defer.inlineCallbacks
+    def testProbeFailure(self):
+
+        link = nsa.Link('aruba:topology', 'aruba:ps', 'error', [LABEL], [LABEL])
+        likelihood = yield self.aggregator.probeLink(link, self.criteria)
+        self.assertEquals(likelihood, aggregator.UNKNOWN)
+
+        link = nsa.Link('nowhere:topology', 'nowhere:ps', 'nowhere:bon', [LABEL], [LABEL])
+        likelihood = yield self.aggregator.probeLink(link, self.criteria)
+        self.assertEquals(likelihood, aggregator.UNAVAILABLE)
+
+
+    @defer.inlineCallbacks
+    def testRecentFailures(self):
+
+        hints = self.aggregator.availability_hints
+        link = self.paths[1][1] # dominica
+
+        hints.reserveFailed('dominica:topology')
+        likelihood = yield self.aggregator.probeLink(link, self.criteria)
+        self.assertEquals(likelihood, aggregator.RECENTLY_FAILED)
+
+        # the path through curacao has the same recent failure, and an unknown link more
+        self.aruba.unavailable_ports.append('aruba:bon')
+        ranked = yield self.aggregator.rankPaths(self.paths, self.criteria)
+        self.assertEquals( [ len(p) for p in ranked ], [3, 4, 2] )
+
+        hints.reserveSucceeded('dominica:topology')
+        likelihood = yield self.aggregator.probeLink(link, self.criteria)
+        self.assertEquals(likelihood, aggregator.UNKNOWN)
+
+        # failures expire
+        hints.reserveFailed('dominica:topology')
+        self.clock.advance(aggregator.AVAILABILITY_HINT_TIMEOUT + 1)
+        self.assertEquals(hints.likelihood('dominica:topology'), aggregator.UNKNOWN)
+        self.assertEquals(hints.failures, {})
+
+
+
+class PathRetryTest(AggregatorSetup, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def testKeepSharedSegments(self):
+
+        conn = FakeConnection()
+        reserved = {}
+
+        bonaire_link = nsa.Link('bonaire:topology', 'bonaire:cur', 'bonaire:ps', [LABEL], [LABEL])
+        first_path  = [ nsa.Link('dominica:topology', 'dominica:aru', 'dominica:cur', [LABEL], [LABEL]), bonaire_link ]
+        second_path = [ nsa.Link('dominica:topology', 'dominica:aru', 'dominica:bon', [LABEL], [LABEL]),
+                        nsa.Link('curacao:topology',  'curacao:dom',  'curacao:bon',  [LABEL], [LABEL]), bonaire_link ]
+
+        self.dominica.failing_ports.append('dominica:cur')
+        results = yield self.aggregator._reservePath(conn, self.criteria, first_path, reserved)
+        self.assertEquals( [ success for success, _ in results ], [ False, True ] )
+        self.assertEquals(len(reserved), 1)
+        self.assertEquals(self.aggregator.availability_hints.likelihood('dominica:topology'), aggregator.RECENTLY_FAILED)
+
+        # the failed reservation is not outstanding, the bonaire one is
+        self.assertEquals( [ r['order_id'] for r in self.aggregator.reservations.values() ], [ 1 ] )
+
+        # the next path shares the bonaire segment, which is kept, and gets a new position
+        yield self.aggregator._releaseSegments(reserved, second_path)
+        self.assertEquals(self.bonaire.terminated, [])
+
+        results = yield self.aggregator._reservePath(conn, self.criteria, second_path, reserved)
+        self.assertEquals( [ success for success, _ in results ], [ True, True, True ] )
+        self.assertEquals(len(self.bonaire.connections), 1)
+        self.assertEquals(len(reserved), 3)
+        self.assertEquals(sorted( [ r['order_id'] for r in self.aggregator.reservations.values() ] ), [ 0, 1, 2 ])
+
+        # giving up terminates everything
+        yield self.aggregator._releaseSegments(reserved, [])
+        self.assertEquals(reserved, {})
+        self.assertEquals(self.aggregator.reservations, {})
+        self.assertEquals(self.bonaire.terminated, [ 'SC-0' ])
+        self.assertEquals(len(self.aggregator.abandoned), 3)
+
+        # terminate confirmations for dropped segments are swallowed
+        header = nsa.NSIHeader('aruba:nsa', nsa.NetworkServiceAgent('bonaire:nsa', 'bonaire-endpoint').urn())
+        yield self.aggregator.terminateConfirmed(header, 'SC-0')
+        self.assertEquals(len(self.aggregator.abandoned), 2)
+
+        # the rest are dropped when the confirmations do not arrive
+        self.clock.advance(aggregator.ABANDONED_TIMEOUT + 1)
+        self.assertEquals(self.aggregator.abandoned, {})
+
+
+    @defer.inlineCallbacks
+    def testLateReserveFailure(self):
+
+        conn = FakeConnection()
+        self.patch(database.ServiceConnection, 'find', staticmethod(lambda conn_id : defer.succeed(conn)))
+        self.aggregator.parent_requester = FakeRequester()
+
+        dominica_nsa = nsa.NetworkServiceAgent('dominica:nsa', 'dominica-endpoint').urn()
+
+        def failSubConnection(network, err):
+            correlation_id, resv_info = [ (cid, ri) for cid, ri in self.aggregator.reservations.items() if ri['source_network'] == network ][0]
+            sc_id = [ sc_id for (_, cid, sc_id) in search.reserved.values() if cid == correlation_id ][0]
+            header = nsa.NSIHeader('aruba:nsa', dominica_nsa, correlation_id=correlation_id)
+            return self.aggregator.reserveFailed(header, sc_id, None, err)
+
+        bonaire_link = nsa.Link('bonaire:topology', 'bonaire:cur', 'bonaire:ps', [LABEL], [LABEL])
+        first_path  = [ nsa.Link('dominica:topology', 'dominica:aru', 'dominica:cur', [LABEL], [LABEL]), bonaire_link ]
+        second_path = [ nsa.Link('dominica:topology', 'dominica:aru', 'dominica:bon', [LABEL], [LABEL]),
+                        nsa.Link('curacao:topology',  'curacao:dom',  'curacao:bon',  [LABEL], [LABEL]), bonaire_link ]
+
+        search = aggregator.PathSearch(self.criteria, [ first_path, second_path ], self.clock.seconds())
+        self.aggregator.path_searches[conn.id] = search
+
+        results = yield self.aggregator._searchPaths(conn, search)
+        self.assertEquals( [ success for success, _ in results ], [ True, True ] )
+        self.assertEquals(self.aggregator.path_lengths, { conn.id : 2 })
+
+        # the dominica link fails after it has been acked, so the next path is tried
+        yield failSubConnection('dominica:topology', error.STPUnavailableError('Port gone'))
+        self.assertEquals(search.attempts, 2)
+        self.assertEquals(self.aggregator.path_lengths, { conn.id : 3 })
+        self.assertEquals(len(self.dominica.connections), 2)
+        self.assertEquals(self.dominica.terminated, [])
+        self.assertEquals(self.bonaire.terminated, []) # shared with the new path
+
+        # no more paths, so the reservation fails and is released
+        yield failSubConnection('dominica:topology', error.STPUnavailableError('Port gone again'))
+        self.assertEquals(self.aggregator.path_searches, {})
+        self.assertEquals(self.aggregator.path_lengths, {})
+        self.assertEquals(self.aggregator.reservations, {})
+        self.assertEquals(self.bonaire.terminated, [ 'SC-0' ])
+        self.assertEquals(conn.lifecycle_state, state.TERMINATED)
+        self.assertEquals(self.aggregator.reserve_statistics.failed, 1)
+
+        [ (connection_id, connection_states, err) ] = self.aggregator.parent_requester.reserve_failures
+        self.assertEquals(connection_id, conn.connection_id)
+        self.assertEquals(connection_states[0], state.RESERVE_FAILED)
+        self.assertTrue(err.check(error.STPUnavailableError))
+
+
+
+class ReserveStatisticsTest(unittest.TestCase):
+
+    def testStatistics(self):
+
+        stats = aggregator.ReserveStatistics(samples=10)
+        self.assertEquals(stats.latencyPercentile(50), None)
+
+        for latency in range(1, 21):
+            stats.record(1 + latency % 3, latency, latency % 4 != 0)
+
+        self.assertEquals(stats.requests, 20)
+        self.assertEquals(stats.failed, 5)
+        self.assertEquals(stats.succeeded, 15)
+        self.assertEquals(stats.attempts, 41)
+
+        # only the last 10 latencies are kept
+        self.assertEquals(stats.latencyPercentile(0), 11)
+        self.assertEquals(stats.latencyPercentile(50), 15)
+        self.assertEquals(stats.latencyPercentile(90), 19)
+        self.assertEquals(stats.latencyPercentile(100), 20)
+
+        self.assertEquals(stats.summary(), '20 requests, 15 succeeded, 5 failed, 2.05 paths per request, latency p50 15.000 / p95 20.000 seconds')
@@ -0,0 +1,226 @@
+import random
+import datetime
+
+from twisted.trial import unittest
+
+from opennsa import nsa, constants as cnt
+from opennsa.backends.common import calendar
+
+
+
+class IntervalTreeTest(unittest.TestCase):
+
+    def testOverlapMatchesLinearScan(self):
+
+        rng = random.Random(42)
+        tree = calendar.IntervalTree()
+        intervals = []
+
+        for _ in range(500):
+            start = rng.randint(0, 1000)
+            end   = start + rng.randint(1, 50)
+            tree.insert(start, end, 'r%i' % (start % 3))
+            intervals.append( (start, end, 'r%i' % (start % 3)) )
+
+        for _ in range(200):
+            victim = intervals.pop(rng.randint(0, len(intervals)-1))
+            tree.remove(*victim)
+
+        self.assertEquals(len(tree), len(intervals))
+        self.assertEquals(list(tree), sorted(intervals))
+
+        for _ in range(200):
+            qs = rng.randint(0, 1050)
+            qe = qs + rng.randint(1, 50)
+            expected = sorted( [ (s,e,v) for (s,e,v) in intervals if not (e < qs or s > qe) ] )
+            self.assertEquals(sorted(tree.overlaps(qs, qe)), expected)
+            self.assertEquals(tree.hasOverlap(qs, qe), len(expected) > 0)
+
+
+    def testBuild(self):
+
+        rng = random.Random(3)
+        intervals = []
+        for _ in range(300):
+            start = rng.randint(0, 100)
+            intervals.append( (start, start + rng.randint(1, 20), rng.choice( [None, 'a', 'b'] )) )
+
+        tree = calendar.IntervalTree.build(intervals)
+        self.assertEquals(len(tree), len(intervals))
+        self.assertEquals(list(tree), sorted(intervals))
+
+        for qs in range(0, 120, 7):
+            expected = sorted( [ (s,e,v) for (s,e,v) in intervals if not (e < qs or s > qs + 5) ] )
+            self.assertEquals(sorted(tree.overlaps(qs, qs + 5)), expected)
+
+        for interval in intervals:
+            tree.remove(*interval)
+        self.assertEquals(len(tree), 0)
+
+
+    def testDuplicateIntervals(self):
+
+        tree = calendar.IntervalTree()
+        tree.insert(1, 5)
+        tree.insert(1, 5)
+        tree.insert(1, 5, 'x')
+        self.assertEquals(list(tree.overlaps(5, 8)), [ (1,5,None), (1,5,None), (1,5,'x') ])
+
+        tree.remove(1, 5)
+        tree.remove(1, 5)
+        self.assertRaises(KeyError, tree.remove, 1, 5)
+        self.assertEquals(list(tree), [ (1,5,'x') ])
+        tree.remove(1, 5, 'x')
+        self.assertEquals(len(tree), 0)
+
+        self.assertRaises(KeyError, tree.remove, 1, 5)
+
+
+
+class ReservationCalendarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calendar = calendar.ReservationCalendar()
+        self.t0 = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+    def time(self, hours):
+        return self.t0 + datetime.timedelta(hours=hours)
+
+
+    def testAvailability(self):
+
+        self.calendar.addReservation('port-1', self.time(0), self.time(2))
+
+        self.failIf(self.calendar.isAvailable('port-1', self.time(1), self.time(3)))
+        self.failIf(self.calendar.isAvailable('port-1', self.time(2), self.time(3))) # shared end point is an overlap
+        self.failUnless(self.calendar.isAvailable('port-1', self.time(3), self.time(4)))
+        self.failUnless(self.calendar.isAvailable('port-2', self.time(0), self.time(2)))
+
+
+    def testRemoveReservation(self):
+
+        self.calendar.addReservation('port-1', self.time(0), self.time(2))
+        self.calendar.removeReservation('port-1', self.time(0), self.time(2))
+
+        self.failUnless(self.calendar.isAvailable('port-1', self.time(0), self.time(2)))
+        self.assertRaises(ValueError, self.calendar.removeReservation, 'port-1', self.time(0), self.time(2))
+
+
+    def testLoadReservations(self):
+
+        self.calendar.loadReservations( [ ('port-1', self.time(0), self.time(2)), ('port-2', self.time(1), self.time(3)) ] )
+
+        self.failIf(self.calendar.isAvailable('port-1', self.time(1), self.time(3)))
+        self.failUnless(self.calendar.isAvailable('port-1', self.time(3), self.time(4)))
+        self.failIf(self.calendar.isAvailable('port-2', self.time(2), self.time(3)))
+
+        # non-empty calendar, reservations are added one by one
+        self.calendar.loadReservations( [ ('port-1', self.time(5), self.time(6)) ] )
+        self.failIf(self.calendar.isAvailable('port-1', self.time(5), self.time(6)))
+
+        self.calendar.removeReservation('port-2', self.time(1), self.time(3))
+        self.failUnless(self.calendar.isAvailable('port-2', self.time(2), self.time(3)))
+        self.failIf(self.calendar.isAvailable('port-1', self.time(2), self.time(3)))
+
+
+    def testAvailableLabelValues(self):
+
+        # vlans are a per-port resource
+        getResource = lambda port, label_type, label_value : '%s.%s' % (port, label_value)
+        label = nsa.Label(cnt.ETHERNET_VLAN, '1780-1784')
+
+        self.calendar.addReservation('port-1.1780', self.time(0), self.time(2))
+        self.calendar.addReservation('port-2.1781', self.time(0), self.time(2))
+        self.calendar.addReservation('port-2.1782', self.time(5), self.time(6))
+
+        values = self.calendar.availableLabelValues(['port-1'], label, self.time(1), self.time(3), getResource)
+        self.assertEquals(list(values), [ 1781, 1782, 1783, 1784 ])
+
+        values = self.calendar.availableLabelValues(['port-1', 'port-2'], label, self.time(1), self.time(3), getResource)
+        self.assertEquals(list(values), [ 1782, 1783, 1784 ])
+
+        values = self.calendar.availableLabelValues(['port-1', 'port-2'], label, self.time(3), self.time(4), getResource)
+        self.assertEquals(list(values), [ 1780, 1781, 1782, 1783, 1784 ])
+
+
+    def testAvailableLabelValuesPortResource(self):
+
+        # entire port is the resource, like the dud backend
+        getResource = lambda port, label_type, label_value : port
+        label = nsa.Label(cnt.ETHERNET_VLAN, '1780-1784')
+
+        self.calendar.addReservation('port-1', self.time(0), self.time(2))
+
+        values = self.calendar.availableLabelValues(['port-1'], label, self.time(1), self.time(3), getResource)
+        self.assertEquals(list(values), [])
+
+
+    def testAvailableLabelValuesLookups(self):
+
+        # vlans are a global resource, like the brocade backend, so a vlan used on one port is busy on all ports
+        lookups = []
+        def getResource(port, label_type, label_value):
+            lookups.append( (port, label_value) )
+            return str(label_value)
+        label = nsa.Label(cnt.ETHERNET_VLAN, '1780-1784')
+
+        self.calendar.addReservation('1780', self.time(0), self.time(2))
+        self.calendar.addReservation('9999', self.time(0), self.time(2))
+
+        values = self.calendar.availableLabelValues(['port-1', 'port-2'], label, self.time(1), self.time(3), getResource)
+        self.assertEquals(list(values), [ 1781, 1782, 1783, 1784 ])
+
+        # first fit stops at the first free value, so only the ports and values up to it are looked up
+        lookups[:] = []
+        values = self.calendar.availableLabelValues(['port-1', 'port-2'], label, self.time(10), self.time(20), getResource)
+        self.assertEquals(next(values), 1780)
+        self.assertEquals(lookups, [ ('port-1', 1780), ('port-2', 1780) ])
+
+
+
+class CapacityCalendarTest(unittest.TestCase):
+
+    def testPeakMatchesLinearScan(self):
+
+        rng = random.Random(7)
+        timeline = calendar.CapacityTimeline()
+        reservations = []
+
+        for _ in range(300):
+            start = rng.randint(0, 500)
+            end   = start + rng.randint(1, 40)
+            bw    = rng.choice( [100, 200, 500] )
+            timeline.add(start, end, bw)
+            reservations.append( (start, end, bw) )
+
+        for _ in range(100):
+            timeline.remove(*reservations.pop(rng.randint(0, len(reservations)-1)))
+
+        def linearPeak(qs, qe):
+            points = set([qs, qe] + [ s for (s,e,b) in reservations if qs <= s <= qe ])
+            return max( sum( [ b for (s,e,b) in reservations if s <= t <= e ] ) for t in points )
+
+        for _ in range(200):
+            qs = rng.randint(0, 550)
+            qe = qs + rng.randint(0, 40)
+            self.assertEquals(timeline.peak(qs, qe), linearPeak(qs, qe))
+
+
+    def testCanProvideBandwidth(self):
+
+        cc = calendar.CapacityCalendar()
+        cc.addReservation('port-1', 600, 10, 20)
+        cc.addReservation('port-1', 300, 20, 30) # shares end point, so both count at 20
+
+        self.assertEquals(cc.committedBandwidth('port-1', 0, 9), 0)
+        self.assertEquals(cc.committedBandwidth('port-1', 15, 25), 900)
+        self.assertEquals(cc.committedBandwidth('port-1', 21, 25), 300)
+
+        self.failUnless(cc.canProvideBandwidth('port-1', 1000, 700, 21, 40))
+        self.failIf(cc.canProvideBandwidth('port-1', 1000, 500, 5, 15))
+        self.failUnless(cc.canProvideBandwidth('port-2', 1000, 1000, 5, 15))
+
+        cc.removeReservation('port-1', 600, 10, 20)
+        self.failUnless(cc.canProvideBandwidth('port-1', 1000, 500, 5, 15))
+        self.assertRaises(ValueError, cc.removeReservation, 'port-1', 600, 10, 20)
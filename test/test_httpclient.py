@@ -0,0 +1,150 @@
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.web import server, resource, client as twclient
+from twisted.web.error import Error as WebError
+
+from opennsa.protocols.shared import httpclient
+
+
+
+class CountingSite(server.Site):
+
+    def __init__(self, resource):
+        server.Site.__init__(self, resource)
+        self.connections = 0
+        self.channels = []
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        channel = server.Site.buildProtocol(self, addr)
+        self.channels.append(channel)
+        return channel
+
+
+
+class EchoResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.in_progress = 0
+        self.max_in_progress = 0
+        self.delayed = []
+        self.dropped = 0
+
+    def render_POST(self, request):
+        body = request.content.read()
+        if request.postpath == ['fault']:
+            request.setResponseCode(500)
+            return '<fault>' + body + '</fault>'
+        if request.postpath == ['empty']:
+            request.setResponseCode(204)
+            return ''
+        if request.postpath == ['drop']:
+            # request is received, but the connection is closed before replying
+            self.dropped += 1
+            request.transport.loseConnection()
+            return server.NOT_DONE_YET
+        if request.postpath == ['slow']:
+            # reply later, so requests pile up
+            self.in_progress += 1
+            self.max_in_progress = max(self.in_progress, self.max_in_progress)
+            def reply():
+                self.in_progress -= 1
+                request.write(body)
+                request.finish()
+            self.delayed.append(reactor.callLater(0.01, reply))
+            return server.NOT_DONE_YET
+        return body
+
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = EchoResource()
+        self.site = CountingSite(self.resource)
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%i/' % self.port.getHost().port
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield httpclient.closeConnections()
+        yield task.deferLater(reactor, 0, lambda : None)
+        yield self.port.stopListening()
+
+
+    @defer.inlineCallbacks
+    def testPersistentConnection(self):
+
+        for i in range(5):
+            reply = yield httpclient.soapRequest(self.url, 'action', '<message>%i</message>' % i)
+            self.assertEquals(reply, '<message>%i</message>' % i)
+
+        self.assertEquals(self.site.connections, 1)
+
+
+    @defer.inlineCallbacks
+    def testReplyStatus(self):
+
+        reply = yield httpclient.httpRequest(self.url + 'empty', 'payload', {})
+        self.assertEquals(reply, '')
+
+        try:
+            yield httpclient.httpRequest(self.url + 'fault', 'payload', {})
+            self.fail('Request should have failed')
+        except WebError as e:
+            self.assertEquals( (e.status, e.response), ('500', '<fault>payload</fault>') )
+
+        # connection is still good after the fault
+        reply = yield httpclient.httpRequest(self.url, 'payload', {})
+        self.assertEquals(reply, 'payload')
+        self.assertEquals(self.site.connections, 1)
+
+        # and no https without a context factory
+        yield self.assertFailure(httpclient.httpRequest('https://127.0.0.1:1/', 'payload', {}), httpclient.HTTPRequestError)
+
+
+    @defer.inlineCallbacks
+    def testHostConnectionLimit(self):
+
+        defs = [ httpclient.httpRequest(self.url + 'slow', str(i), {}) for i in range(httpclient.MAX_CONNECTIONS_PER_HOST * 2) ]
+        replies = yield defer.gatherResults(defs)
+
+        self.assertEquals(replies, [ str(i) for i in range(httpclient.MAX_CONNECTIONS_PER_HOST * 2) ])
+        self.assertEquals(self.resource.max_in_progress, httpclient.MAX_CONNECTIONS_PER_HOST)
+        self.assertEquals(self.site.connections, httpclient.MAX_CONNECTIONS_PER_HOST)
+
+
+    @defer.inlineCallbacks
+    def testServerClosesConnection(self):
+
+        reply = yield httpclient.httpRequest(self.url, 'one', {})
+        self.assertEquals(reply, 'one')
+
+        # the server closes the idle connection, and the next request gets a new one
+        for channel in self.site.channels:
+            channel._channel.transport.loseConnection()
+        yield task.deferLater(reactor, 0.05, lambda : None)
+        reply = yield httpclient.httpRequest(self.url, 'two', {})
+        self.assertEquals(reply, 'two')
+        self.assertEquals(self.site.connections, 2)
+
+
+    @defer.inlineCallbacks
+    def testPostNotResent(self):
+
+        # the server may have processed the request, so it must not be sent again
+        # (closed connections are not errors for httpRequest, so there is just no reply)
+        reply = yield httpclient.httpRequest(self.url + 'drop', 'reserve', {})
+        self.assertEquals(reply, None)
+        self.assertEquals(self.resource.dropped, 1)
+
+        try:
+            yield httpclient.getClient().request(self.url + 'drop', 'POST', {}, 'reserve', 5, None, lambda r : r)
+            self.fail('Request should have failed')
+        except twclient.ResponseNeverReceived:
+            pass
+        self.assertEquals(self.resource.dropped, 2)
@@ -18,6 +18,8 @@ class FakeTopology:
 class InterfaceTest(unittest.TestCase):
 
     def testGenericBackend(self):
+        # there is no database, so the backend must not restore its schedule when the reactor runs
+        self.patch(genericbackend.reactor, 'callWhenRunning', lambda *args, **kwargs : None)
         ft = FakeTopology('network', 'network')
         simple_backend = genericbackend.GenericBackend('network', ft, None, None, None)
         verifyObject(INSIProvider, simple_backend)
@@ -15,7 +15,11 @@ bi-ethernet     somelight       netherlight#somelight-(in|out)  vlan:1780-1780
 bi-ethernet     uvalight        uvalight#uvalight-(in|out)      vlan:1780-1783  1000    em2
 """
 
-# uni-ethernet    test            uvalight:ndn-uvalight           vlan:1780-1783      em2
+UNI_NRM_ENTRY = \
+"""
+uni-ethernet    ps-in           -                               vlan:1780-1788  1000    em0
+uni-ethernet    uvalight-out    uvalight#nordunet-in            vlan:1780-1783  500     em1
+"""
 
 class NRMParserTest(unittest.TestCase):
 
@@ -32,3 +36,20 @@ class NRMParserTest(unittest.TestCase):
 
         # should test alias as well
 
+
+    def testUnidirectionalPorts(self):
+
+        source = StringIO.StringIO(UNI_NRM_ENTRY)
+        network, pim = nrmparser.parseTopologySpec(source, 'dud')
+
+        self.assertEquals( [ p.id_ for p in network.inbound_ports ],  [ 'dud:ps-in' ] )
+        self.assertEquals( [ p.id_ for p in network.outbound_ports ], [ 'dud:uvalight-out' ] )
+        self.assertEquals( network.bidirectional_ports, [] )
+
+        port = network.getPort('dud:uvalight-out')
+        self.assertEquals(port.remote_port, 'uvalight:nordunet-in')
+        self.assertEquals(port.bandwidth, 500)
+        self.assertEquals(pim.get('dud:uvalight-out'), 'em1')
+
+        bad_entry = 'uni-ethernet    uvalight    uvalight#nordunet-in    vlan:1780-1783  500    em1'
+        self.assertRaises(nrmparser.NRMSpecificationError, nrmparser.parseTopologySpec, StringIO.StringIO(bad_entry), 'dud')
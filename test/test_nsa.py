@@ -1,3 +1,6 @@
+import random
+import itertools
+
 from twisted.trial import unittest
 
 from opennsa import nsa
@@ -34,18 +37,140 @@ class LabelTest(unittest.TestCase):
 
     def testLabelValueEnumeration(self):
 
-        self.assertEquals(nsa.Label('', '1-2,3').enumerateValues(),        [ 1,2,3 ] )
-        self.assertEquals(nsa.Label('', '1-3,2').enumerateValues(),        [ 1,2,3 ] )
-        self.assertEquals(nsa.Label('', '1-3,3,1-2').enumerateValues(),    [ 1,2,3 ] )
-        self.assertEquals(nsa.Label('', '2-4,8,1-3').enumerateValues(),    [ 1,2,3,4,8 ] )
+        self.assertEquals(list(nsa.Label('', '1-2,3').enumerateValues()),        [ 1,2,3 ] )
+        self.assertEquals(list(nsa.Label('', '1-3,2').enumerateValues()),        [ 1,2,3 ] )
+        self.assertEquals(list(nsa.Label('', '1-3,3,1-2').enumerateValues()),    [ 1,2,3 ] )
+        self.assertEquals(list(nsa.Label('', '2-4,8,1-3').enumerateValues()),    [ 1,2,3,4,8 ] )
+
+
+    def testLazyLabelValues(self):
+
+        label = nsa.Label('', '10-19,30,40-1000000000')
+
+        self.assertEquals(len(label), 10 + 1 + 999999961)
+        self.assertEquals(label.minValue(), 10)
+        self.assertEquals(label.maxValue(), 1000000000)
+        self.assertEquals(list(itertools.islice(label, 12)), range(10, 20) + [ 30, 40 ])
+        self.failUnless(999999999 in label)
+
+
+    def testLabelSplit(self):
+
+        label = nsa.Label('', '1-3,5,7-9')
+
+        lower, upper = label.split(8)
+        self.assertEquals(lower.values, [ (1,3), (5,5), (7,7) ])
+        self.assertEquals(upper.values, [ (8,9) ])
+
+        lower, upper = label.split(5)
+        self.assertEquals(lower.values, [ (1,3) ])
+        self.assertEquals(upper.values, [ (5,5), (7,9) ])
+
+        self.assertEquals(label.split(1), (None, label))
+        self.assertEquals(label.split(10), (label, None))
+
+
+    def testRandomLabel(self):
+
+        label = nsa.Label('', '1,10-12')
+        values = [ label.randomLabel() for _ in range(400) ]
+        self.assertEquals(set(values), set( [1, 10, 11, 12] ))
+        self.failUnless(values.count(1) < 200) # the single value range used to be picked half of the time
 
 
     def testContainedLabelsIntersection(self):
 
-        self.failUnlessEquals(nsa.Label('', '80-89').intersect(nsa.Label('','81-82')).enumerateValues(), [ 81,82] )
+        self.failUnlessEquals(list(nsa.Label('', '80-89').intersect(nsa.Label('','81-82')).enumerateValues()), [ 81,82] )
 
 
     def testIntersectedLabelUnderAndSingleValued(self):
 
         self.failUnlessRaises(nsa.EmptyLabelSet, nsa.Label('', '1781-1784').intersect, nsa.Label('', '1780-1780') )
 
+
+
+    def testLabelUnionDifference(self):
+
+        l13 = nsa.Label('', '1-3')
+        l48 = nsa.Label('', '4-8')
+        l26 = nsa.Label('', '2-6')
+
+        self.assertEquals( l13.union(l48).values,       [ (1,8) ] )
+        self.assertEquals( l13.union(l26).values,       [ (1,6) ] )
+        self.assertEquals( l48.difference(l26).values,  [ (7,8) ] )
+        self.assertEquals( l26.difference(nsa.Label('', '3,5')).values, [ (2,2), (4,4), (6,6) ] )
+
+        self.assertRaises(nsa.EmptyLabelSet, l13.difference, l13)
+
+
+    def testLabelMembershipAndFirstFree(self):
+
+        label = nsa.Label('', '2-4,8')
+
+        self.failUnless(2 in label)
+        self.failUnless(8 in label)
+        self.failIf(5 in label)
+        self.failIf(1 in label)
+
+        self.assertEquals(label.firstFreeValue(nsa.Label('', '1-3')), 4)
+        self.assertEquals(label.firstFreeValue(nsa.Label('', '1-7')), 8)
+        self.assertEquals(label.firstFreeValue(nsa.Label('', '1-8')), None)
+
+
+    def testLabelWithoutValues(self):
+
+        empty = nsa.Label('')
+        label = nsa.Label('', '2-4,8')
+        large = nsa.Label('', '5000-5010')
+
+        self.assertEquals( (len(empty), list(empty), empty.labelValue()), (0, [], '') )
+        self.failIf(3 in empty)
+        self.failIf(empty.intersects(label))
+        self.failIf(large.intersects(empty))
+        self.failUnless(empty.issubset(label))
+        self.failIf(large.issubset(empty))
+        self.assertEquals(label.firstFreeValue(empty), 2)
+        self.assertEquals(large.firstFreeValue(empty), 5000)
+        self.assertEquals(label.union(empty).values, label.values)
+        self.assertEquals(large.difference(empty).values, large.values)
+        self.assertRaises(nsa.EmptyLabelSet, empty.intersect, label)
+
+
+    def testBitsetAndRangeOperationsAgree(self):
+
+        # labels with values above the bitset bound use range operations, shift them up and compare
+        rng = random.Random(11)
+        shift = nsa.BITSET_LABEL_BOUND
+
+        def randomLabels():
+            ranges = []
+            for _ in range(rng.randint(1, 8)):
+                v1 = rng.randint(0, 200)
+                ranges.append( (v1, v1 + rng.randint(0, 20)) )
+            small = nsa.Label('', ','.join( [ '%i-%i' % r for r in ranges ] ))
+            large = nsa.Label('', ','.join( [ '%i-%i' % (r[0]+shift, r[1]+shift) for r in ranges ] ))
+            return small, large
+
+        def shifted(label):
+            return [ (v1+shift, v2+shift) for v1, v2 in label.values ]
+
+        for _ in range(100):
+            s1, l1 = randomLabels()
+            s2, l2 = randomLabels()
+
+            for operation in ('intersect', 'union', 'difference'):
+                try:
+                    small_values = shifted(getattr(s1, operation)(s2))
+                except nsa.EmptyLabelSet:
+                    small_values = None
+                try:
+                    large_values = getattr(l1, operation)(l2).values
+                except nsa.EmptyLabelSet:
+                    large_values = None
+                self.assertEquals(small_values, large_values)
+
+            ff = s1.firstFreeValue(s2)
+            self.assertEquals(ff + shift if ff is not None else None, l1.firstFreeValue(l2))
+
+            for value in range(0, 230, 3):
+                self.assertEquals(value in s1, value + shift in l1)
@@ -0,0 +1,107 @@
+import datetime
+
+from twisted.trial import unittest
+
+from opennsa import nsa, logging
+from opennsa.protocols.shared import minisoap
+from opennsa.protocols.nsi2 import helper
+from opennsa.protocols.nsi2.bindings import nsiconnection
+
+
+REQUESTER_NSA = 'urn:ogf:network:aruba.net:nsa:requester'
+PROVIDER_NSA  = u'urn:ogf:network:bonaire.net:nsa:<&>'
+CORRELATION_ID = 'urn:uuid:4b2b8a3e-4bb4-4c1b-a6e4-6f6c6c7d9a01'
+
+
+
+def treePayload(body_element):
+    header_element = helper.createHeader(REQUESTER_NSA, PROVIDER_NSA, correlation_id=CORRELATION_ID)
+    return minisoap.createSoapPayload(body_element, header_element)
+
+
+
+class TemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.header = nsa.NSIHeader(REQUESTER_NSA, PROVIDER_NSA, correlation_id=CORRELATION_ID)
+
+
+    def testAcknowledgement(self):
+
+        payload = helper.createGenericAcknowledgement(self.header)
+        self.assertEquals(payload, treePayload( nsiconnection.GenericAcknowledgmentType().xml(nsiconnection.acknowledgment) ))
+
+        header, ack = helper.parseRequest(payload)
+        self.assertEquals( (header.requester_nsa, header.provider_nsa, header.correlation_id), (REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID) )
+
+
+    def testReserveResponse(self):
+
+        connection_id = u'ARU-5%s&\xe6\xf8\xe5'
+        payload = helper.createReserveResponse(self.header, connection_id)
+        self.assertEquals(payload, treePayload( nsiconnection.ReserveResponseType(connection_id).xml(nsiconnection.reserveResponse) ))
+
+        header, response = helper.parseRequest(payload)
+        self.assertEquals(response.connectionId, connection_id)
+
+
+    def testGenericConfirmed(self):
+
+        for element_name in (nsiconnection.provisionConfirmed, nsiconnection.terminateConfirmed, nsiconnection.provisionConfirmed):
+            payload = helper.createGenericConfirmed(element_name, REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID, 'ARU-5')
+            self.assertEquals(payload, treePayload( nsiconnection.GenericConfirmedType('ARU-5').xml(element_name) ))
+
+        # no connection id gives an empty element, like from the bindings
+        payload = helper.createGenericConfirmed(nsiconnection.releaseConfirmed, REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID, None)
+        tree_payload = treePayload( nsiconnection.GenericConfirmedType(None).xml(nsiconnection.releaseConfirmed) )
+        self.assertEquals(helper.parseRequest(payload)[1].connectionId, helper.parseRequest(tree_payload)[1].connectionId)
+
+
+    def testDataPlaneStateChange(self):
+
+        timestamp = datetime.datetime(2014, 4, 1, 12, 30, 15)
+
+        for active, version, consistent in [ (True, 0, True), (False, 3, False), (True, 12, False) ]:
+            payload = helper.createDataPlaneStateChange(REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID, 'ARU-5', 7, timestamp, active, version, consistent)
+
+            dps = nsiconnection.DataPlaneStateChangeRequestType('ARU-5', 7, helper.createXMLTime(timestamp),
+                                                                nsiconnection.DataPlaneStatusType(active, version, consistent))
+            self.assertEquals(payload, treePayload( dps.xml(nsiconnection.dataPlaneStateChange) ))
+
+            header, dpsc = helper.parseRequest(payload)
+            dps = dpsc.dataPlaneStatus
+            self.assertEquals( (dps.active, int(dps.version), dps.versionConsistent), (active, version, consistent) )
+
+
+    def testMissingRequiredFields(self):
+
+        # the bindings refuse a header without correlation id, and so do the templates
+        self.failUnlessRaises(AssertionError, helper.createHeader, REQUESTER_NSA, PROVIDER_NSA, correlation_id=None)
+
+        header = nsa.NSIHeader(REQUESTER_NSA, PROVIDER_NSA)
+        header.correlation_id = None
+        self.failUnlessRaises(ValueError, helper.createGenericAcknowledgement, header)
+        self.failUnlessRaises(ValueError, helper.createReserveResponse, header, 'ARU-5')
+        self.failUnlessRaises(ValueError, helper.createGenericConfirmed, nsiconnection.provisionConfirmed, REQUESTER_NSA, PROVIDER_NSA, None, 'ARU-5')
+
+        # the bindings write None for these, which is not valid either
+        timestamp = datetime.datetime(2014, 4, 1, 12, 30, 15)
+        self.failUnlessRaises(ValueError, helper.createDataPlaneStateChange, REQUESTER_NSA, PROVIDER_NSA, None, 'ARU-5', 7, timestamp, True, 0, True)
+        self.failUnlessRaises(ValueError, helper.createDataPlaneStateChange, REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID, 'ARU-5', None, timestamp, True, 0, True)
+        self.failUnlessRaises(ValueError, helper.createDataPlaneStateChange, REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID, 'ARU-5', 7, timestamp, True, None, True)
+
+
+    def testPayloadLogging(self):
+
+        # the payload on the wire is compact, also with payload logging on, only the logged copy is indented
+        body_element = nsiconnection.GenericConfirmedType('ARU-5').xml(nsiconnection.provisionConfirmed)
+        compact = treePayload(body_element)
+        logging.setPayloadLogging(True)
+        self.addCleanup(logging.setPayloadLogging, False)
+        self.assertEquals(treePayload(body_element), compact)
+        self.assertEquals(helper.createGenericConfirmed(nsiconnection.provisionConfirmed, REQUESTER_NSA, PROVIDER_NSA, CORRELATION_ID, 'ARU-5'), compact)
+
+        indented = logging.indentPayload(compact)
+        self.failUnless(len(indented.split('\n')) > len(compact.split('\n')))
+        self.assertEquals(helper.parseRequest(indented)[1].connectionId, 'ARU-5')
+        self.assertEquals(logging.indentPayload('Internal Server Error'), 'Internal Server Error')
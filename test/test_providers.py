@@ -27,6 +27,11 @@ class GenericProviderTest:
         yield self.requester.reserve_commit_defer
 
         yield self.provider.terminate(self.header, response_cid)
+        yield self.requester.terminate_defer
+
+        # the connection was never activated, but must still release its resources
+        self.failUnlessEquals(self.backend.calendar.reservations, {})
+        self.failUnlessEquals(self.backend.capacity_calendar.ports, {})
 
 
     @defer.inlineCallbacks
@@ -267,6 +272,8 @@ class GenericProviderTest:
         yield self.provider.reserveAbort(self.header, acid)
         header, cid = yield self.requester.reserve_abort_defer
 
+        self.failUnlessEquals(self.backend.calendar.reservations, {})
+
         self.requester.reserve_defer = defer.Deferred()
 
         # try to reserve the same resources
@@ -427,22 +434,23 @@ class DUDBackendTest(GenericProviderTest, unittest.TestCase):
 
     def setUp(self):
 
+        # the backend restores its calendar from the database on creation
+        tcf = os.path.expanduser('~/.opennsa-test.json')
+        tc = json.load( open(tcf) )
+        database.setupDatabase( tc['database'], tc['database-user'], tc['database-password'])
+
         self.clock = task.Clock()
 
         self.requester = common.DUDRequester()
 
-        aruba_topo, pm = nrmparser.parseTopologySpec(StringIO.StringIO(topology.ARUBA_TOPOLOGY), self.base)
+        self.aruba_topo, self.port_map = nrmparser.parseTopologySpec(StringIO.StringIO(topology.ARUBA_TOPOLOGY), self.base)
 
-        self.backend = dud.DUDNSIBackend(self.network, aruba_topo, self.requester, pm, {})
+        self.backend = dud.DUDNSIBackend(self.network, self.aruba_topo, self.requester, self.port_map, {})
 
         self.provider = self.backend
         self.provider.scheduler.clock = self.clock
         self.provider.startService()
 
-        tcf = os.path.expanduser('~/.opennsa-test.json')
-        tc = json.load( open(tcf) )
-        database.setupDatabase( tc['database'], tc['database-user'], tc['database-password'])
-
         # request stuff
         self.start_time  = datetime.datetime.utcnow() + datetime.timedelta(seconds=2)
         self.end_time    = datetime.datetime.utcnow() + datetime.timedelta(seconds=10)
@@ -452,6 +460,56 @@ class DUDBackendTest(GenericProviderTest, unittest.TestCase):
         self.criteria = nsa.Criteria(0, self.schedule, self.sd)
 
 
+    @defer.inlineCallbacks
+    def testCalendarRestore(self):
+
+        # the dud backend has a resource per port, so the aborted reservation must come later
+        schedule = nsa.Schedule(self.end_time, self.end_time + datetime.timedelta(seconds=10))
+        criteria = nsa.Criteria(0, schedule, self.sd)
+
+        # one committed and one aborted reservation
+        self.header.newCorrelationId()
+        cid = yield self.provider.reserve(self.header, None, None, None, self.criteria)
+        yield self.requester.reserve_defer
+        yield self.provider.reserveCommit(self.header, cid)
+        yield self.requester.reserve_commit_defer
+
+        self.requester.reserve_defer = defer.Deferred()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.requester.reserve_defer
+        yield self.provider.reserveAbort(self.header, acid)
+        yield self.requester.reserve_abort_defer
+
+        backend = dud.DUDNSIBackend(self.network, self.aruba_topo, self.requester, self.port_map, {})
+        backend.scheduler.clock = self.clock
+        yield backend.waitForRestore()
+
+        self.failUnlessEquals(len(self.backend.calendar.reservations), 2)
+        for resource, reservations in self.backend.calendar.reservations.items():
+            self.failUnlessEquals(list(backend.calendar.reservations[resource]), list(reservations))
+        self.failUnlessEquals(sorted(backend.capacity_calendar.ports), sorted(self.backend.capacity_calendar.ports))
+        backend.scheduler.cancelAllCalls()
+
+
+    @defer.inlineCallbacks
+    def testRestoreWithoutPort(self):
+
+        # a held reservation on a port which has been removed from the topology must not stop the restore
+        self.header.newCorrelationId()
+        cid = yield self.provider.reserve(self.header, None, None, None, self.criteria)
+        yield self.requester.reserve_defer
+
+        topology_spec = topology.ARUBA_TOPOLOGY.replace('bi-ethernet     ps      -                       vlan:1780-1789  1000    em0\n', '')
+        topo, port_map = nrmparser.parseTopologySpec(StringIO.StringIO(topology_spec), self.base)
+        backend = dud.DUDNSIBackend(self.network, topo, self.requester, port_map, {})
+        backend.scheduler.clock = self.clock
+        yield backend.waitForRestore()
+
+        self.failIf(backend.scheduler.hasScheduledCall(cid))
+        self.failUnlessEquals(len(backend.calendar.reservations), 0)
+        backend.scheduler.cancelAllCalls()
+
+
     @defer.inlineCallbacks
     def tearDown(self):
         from opennsa.backends.common import genericbackend
@@ -0,0 +1,85 @@
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from opennsa.backends.common import scheduler
+
+
+
+class CallSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = scheduler.CallScheduler()
+        self.scheduler.clock = self.clock
+        self.calls = []
+
+
+    def tearDown(self):
+        self.scheduler.cancelAllCalls()
+
+
+    def scheduleIn(self, connection_id, seconds):
+        transition_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+        return self.scheduler.scheduleCall(connection_id, transition_time, self.calls.append, connection_id)
+
+
+    def testSingleTimer(self):
+
+        for i in range(10):
+            self.scheduleIn('conn-%i' % i, 10 - i)
+
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(3)
+        self.assertEquals(self.calls, [ 'conn-9', 'conn-8', 'conn-7' ])
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.failIf(self.scheduler.hasScheduledCall('conn-9'))
+        self.failUnless(self.scheduler.hasScheduledCall('conn-6'))
+
+        self.clock.advance(10)
+        self.assertEquals(len(self.calls), 10)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 0)
+
+
+    def testCancelCall(self):
+
+        self.scheduleIn('conn-1', 1)
+        d = self.scheduleIn('conn-2', 2)
+        self.scheduler.cancelCall('conn-1')
+        self.scheduler.cancelCall('conn-1') # cancelling twice is ok
+
+        self.failIf(self.scheduler.hasScheduledCall('conn-1'))
+
+        self.clock.advance(5)
+        self.assertEquals(self.calls, [ 'conn-2' ])
+        self.failUnless(d.called)
+
+
+    def testRescheduleAfterCancel(self):
+
+        self.scheduleIn('conn-1', 5)
+        self.scheduler.cancelCall('conn-1')
+        self.scheduleIn('conn-1', 1)
+
+        self.clock.advance(2)
+        self.assertEquals(self.calls, [ 'conn-1' ])
+
+        self.clock.advance(5)
+        self.assertEquals(self.calls, [ 'conn-1' ])
+
+
+    def testCallCancelsOther(self):
+
+        def cancelOther():
+            self.calls.append('conn-1')
+            self.scheduler.cancelCall('conn-2')
+
+        now = datetime.datetime.utcnow()
+        self.scheduler.scheduleCall('conn-1', now + datetime.timedelta(seconds=1), cancelOther)
+        self.scheduler.scheduleCall('conn-2', now + datetime.timedelta(seconds=2), self.calls.append, 'conn-2')
+
+        self.clock.advance(5) # both are due in the same round
+        self.assertEquals(self.calls, [ 'conn-1' ])
+
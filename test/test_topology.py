@@ -1,9 +1,18 @@
+import os
+import zlib
+import datetime
 from StringIO import StringIO
+from xml.etree import ElementTree as ET
 
 from twisted.trial import unittest
+from twisted.python import threadpool
+from twisted.internet import defer, reactor, task, address
+from twisted.web import server, static
+from twisted.web.test.requesthelper import DummyRequest
 
 from opennsa import nsa, error, constants as cnt
-from opennsa.topology import nml, nrmparser
+from opennsa.protocols.shared import httpclient
+from opennsa.topology import nml, nrmparser, nmlxml, fetcher, http, cache
 from . import topology
 
 
@@ -50,11 +59,11 @@ class TopologyTest(unittest.TestCase):
         lengths = [ len(path) for path in paths ]
         self.assertEquals(lengths, [2,3,4])
 
-        # test bandwidth - bw currently not in pathfinding
-        #paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 300)
-        #self.assertEquals(len(paths), 2)
-        #paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 800)
-        #self.assertEquals(len(paths), 1)
+        # test bandwidth
+        paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 300)
+        self.assertEquals(len(paths), 2)
+        paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 800)
+        self.assertEquals(len(paths), 1)
 
 
     def testNoSwapPathfinding(self):
@@ -210,5 +219,585 @@ class TopologyTest(unittest.TestCase):
     def testNoAvailableBandwidth(self):
         self.failUnlessRaises(error.BandwidthUnavailableError, self.topology.findPaths, ARUBA_PS, BONAIRE_PS, 1200)
 
-    testNoAvailableBandwidth.skip = 'Bandwidth currently not available in path finding'
 
+
+    def testPortIndex(self):
+
+        network_id, port = self.topology.getNetworkPort('aruba:ps')
+        self.assertEquals(network_id, ARUBA_NETWORK)
+        self.assertEquals(port.id_, 'aruba:ps')
+        self.failUnlessRaises(error.TopologyError, self.topology.getNetworkPort, 'aruba:no-such-port')
+
+        # update with a network where a port is gone
+        an = self.networks[0]
+        ports = [ p for p in an.bidirectional_ports if p.id_ != 'aruba:ps' ]
+        smaller = nml.Network(an.id_, an.name, an.inbound_ports, an.outbound_ports, ports)
+        self.topology.updateNetwork(smaller, self.nsas[0])
+        self.failUnlessRaises(error.TopologyError, self.topology.getNetworkPort, 'aruba:ps')
+        self.assertEquals(self.topology.getNetworkPort('aruba:ps-in')[0], ARUBA_NETWORK)
+
+        # a failed update, due to port id from another network, must leave the old entry in place
+        bn = self.networks[1]
+        conflicting = nml.Network(an.id_, an.name, an.inbound_ports, an.outbound_ports, ports + bn.bidirectional_ports[:1])
+        self.failUnlessRaises(error.TopologyError, self.topology.updateNetwork, conflicting, self.nsas[0])
+        self.assertEquals(sorted(self.topology.getNetwork(ARUBA_NETWORK).ports), sorted(smaller.ports))
+        self.assertEquals(self.topology.getNetworkPort(bn.bidirectional_ports[0].id_)[0], BONAIRE_NETWORK)
+
+
+    def testShortestPath(self):
+
+        # the shortest path should be the same as the first of all paths, with all kinds of label swapping
+        def check(bandwidth):
+            path = self.topology.findPath(ARUBA_PS, BONAIRE_PS, bandwidth)
+            self.assertEquals(path, self.topology.findPaths(ARUBA_PS, BONAIRE_PS, bandwidth)[0])
+            return path
+
+        self.assertEquals(len(check(100)), 2)
+
+        # take out the direct link, so the search must go further out
+        self.topology.adjacency[ARUBA_NETWORK] = [ edge for edge in self.topology.adjacency[ARUBA_NETWORK] if edge[1] != BONAIRE_NETWORK ]
+        self.topology.path_cache.clear() # topology changed behind the back of the cache
+        self.assertEquals( [ l.network for l in check(100) ], [ARUBA_NETWORK, DOMINICA_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.network for l in check(300) ], [ARUBA_NETWORK, DOMINICA_NETWORK, CURACAO_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals(self.topology.findPath(ARUBA_PS, BONAIRE_PS, 800), None)
+
+        self.networks[1].canSwapLabel = lambda _ : True
+        self.networks[3].canSwapLabel = lambda _ : True
+        self.topology.path_cache.clear() # topology changed behind the back of the cache
+        check(100)
+        check(300)
+
+        for nw in self.networks:
+            nw.canSwapLabel = lambda _ : True
+        self.topology.path_cache.clear() # topology changed behind the back of the cache
+        check(100)
+        check(300)
+
+        # no path with labels outside of the dominica - bonaire and dominica - curacao links
+        for nw in self.networks:
+            nw.canSwapLabel = lambda _ : False
+        self.topology.path_cache.clear() # topology changed behind the back of the cache
+        stp = nsa.STP(ARUBA_NETWORK, 'aruba:ps', [ nsa.Label(cnt.ETHERNET_VLAN, '1787-1789') ])
+        self.assertEquals(self.topology.findPath(stp, BONAIRE_PS, 100), None)
+
+
+    def testAdjacencyUpdate(self):
+
+        self.assertEquals(sorted( [ e[1] for e in self.topology.adjacency[ARUBA_NETWORK] ] ), [BONAIRE_NETWORK, DOMINICA_NETWORK])
+
+        # replacing bonaire without the port to aruba removes the edge both ways
+        bn = self.networks[1]
+        ports = [ p for p in bn.bidirectional_ports if p.id_ != 'bonaire:aru' ]
+        self.topology.updateNetwork(nml.Network(bn.id_, bn.name, bn.inbound_ports, bn.outbound_ports, ports), self.nsas[1])
+        self.assertEquals( [ e[1] for e in self.topology.adjacency[ARUBA_NETWORK] ], [DOMINICA_NETWORK])
+        self.assertEquals(sorted( [ e[1] for e in self.topology.adjacency[BONAIRE_NETWORK] ] ), [CURACAO_NETWORK, DOMINICA_NETWORK])
+
+        self.topology.updateNetwork(bn, self.nsas[1])
+        self.assertEquals(sorted( [ e[1] for e in self.topology.adjacency[ARUBA_NETWORK] ] ), [BONAIRE_NETWORK, DOMINICA_NETWORK])
+        self.assertEquals(self.topology.findPath(ARUBA_PS, BONAIRE_PS, 100)[0].dst_port, 'aruba:bon')
+
+
+    def testIncrementalUpdate(self):
+
+        bn = self.topology.getNetwork(BONAIRE_NETWORK)
+        cache = self.topology.path_cache
+        path = self.topology.findPath(ARUBA_PS, BONAIRE_PS, 100)
+        self.topology.findPath(nsa.STP(DOMINICA_NETWORK, 'dominica:ps', [LABEL]), ARUBA_PS, 100)
+
+        # a freshly parsed, identical, network leaves everything in place
+        same, _ = nrmparser.parseTopologySpec(StringIO(topology.BONAIRE_TOPOLOGY), 'bonaire')
+        self.topology.updateNetwork(same, self.nsas[1])
+        self.assertIdentical(self.topology.getNetwork(BONAIRE_NETWORK), bn)
+        self.assertEquals(len(cache), 2)
+
+        # changing the labels of one port only replaces that port
+        spec = topology.BONAIRE_TOPOLOGY.replace('vlan:1781-1782   100    em3', 'vlan:1781-1783   100    em3')
+        changed, _ = nrmparser.parseTopologySpec(StringIO(spec), 'bonaire')
+        self.topology.updateNetwork(changed, self.nsas[1])
+
+        patched = self.topology.getNetwork(BONAIRE_NETWORK)
+        self.assertEquals(patched.version, changed.version)
+        self.assertIdentical(patched.getPort('bonaire:aru'), bn.getPort('bonaire:aru'))
+        self.assertIdentical(patched.getPort('bonaire:dom'), changed.getPort('bonaire:dom'))
+        self.assertIdentical(patched.getPort('bonaire:dom-in'), changed.getPort('bonaire:dom-in'))
+        self.assertEquals(patched.getPort('bonaire:dom-in').orientation, nml.INGRESS)
+        self.assertEquals(sorted(patched.ports), sorted(bn.ports))
+        self.assertIdentical(patched.findBidirectionalPort('bonaire:dom-in', 'bonaire:dom-out'), changed.getPort('bonaire:dom'))
+
+        # the graph is the same, only paths through bonaire are dropped
+        self.assertEquals(sorted( [ e[1] for e in self.topology.adjacency[BONAIRE_NETWORK] ] ), [ARUBA_NETWORK, CURACAO_NETWORK, DOMINICA_NETWORK])
+        self.assertEquals(len(cache), 1)
+        self.assertEquals(self.topology.findPath(ARUBA_PS, BONAIRE_PS, 100), path)
+
+        # removing a port removes the edges to it, also from the other network
+        spec = '\n'.join( [ line for line in topology.BONAIRE_TOPOLOGY.split('\n') if not 'dominica#' in line ] )
+        smaller, _ = nrmparser.parseTopologySpec(StringIO(spec), 'bonaire')
+        self.topology.updateNetwork(smaller, self.nsas[1])
+        self.assertEquals(sorted( [ e[1] for e in self.topology.adjacency[BONAIRE_NETWORK] ] ), [ARUBA_NETWORK, CURACAO_NETWORK])
+        self.assertEquals(sorted( [ e[1] for e in self.topology.adjacency[DOMINICA_NETWORK] ] ), [ARUBA_NETWORK, CURACAO_NETWORK])
+        self.failUnlessRaises(error.TopologyError, self.topology.getNetworkPort, 'bonaire:dom-in')
+
+        # and adding it back restores them
+        self.topology.updateNetwork(changed, self.nsas[1])
+        self.assertEquals(sorted( [ e[1] for e in self.topology.adjacency[DOMINICA_NETWORK] ] ), [ARUBA_NETWORK, BONAIRE_NETWORK, CURACAO_NETWORK])
+        self.assertEquals(self.topology.getNetworkPort('bonaire:dom-in')[0], BONAIRE_NETWORK)
+
+
+    def testUpdateWithoutLabelValues(self):
+
+        # an empty label group gives a label without values
+        bn = self.networks[1]
+        empty_in  = nml.Port('bonaire:empty-in',  'empty-in',  [ nsa.Label(cnt.ETHERNET_VLAN, None) ])
+        no_labels = nml.Port('bonaire:none-in',   'none-in',   None)
+        updated = nml.Network(bn.id_, bn.name, bn.inbound_ports + [ empty_in, no_labels ], bn.outbound_ports, bn.bidirectional_ports)
+
+        self.topology.updateNetwork(updated, self.nsas[1])
+        self.assertIdentical(self.topology.getNetwork(BONAIRE_NETWORK).getPort('bonaire:empty-in'), empty_in)
+
+        # and the ports are compared on the next update as well
+        again = nml.Network(bn.id_, bn.name, bn.inbound_ports + [ empty_in, no_labels ], bn.outbound_ports, bn.bidirectional_ports)
+        self.topology.updateNetwork(again, self.nsas[1])
+        self.assertIdentical(self.topology.getNetwork(BONAIRE_NETWORK).getPort('bonaire:none-in'), no_labels)
+
+
+    def testKShortestPaths(self):
+
+        all_paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100)
+
+        self.assertEquals(self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=2), all_paths[:2])
+        self.assertEquals(self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=10), all_paths)
+        self.assertEquals(self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 300, max_paths=10), self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 300))
+        self.assertEquals(self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=3, exclude_networks=[DOMINICA_NETWORK]), all_paths[:1])
+
+        for nw in self.networks:
+            nw.canSwapLabel = lambda _ : True
+        self.topology.path_cache.clear() # topology changed behind the back of the cache
+        self.assertEquals(self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=10), self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100))
+
+        # make the direct link expensive
+        cost = nml.weightCost( { 'aruba:bon' : 10 } )
+        paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=3, cost=cost)
+        self.assertEquals( [ len(p) for p in paths ], [ 3, 4, 2 ])
+        self.assertEquals(self.topology.findPath(ARUBA_PS, BONAIRE_PS, 100, cost=cost), paths[0])
+
+        # the bonaire - dominica link has the least bandwidth
+        paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=3, cost=nml.bandwidthCost)
+        self.assertEquals( [ [ l.network for l in p ] for p in paths ],
+                           [ [ ARUBA_NETWORK, BONAIRE_NETWORK ], [ ARUBA_NETWORK, DOMINICA_NETWORK, CURACAO_NETWORK, BONAIRE_NETWORK ], [ ARUBA_NETWORK, DOMINICA_NETWORK, BONAIRE_NETWORK ] ] )
+
+
+    def testPathCache(self):
+
+        def rebuild(idx, version):
+            # same network, new network object with the given version
+            nw = self.networks[idx]
+            self.topology.updateNetwork(nml.Network(nw.id_, nw.name, nw.inbound_ports, nw.outbound_ports, nw.bidirectional_ports, version), self.nsas[idx])
+
+        cache = self.topology.path_cache
+        path = self.topology.findPath(ARUBA_PS, BONAIRE_PS, 100)
+        self.assertEquals( (cache.hits, cache.misses), (0, 1) )
+        self.assertEquals(self.topology.findPath(ARUBA_PS, BONAIRE_PS, 100), path)
+        self.assertEquals( (cache.hits, cache.misses), (1, 1) )
+        self.topology.findPath(ARUBA_PS, BONAIRE_PS, 300)
+        self.assertEquals( (cache.hits, cache.misses), (1, 2) )
+
+        # same ports, or network not on the path, keeps the entry
+        rebuild(1, datetime.datetime(2030, 1, 1))
+        rebuild(2, datetime.datetime(2030, 1, 1))
+        self.assertEquals(self.topology.findPath(ARUBA_PS, BONAIRE_PS, 100), path)
+        self.assertEquals( (cache.hits, cache.misses), (2, 2) )
+
+        # changed port in a network on the path
+        spec = topology.BONAIRE_TOPOLOGY.replace('vlan:1780-1789  1000    em0', 'vlan:1780-1788  1000    em0')
+        bn, _ = nrmparser.parseTopologySpec(StringIO(spec), 'bonaire')
+        self.topology.updateNetwork(bn, self.nsas[1])
+        self.assertEquals(self.topology.findPath(ARUBA_PS, BONAIRE_PS, 100)[-1].dst_labels[0].labelValue(), '1781-1788')
+        self.assertEquals( (cache.hits, cache.misses), (2, 3) )
+
+        # cost functions are cached by what they are, other callables are not cached
+        entries = len(cache)
+        self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=2, cost=nml.weightCost( { 'aruba:bon' : 10 } ))
+        self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=2, cost=nml.weightCost( { 'aruba:bon' : 10 } ))
+        self.assertEquals( (cache.hits, cache.misses, len(cache)), (3, 4, entries + 1) )
+        self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=2, cost=lambda port : 1)
+        self.assertEquals( (cache.hits, cache.misses, len(cache)), (3, 4, entries + 1) )
+
+        # cache must not hand out paths from a replaced network, even if the invalidation was missed
+        key = cache.entries.keys()[-1]
+        self.topology.networks[BONAIRE_NETWORK][0].version = datetime.datetime(2031, 1, 1)
+        self.assertEquals(cache.get(key, self.topology.networks), None)
+
+        # lru eviction
+        small = nml.PathCache(2)
+        for key in 'abc':
+            small.put(key, [ path ], self.topology.networks)
+        small.get('b', self.topology.networks)
+        small.put('d', [ path ], self.topology.networks)
+        self.assertEquals(small.entries.keys(), [ 'b', 'd' ])
+        small.invalidateNetwork(ARUBA_NETWORK)
+        self.assertEquals( (len(small), small.network_keys), (0, {}) )
+
+
+
+UNI_ARUBA_TOPOLOGY = """
+uni-ethernet    ps-in       -                   vlan:1780-1789  1000    em0
+uni-ethernet    bon-out     bonaire#aru-in      vlan:1780-1789  1000    em1
+uni-ethernet    cur-out     curacao#aru-in      vlan:1783-1786  1000    em2
+"""
+
+UNI_BONAIRE_TOPOLOGY = """
+uni-ethernet    aru-in      aruba#bon-out       vlan:1780-1789  1000    em0
+uni-ethernet    cur-out     curacao#bon-in      vlan:1780-1782   100    em1
+"""
+
+UNI_CURACAO_TOPOLOGY = """
+uni-ethernet    aru-in      aruba#cur-out       vlan:1783-1786  1000    em0
+uni-ethernet    bon-in      bonaire#cur-out     vlan:1780-1782   100    em1
+uni-ethernet    ps-out      -                   vlan:1780-1789  1000    em2
+"""
+
+
+class UnidirectionalTopologyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = nml.Topology()
+        for spec, name in ( (UNI_ARUBA_TOPOLOGY, 'aruba'), (UNI_BONAIRE_TOPOLOGY, 'bonaire'), (UNI_CURACAO_TOPOLOGY, 'curacao') ):
+            network, _ = nrmparser.parseTopologySpec(StringIO(spec), name)
+            self.topology.addNetwork(network, nsa.NetworkServiceAgent(name + ':nsa', name + '-endpoint'))
+
+
+    def testUnidirectionalPathfinding(self):
+
+        source_stp = nsa.STP(ARUBA_NETWORK,   'aruba:ps-in',    [LABEL])
+        dest_stp   = nsa.STP(CURACAO_NETWORK, 'curacao:ps-out', [LABEL])
+
+        paths = self.topology.findPaths(source_stp, dest_stp, 100)
+        self.assertEquals( [ [ (l.network, l.src_port, l.dst_port) for l in p ] for p in paths ], [
+            [ (ARUBA_NETWORK, 'aruba:ps-in', 'aruba:cur-out'), (CURACAO_NETWORK, 'curacao:aru-in', 'curacao:ps-out') ],
+            [ (ARUBA_NETWORK, 'aruba:ps-in', 'aruba:bon-out'), (BONAIRE_NETWORK, 'bonaire:aru-in', 'bonaire:cur-out'), (CURACAO_NETWORK, 'curacao:bon-in', 'curacao:ps-out') ] ] )
+        self.assertEquals(paths[0][0].src_labels, [ nsa.Label(cnt.ETHERNET_VLAN, '1783-1786') ])
+        self.assertEquals(paths[1][0].src_labels, [ nsa.Label(cnt.ETHERNET_VLAN, '1781-1782') ])
+
+        # labels and bandwidth rule out the direct and the bonaire link respectively
+        stp = nsa.STP(ARUBA_NETWORK, 'aruba:ps-in', [ nsa.Label(cnt.ETHERNET_VLAN, '1780-1781') ])
+        self.assertEquals(len(self.topology.findPath(stp, dest_stp, 100)), 3)
+        self.assertEquals(len(self.topology.findPath(source_stp, dest_stp, 200)), 2)
+        self.assertEquals(self.topology.findPath(stp, dest_stp, 200), None)
+
+        # going from the egress stp lists the same links, from the other end
+        reverse_paths = self.topology.findPaths(dest_stp, source_stp, 100)
+        self.assertEquals(len(reverse_paths), 2)
+        self.assertEquals( [ (l.network, l.src_port, l.dst_port) for l in reverse_paths[0] ],
+                           [ (CURACAO_NETWORK, 'curacao:ps-out', 'curacao:aru-in'), (ARUBA_NETWORK, 'aruba:cur-out', 'aruba:ps-in') ] )
+
+        self.failUnlessRaises(error.TopologyError, self.topology.findPaths, source_stp, nsa.STP(ARUBA_NETWORK, 'aruba:ps-in', [LABEL]), 100)
+
+        # without max_paths, the number of paths is still bounded
+        self.patch(nml, 'UNIDIRECTIONAL_MAX_PATHS', 1)
+        self.assertEquals(self.topology.findPaths(source_stp, dest_stp, 100), paths[:1])
+
+
+
+class NMLXMLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.network, _ = nrmparser.parseTopologySpec(StringIO(topology.BONAIRE_TOPOLOGY), 'bonaire')
+        self.nsi_agent  = nsa.NetworkServiceAgent('bonaire:nsa', 'http://bonaire.example.org/NSI/CS2', cnt.CS2_SERVICE_TYPE)
+        self.document   = ET.tostring( nmlxml.nsiXML(self.nsi_agent, self.network) )
+
+
+    def portInfo(self, network):
+        ports = network.inbound_ports + network.outbound_ports
+        info = [ (p.id_, p.name, [ str(l) for l in p.labels() ], p.remote_port) for p in ports ]
+        info += [ (p.id_, p.name, p.inbound_port.id_, p.outbound_port.id_) for p in network.bidirectional_ports ]
+        return sorted(info)
+
+
+    def testStreamingParser(self):
+
+        tree = ET.fromstring(self.document)
+        tree_agent   = nmlxml.parseNSIService( tree.find( str(nmlxml.NSI_SERVICE) ) )
+        tree_network = nmlxml.parseNMLTopology( tree.find( str(nmlxml.NML_TOPOLOGY) ) )
+
+        # feed in small chunks, so elements are split between chunks
+        parser = nmlxml.NSITopologyParser()
+        for idx in range(0, len(self.document), 7):
+            parser.feed( self.document[idx:idx+7] )
+        nsi_agent, network = parser.close()
+
+        self.assertEquals(nsi_agent.urn(), tree_agent.urn())
+        self.assertEquals(nsi_agent.endpoint, self.nsi_agent.endpoint)
+        self.assertEquals(network.id_, self.network.id_)
+        self.assertEquals(network.name, self.network.name)
+        self.assertEquals(self.portInfo(network), self.portInfo(tree_network))
+        self.assertEquals(self.portInfo(network), self.portInfo(self.network))
+
+        # the parsed elements are dropped along the way
+        self.assertEquals(len(parser.builder.open_elements), 0)
+        self.assertEquals(len(parser.builder.close()), 0)
+
+        nsi_agent, network = nmlxml.parseNSITopology(StringIO(self.document))
+        self.assertEquals(self.portInfo(network), self.portInfo(self.network))
+
+
+    def testIncompleteDocument(self):
+
+        parser = nmlxml.NSITopologyParser()
+        parser.feed(self.document[:len(self.document) / 2])
+        self.failUnlessRaises(ET.ParseError, parser.close)
+
+        document = self.document.replace('nsi:Service', 'nsi:Other')
+        self.failUnlessRaises(ValueError, nmlxml.parseNSITopology, StringIO(document))
+
+
+
+
+    @defer.inlineCallbacks
+    def testConsumer(self):
+
+        pool = threadpool.ThreadPool(0, 2, 'TestTopologyParser')
+        pool.start()
+        self.addCleanup(pool.stop)
+
+        # parts are parsed as they are written, also when compressed
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzip_document = compressor.compress(self.document) + compressor.flush()
+        for document, headers in ( (self.document, {}), (gzip_document, { 'content-encoding' : [ 'gzip' ] }) ):
+            consumer = fetcher.TopologyConsumer(pool)
+            consumer.headersReceived(headers)
+            for idx in range(0, len(document), 100):
+                consumer.write( document[idx:idx+100] )
+            yield self.assertFailure(consumer.parse(), ValueError)
+            consumer.close()
+            nsi_agent, network = yield consumer.parse()
+            self.assertEquals(self.portInfo(network), self.portInfo(self.network))
+            self.assertEquals(consumer.size, len(document))
+
+        consumer = fetcher.TopologyConsumer(pool)
+        consumer.write('<not-nsi/>')
+        consumer.write(self.document)
+        consumer.close()
+        yield self.assertFailure(consumer.parse(), AssertionError)
+
+
+
+class TopologyResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        network, _ = nrmparser.parseTopologySpec(StringIO(topology.ARUBA_TOPOLOGY), 'aruba')
+        self.resource = http.TopologyResource(nsa.NetworkServiceAgent('aruba:nsa', 'aruba-endpoint'), network)
+
+
+    def get(self, **headers):
+        request = DummyRequest([''])
+        request.client = address.IPv4Address('TCP', '127.0.0.1', 4711)
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name.replace('_', '-'), [ value ])
+        body = self.resource.render_GET(request)
+        header = lambda name : (request.responseHeaders.getRawHeaders(name) or [ None ])[0]
+        return request.responseCode or 200, body, header('etag'), header('content-encoding')
+
+
+    def testEncoding(self):
+
+        code, body, etag, encoding = self.get()
+        self.assertEquals( (code, etag, encoding), (200, self.resource.etag, None) )
+        nsi_agent, network = nmlxml.parseNSITopology(StringIO(body))
+        self.assertEquals(sorted(network.ports), sorted(self.resource.nml_network.ports))
+
+        code, gzip_body, etag, encoding = self.get(accept_encoding='deflate, gzip;q=0.5')
+        self.assertEquals( (code, etag, encoding), (200, self.resource.etag_gzip, 'gzip') )
+        self.assertEquals(zlib.decompress(gzip_body, 16 + zlib.MAX_WBITS), body)
+        self.failUnless(len(gzip_body) < len(body))
+
+        self.assertEquals(self.get(accept_encoding='gzip;q=0')[3], None)
+        self.assertEquals(self.get(accept_encoding='identity')[3], None)
+
+
+    def testConditionalRequests(self):
+
+        self.assertEquals(self.get(if_none_match=self.resource.etag)[:2], (304, ''))
+        self.assertEquals(self.get(if_none_match='"other", ' + self.resource.etag_gzip)[0], 304)
+        self.assertEquals(self.get(if_modified_since=self.resource.topology_version_http)[0], 304)
+        # if-none-match takes precedence
+        self.assertEquals(self.get(if_none_match='"other"', if_modified_since=self.resource.topology_version_http)[0], 200)
+
+        # new network version gives a new representation
+        etag = self.resource.etag
+        self.resource.nml_network.version = self.resource.nml_network.version + datetime.timedelta(seconds=10)
+        self.assertEquals(self.get(if_none_match=etag)[0], 200)
+        self.failIfEquals(self.resource.etag, etag)
+
+
+
+class FakeProviderRegistry:
+
+    def __init__(self):
+        self.spawned = []
+
+    def spawnProvider(self, nsi_agent):
+        self.spawned.append(nsi_agent)
+
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        network, _ = nrmparser.parseTopologySpec(StringIO(topology.ARUBA_TOPOLOGY), 'aruba')
+        self.resource = http.TopologyResource(nsa.NetworkServiceAgent('aruba:nsa', 'aruba-endpoint'), network)
+        self.port = reactor.listenTCP(0, server.Site(self.resource), interface='127.0.0.1')
+
+        self.topology = nml.Topology()
+        self.provider_registry = FakeProviderRegistry()
+        self.url = 'http://127.0.0.1:%i/' % self.port.getHost().port
+        self.fetcher = self.createFetcher( [ ('aruba', self.url) ] )
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        # close the pooled connections, and let the server see it
+        yield httpclient.closeConnections()
+        yield task.deferLater(reactor, 0, lambda : None)
+        yield self.port.stopListening()
+
+
+    def createFetcher(self, peering_entries, **kwargs):
+        fs = fetcher.FetcherService(peering_entries, self.topology, self.provider_registry, **kwargs)
+        fs.parse_pool.start()
+        self.addCleanup(fs.parse_pool.stop)
+        return fs
+
+
+    @defer.inlineCallbacks
+    def testConditionalFetch(self):
+
+        yield self.fetcher.fetchTopologies()
+        network = self.topology.getNetwork(ARUBA_NETWORK)
+        self.assertEquals(len(self.provider_registry.spawned), 1)
+        self.assertEquals(self.fetcher.validators['aruba'], { 'If-Modified-Since' : self.resource.topology_version_http,
+                                                              'If-None-Match'     : self.resource.etag_gzip } )
+
+        # unchanged topology is not downloaded again
+        yield self.fetcher.fetchTopologies()
+        self.assertIdentical(self.topology.getNetwork(ARUBA_NETWORK), network)
+        self.assertEquals(len(self.provider_registry.spawned), 1)
+        self.assertEquals(self.fetcher.statistics['aruba'].fetches, 1)
+        self.assertEquals(self.fetcher.statistics['aruba'].not_modified, 1)
+
+        # new version, only the changed port is replaced
+        spec = topology.ARUBA_TOPOLOGY.replace('vlan:1780-1789   500    em2', 'vlan:1780-1785   500    em2')
+        self.resource.nml_network, _ = nrmparser.parseTopologySpec(StringIO(spec), 'aruba')
+        self.resource.nml_network.version = datetime.datetime.utcnow() + datetime.timedelta(seconds=2)
+        self.resource.updateRepresentation()
+
+        yield self.fetcher.fetchTopologies()
+        updated = self.topology.getNetwork(ARUBA_NETWORK)
+        self.assertEquals(len(self.provider_registry.spawned), 2)
+        self.assertIdentical(updated.getPort('aruba:bon'), network.getPort('aruba:bon'))
+        self.assertEquals(updated.getPort('aruba:dom').labels()[0].labelValue(), '1780-1785')
+
+
+    @defer.inlineCallbacks
+    def testScheduling(self):
+
+        # a port where nothing listens
+        closed = reactor.listenTCP(0, server.Site(self.resource), interface='127.0.0.1')
+        failing_url = 'http://127.0.0.1:%i/' % closed.getHost().port
+        yield closed.stopListening()
+
+        clock = task.Clock()
+        self.fetcher = fetcher.FetcherService( [ ('aruba', self.url), ('bonaire', failing_url) ], self.topology, self.provider_registry)
+        self.fetcher.clock = clock
+        self.fetcher.jitter = 0
+        self.fetcher.startService()
+        self.assertEquals(sorted(self.fetcher.calls), [ 'aruba', 'bonaire' ])
+
+        yield self.fetcher.scheduledFetch('aruba', self.url)
+        self.assertEquals(self.fetcher.calls['aruba'].getTime(), fetcher.FETCH_INTERVAL)
+        stats = self.fetcher.statistics['aruba']
+        self.assertEquals( (stats.fetches, stats.failures), (1, 0) )
+        self.failIf(stats.parse_latency is None)
+        self.assertEquals(stats.averageFetchLatency(), 0)
+
+        # failures back off exponentially
+        for failures in range(1, 4):
+            yield self.fetcher.scheduledFetch('bonaire', failing_url)
+            self.assertEquals(self.fetcher.statistics['bonaire'].failures, failures)
+            self.assertEquals(self.fetcher.calls['bonaire'].getTime(), fetcher.BACKOFF_START * 2 ** (failures - 1))
+        self.fetcher.statistics['bonaire'].failures = 100
+        self.assertEquals(self.fetcher.nextDelay('bonaire'), fetcher.BACKOFF_MAX)
+
+        # an unexpected error in the fetch does not stop the peer from being fetched
+        self.fetcher.retrieveTopology = lambda network_name, topology_url : defer.fail(ValueError('bug'))
+        yield self.fetcher.scheduledFetch('aruba', self.url)
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEquals(stats.failures, 1)
+        self.assertEquals(self.fetcher.calls['aruba'].getTime(), fetcher.BACKOFF_START)
+
+        self.fetcher.stopService()
+        self.assertEquals(self.fetcher.calls, {})
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+
+    def testConcurrencyLimit(self):
+
+        self.fetcher = self.createFetcher( [ ('aruba', self.url), ('aruba2', self.url) ], concurrency=1)
+        d = self.fetcher.fetchTopologies()
+        self.assertEquals( (self.fetcher.semaphore.tokens, len(self.fetcher.semaphore.waiting)), (0, 1) )
+        return d
+
+
+    @defer.inlineCallbacks
+    def testParseFailure(self):
+
+        junk = reactor.listenTCP(0, server.Site(static.Data('<nsi-junk>', 'text/xml')), interface='127.0.0.1')
+        self.addCleanup(junk.stopListening)
+        self.fetcher = self.createFetcher( [ ('junk', 'http://127.0.0.1:%i/' % junk.getHost().port) ] )
+
+        yield self.fetcher.fetchTopologies()
+        self.assertEquals(self.fetcher.statistics['junk'].failures, 1)
+        self.assertEquals(self.fetcher.validators, {})
+        self.assertEquals(self.topology.networks, {})
+
+
+    @defer.inlineCallbacks
+    def testTopologyCache(self):
+
+        topology_cache = cache.TopologyCache(self.mktemp())
+        self.assertEquals(topology_cache.load(), {})
+
+        self.fetcher = self.createFetcher( [ ('aruba', self.url) ], cache=topology_cache)
+        yield self.fetcher.fetchTopologies()
+        self.assertEquals(topology_cache.load().keys(), [ 'aruba' ])
+        self.assertEquals(os.listdir(topology_cache.directory), [ 'aruba' + cache.CACHE_SUFFIX ])
+
+        # peers which are no longer configured are dropped
+        topology_cache.save('gone', ('agent', 'network', {}))
+
+        # restart, the topology is there before anything is fetched
+        self.topology = nml.Topology()
+        self.provider_registry = FakeProviderRegistry()
+        self.fetcher = self.createFetcher( [ ('aruba', self.url), ('bonaire', self.url) ], cache=topology_cache)
+        self.fetcher.loadCache()
+
+        network = self.topology.getNetwork(ARUBA_NETWORK)
+        self.assertEquals(sorted(network.ports), sorted(self.resource.nml_network.ports))
+        self.assertEquals( [ a.urn() for a in self.provider_registry.spawned ], [ 'urn:ogf:network:aruba:nsa-cs' ] )
+
+        # and the fetch only checks that it is still current
+        yield self.fetcher.fetchTopology('aruba', self.url)
+        self.assertEquals(self.fetcher.statistics['aruba'].not_modified, 1)
+        self.assertIdentical(self.topology.getNetwork(ARUBA_NETWORK), network)
+
+        self.assertEquals(topology_cache.load().keys(), [ 'aruba' ])
+
+        # unusable cache files are discarded
+        with open(topology_cache.filename('aruba'), 'w') as f:
+            f.write('garbage')
+        self.assertEquals(topology_cache.load(), {})
+        self.assertEquals(os.listdir(topology_cache.directory), [])
+
+        # and so are cached topologies which cannot be used
+        topology_cache.save('aruba', ('agent', 'network', {}))
+        self.fetcher.loadCache()
+        self.assertEquals(topology_cache.load(), {})